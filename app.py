@@ -1,28 +1,83 @@
-from flask import Flask, jsonify, request
-from utils import blockchain, did_manager, vc_manager
+from flask import Flask, Response, jsonify, request
+from utils import admin_token, blockchain, did_manager, vc_manager, keystore, node_sync, storage
+import hmac
 import json
+from time import perf_counter
 from roles import Issuer, Holder, Verifier
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
+from wire import JSONProvider, NDJSON_MIMETYPE, ndjson_lines, request_body
+from metrics import registry as metrics, profiler
+from sync import MAX_BLOCKS, MAX_HEADERS, encode_blocks
+from bulk import KINDS, Importer, export_records
+import handlers
 
 app = Flask(__name__)
+app.json = JSONProvider(app)
+
+MAX_PAGE_SIZE = 1000
+MAX_IMPORT_BATCH = 50000
+MAX_ISSUE_BATCH = 10000  # Credentials per /issue_credentials/batch request, all anchored in one block
+
+@app.before_request
+def _start_request_timer():
+    if metrics.enabled:
+        request.environ['ssi.started'] = perf_counter()
+
+@app.before_request
+def _refresh_shared_state():
+    # Picks up what other workers wrote to a shared state backend
+    if storage is not None:
+        storage.refresh()
+
+@app.after_request
+def _record_request_time(response):
+    started = request.environ.get('ssi.started')
+    if started is not None:
+        handlers.record_request_time(started)
+    return response
+
+def _admin_error(action):
+    """
+    Error response unless the request carries the SSI_ADMIN_TOKEN bearer token,
+    for operations only the operator may run.
+    """
+    if not admin_token:
+        return jsonify({"error": f"{action} only when SSI_ADMIN_TOKEN is set"}), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {admin_token}".encode()):
+        return jsonify({"error": "Invalid or missing admin token"}), 401
+    return None
 
 @app.route('/create_issuer_did', methods=['POST'])
 def create_issuer_did():
     name = request.args.get('name')
-    issuer = Issuer(name)
+    key_algorithm = request.args.get('key_algorithm')
+    try:
+        issuer = Issuer(name, keystore=keystore, key_algorithm=key_algorithm)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     issuer_did = issuer.did
-    blockchain.add_did(issuer_did, name)
-    blockchain.new_block(proof=12345)  # Create a new block for the DID registration
-    return jsonify({"issuer_did": issuer_did, "name": name}), 201
+    blockchain.add_did(issuer_did, name, 'issuer')  # Sealed into a block by the background sealer
+    return jsonify({"issuer_did": issuer_did, "name": name, "keys": keystore.list_keys(issuer_did)}), 201
+
+@app.route('/rotate_issuer_key', methods=['POST'])
+def rotate_issuer_key():
+    issuer_did = request.args.get('issuer_did')
+    key_algorithm = request.args.get('key_algorithm')
+    if not issuer_did or not keystore.has_key(issuer_did):
+        return jsonify({"message": "Issuer not found"}), 404
+    try:
+        key_id = keystore.rotate_key(issuer_did, key_algorithm)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"issuer_did": issuer_did, "active_key_id": key_id, "keys": keystore.list_keys(issuer_did)}), 200
 
 @app.route('/create_holder_did', methods=['POST'])
 def create_holder_did():
     name = request.args.get('name')
     holder = Holder(name)
     holder_did = holder.did
-    blockchain.add_did(holder_did, name)
-    blockchain.new_block(proof=12345)  # Create a new block for the DID registration
+    blockchain.add_did(holder_did, name, 'holder')  # Sealed into a block by the background sealer
     return jsonify({"holder_did": holder_did, "name": name}), 201
 
 @app.route('/create_verifier_did', methods=['POST'])
@@ -30,8 +85,7 @@ def create_verifier_did():
     name = request.args.get('name')
     verifier = Verifier(name=name)
     verifier_did = verifier.did_manager.create_verifier_did(name)
-    blockchain.add_did(verifier_did, name)
-    blockchain.new_block(proof=12345)  # Create a new block for the DID registration
+    blockchain.add_did(verifier_did, name, 'verifier')  # Sealed into a block by the background sealer
     return jsonify({"verifier_did": verifier_did, "name": name}), 201
 
 def serialize_key(key):
@@ -44,41 +98,59 @@ def serialize_key(key):
 
 @app.route('/issue_credential', methods=['POST'])
 def issue_credential():
-    issuer_did = request.args.get('issuer_did')
-    subject_did = request.args.get('subject_did')
-    diploma_name = request.args.get('passport_name_country')
-    graduation_date = request.args.get('valid_date')
-
-    if not all([issuer_did, subject_did, diploma_name, graduation_date]):
-        error_message = {"error": "Missing required parameters"}
+    data, status = handlers.issue_credential(request.args)
+    return jsonify(data), status
+
+@app.route('/issue_credentials/batch', methods=['POST'])
+def issue_credentials_batch():
+    body = request_body() or {}
+    issuer_did = body.get('issuer_did')
+    entries = body.get('credentials')
+    executor = body.get('executor', 'thread')
+
+    if not issuer_did or not isinstance(entries, list) or not entries:
+        error_message = {"error": "Missing issuer_did or credentials"}
         app.logger.error(f"Error: {error_message}")
         return jsonify(error_message), 400
-
-    credential_data = {
-        'passport_name_country': diploma_name,
-        'valid_date': graduation_date,
-    }
-
-    issuer_name = next((did['name'] for did in blockchain.dids if did['did'] == issuer_did), "unknown issuer")
-    app.logger.debug(f"Issuer Name: {issuer_name}")
-
-    credential = vc_manager.create_credential(issuer_did, subject_did, credential_data)
-    blockchain.new_transaction('VC_ISSUANCE', {
-        'issuer_did': issuer_did,
-        'subject_did': subject_did,
-        'credential_id': credential['credential_id'],
-    })
-    blockchain.new_block(proof=12345)  # Create a new block for the credential issuance
-
-    app.logger.debug("Credential issued successfully.")
-    app.logger.debug(f"Credential Data: {credential}")
-
-    response_data = {
-        "credential_id": credential["credential_id"],
-        "credential": credential["credential"]
-    }
-
-    return jsonify(response_data), 201
+    if len(entries) > MAX_ISSUE_BATCH:
+        return jsonify({"error": f"At most {MAX_ISSUE_BATCH} credentials per request"}), 413
+    if executor not in ('thread', 'process'):
+        return jsonify({"error": f"Unsupported executor: {executor}"}), 400
+    if not keystore.has_key(issuer_did):
+        return jsonify({"message": "Issuer not found"}), 404
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get('subject_did') or not isinstance(entry.get('claims'), dict):
+            return jsonify({"error": "Each credential needs a subject_did and a claims object"}), 400
+
+    def generate():
+        transactions = []
+        block_index = None
+        try:
+            results = vc_manager.create_credentials(
+                issuer_did,
+                ((entry['subject_did'], entry['claims']) for entry in entries),
+                executor=executor,
+            )
+            for credential in results:
+                transactions.append({
+                    'issuer_did': issuer_did,
+                    'subject_did': credential['credential']['credentialSubject']['id'],
+                    'credential_id': credential['credential_id'],
+                })
+                yield json.dumps({
+                    "credential_id": credential["credential_id"],
+                    "credential": credential["credential"],
+                }) + '\n'
+        finally:
+            # Every credential of the batch is anchored in one block, even if the client went away.
+            # The transactions enter the mempool together, so the sealer cannot split the batch.
+            if transactions:
+                block = blockchain.submit_transactions('VC_ISSUANCE', transactions).result()
+                block_index = block['index']
+                app.logger.debug(f"Batch of {len(transactions)} credentials recorded in block {block_index}")
+        yield json.dumps({"issued": len(transactions), "block_index": block_index}) + '\n'
+
+    return Response(generate(), status=201, mimetype=NDJSON_MIMETYPE)
 
 @app.route('/present_credential', methods=['POST'])
 def present_credential():
@@ -86,41 +158,41 @@ def present_credential():
     verifier_did = request.args.get('verifier_did')
     credential_id = request.args.get('credential_id')
     credential = vc_manager.credentials.get(credential_id)
-    if credential and credential['credential']['credentialSubject']['id'] == holder_did:
+    if credential and credential.subject == holder_did:
         vc_manager.present_credential(credential_id, verifier_did)
         return jsonify({"message": "Credential presented to verifier"}), 200
     return jsonify({"message": "Credential not found or unauthorized"}), 404
 
 @app.route('/verify_credential', methods=['POST'])
 def verify_credential():
-    verifier_did = request.args.get('verifier_did')
-    credential_id = request.args.get('credential_id')
-    
-    if not all([verifier_did, credential_id]):
-        app.logger.error("Missing verifier_did or credential_id")
-        return jsonify({"error": "Missing verifier_did or credential_id"}), 400
-    
-    verifier = Verifier(verifier_did=verifier_did)
-    is_valid = verifier.verify_credential(credential_id)
+    data, status = handlers.verify_credential(request.args)
+    return jsonify(data), status
 
-    app.logger.debug(f"Verification result for credential {credential_id}: {is_valid}")
-    
-    return jsonify({"valid": is_valid}), 200
+@app.route('/verify_credentials/batch', methods=['POST'])
+def verify_credentials_batch():
+    data, status = handlers.verify_credentials_batch(request.args, request_body())
+    return jsonify(data), status
 
 @app.route('/revoke_credential', methods=['POST'])
 def revoke_credential():
-    issuer_did = request.args.get('issuer_did')
-    credential_id = request.args.get('credential_id')
-    credential = vc_manager.credentials.get(credential_id)
-    if credential and credential['credential']['issuer'] == issuer_did:
-        vc_manager.revoke_credential(credential_id)
-        blockchain.new_transaction('VC_REVOCATION', {
-            'issuer_did': issuer_did,
-            'credential_id': credential_id,
-        })
-        blockchain.new_block(proof=12345)  # Create a new block for the credential revocation
-        return jsonify({"message": "Credential revoked"}), 200
-    return jsonify({"message": "Credential not found or unauthorized"}), 404
+    data, status = handlers.revoke_credential(request.args)
+    return jsonify(data), status
+
+@app.route('/status/<issuer_did>', methods=['GET'])
+def status_list(issuer_did):
+    result = vc_manager.status_lists.document(issuer_did, request.base_url)
+    if result is None:
+        return jsonify({"message": "No status list for this issuer"}), 404
+    document, etag = result
+    response = jsonify(document)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response.make_conditional(request)
+
+@app.route('/credential_status/<credential_id>', methods=['GET'])
+def credential_status(credential_id):
+    status = vc_manager.credential_status(credential_id)
+    return jsonify({"credential_id": credential_id, "status": status}), 404 if status == 'unknown' else 200
 
 @app.route('/revoke_access_credential', methods=['POST'])
 def revoke_access_credential():
@@ -128,26 +200,266 @@ def revoke_access_credential():
     verifier_did = request.args.get('verifier_did')
     credential_id = request.args.get('credential_id')
     credential = vc_manager.credentials.get(credential_id)
-    if credential and credential['credential']['credentialSubject']['id'] == holder_did:
-        vc_manager.revoke_access_credential(credential_id, verifier_did)
-        blockchain.new_transaction('VC_ACCESS_REVOCATION', {
+    if credential and credential.subject == holder_did:
+        if not vc_manager.revoke_access_credential(credential_id, verifier_did):
+            return jsonify({"message": "Credential was not presented to this verifier"}), 404
+        blockchain.submit_transaction('VC_ACCESS_REVOCATION', {
             'holder_did': holder_did,
             'verifier_did': verifier_did,
             'credential_id': credential_id,
-        })
-        blockchain.new_block(proof=12345)  # Create a new block for the access revocation
+        })  # Sealed into a block by the background sealer
         return jsonify({"message": "Credential access revoked from verifier"}), 200
     return jsonify({"message": "Credential not found or unauthorized"}), 404
 
+@app.route('/credential/<credential_id>', methods=['GET'])
+def credential_record(credential_id):
+    """
+    The stored credential with its signature, signed bytes and issuer key,
+    for verifiers that check signatures themselves. Byte fields are base64
+    in JSON and native byte strings in CBOR.
+    """
+    record = vc_manager.credentials.get(credential_id)
+    if record is None:
+        return jsonify({"message": "Credential not found"}), 404
+    return jsonify(record.as_dict(credential_id)), 200
+
+@app.route('/proof/<credential_id>', methods=['GET'])
+def credential_proof(credential_id):
+    proofs = blockchain.inclusion_proofs(credential_id)
+    if not proofs:
+        return jsonify({"message": "No anchored transaction for this credential"}), 404
+    return jsonify({"credential_id": credential_id, "proofs": proofs}), 200
+
+def _page_args(default_start):
+    """
+    Reads the cursor arguments shared by the listing routes. Returns
+    (start, limit, stream) or raises ValueError on malformed input.
+    """
+    start = int(request.args.get('start', default_start))
+    limit = request.args.get('limit')
+    limit = int(limit) if limit is not None else None
+    if start < default_start or (limit is not None and not 0 < limit <= MAX_PAGE_SIZE):
+        raise ValueError(f"start must be >= {default_start} and limit between 1 and {MAX_PAGE_SIZE}")
+    stream = request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == NDJSON_MIMETYPE
+    return start, limit, stream
+
 @app.route('/show_blockchain', methods=['GET'])
 def show_blockchain():
-    # Ensure all byte data is properly serialized
-    chain = json.loads(json.dumps(blockchain.chain, default=str))
-    return jsonify(chain), 200
+    """
+    Without arguments the whole chain is returned as before. ?start=<block
+    index>&limit=<n> returns one page plus next_start, and ?format=ndjson
+    streams the requested range one block per line.
+    """
+    try:
+        start, limit, stream = _page_args(default_start=1)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # A reorganization replaces the chain list rather than changing it, so the range
+    # is read from one list without holding the chain lock
+    chain = blockchain.chain
+    height = len(chain)
+    end = height if limit is None else min(height, start - 1 + limit)
+    blocks = (chain[index] for index in range(start - 1, end))
+    if stream:
+        return Response(ndjson_lines(blocks), mimetype=NDJSON_MIMETYPE)
+    if limit is None and 'start' not in request.args:
+        return jsonify(list(blocks)), 200
+    return jsonify({
+        "blocks": list(blocks),
+        "height": height,
+        "next_start": end + 1 if end < height else None,
+    }), 200
+
+@app.route('/transactions', methods=['GET'])
+def find_transactions():
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({"error": "cursor and limit must be integers"}), 400
+    if cursor < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"cursor must be >= 0 and limit between 1 and {MAX_PAGE_SIZE}"}), 400
+    try:
+        transactions, next_cursor = blockchain.find_transactions(
+            did=request.args.get('did'),
+            credential_id=request.args.get('credential_id'),
+            transaction_type=request.args.get('type'),
+            role=request.args.get('role'),
+            cursor=cursor,
+            limit=limit,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"transactions": transactions, "next_cursor": next_cursor}), 200
+
+@app.route('/resolve/<did>', methods=['GET'])
+def resolve_did(did):
+    document = did_manager.resolve(did)
+    if document is None:
+        return jsonify({"message": "DID not found"}), 404
+    return jsonify(document), 200
+
+@app.route('/find_dids', methods=['GET'])
+def find_dids():
+    name = request.args.get('name')
+    did_type = request.args.get('type')
+    if name:
+        dids = did_manager.find_by_name(name, did_type)
+    elif did_type:
+        dids = did_manager.find_by_type(did_type)
+    else:
+        return jsonify({"error": "Missing name or type"}), 400
+    return jsonify([did_manager.resolve(did) for did in dids]), 200
 
 @app.route('/show_dids', methods=['GET'])
 def show_dids():
-    return jsonify(blockchain.dids), 200
+    """
+    Same cursor arguments as /show_blockchain, where start is the position
+    of the DID in registration order.
+    """
+    try:
+        start, limit, stream = _page_args(default_start=0)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    total = len(did_manager)
+    end = total if limit is None else min(total, start + limit)
+    dids = ({'did': record['did'], 'name': record['name']} for record in did_manager.records(start, end))
+    if stream:
+        return Response(ndjson_lines(dids), mimetype=NDJSON_MIMETYPE)
+    if limit is None and 'start' not in request.args:
+        return jsonify(list(dids)), 200
+    return jsonify({
+        "dids": list(dids),
+        "total": total,
+        "next_start": end if end < total else None,
+    }), 200
+
+@app.route('/memory_report', methods=['GET'])
+def memory_report():
+    return jsonify({"credentials": vc_manager.credentials.memory_report()}), 200
+
+@app.route('/export', methods=['GET'])
+def export_state():
+    """
+    Streams DIDs, credentials, revocations and presentations as NDJSON in the
+    format /import reads. ?kinds=did,credential limits the record kinds.
+    """
+    kinds = request.args.get('kinds', ','.join(KINDS)).split(',')
+    unknown = set(kinds) - set(KINDS)
+    if unknown:
+        return jsonify({"error": f"Unknown kinds: {', '.join(sorted(unknown))}"}), 400
+    return Response(export_records(blockchain, vc_manager, kinds), mimetype=NDJSON_MIMETYPE)
+
+@app.route('/import', methods=['POST'])
+def import_state():
+    """
+    Reads NDJSON records from the (possibly chunked) request body and streams
+    back one report per anchored batch. After an interruption, send the same
+    input again with ?skip=<line of the last report>.
+    """
+    error = _admin_error("Records can be imported")
+    if error:
+        return error
+    try:
+        skip = int(request.args.get('skip', 0))
+        batch_size = int(request.args.get('batch_size', 5000))
+    except ValueError:
+        return jsonify({"error": "skip and batch_size must be integers"}), 400
+    if skip < 0 or not 0 < batch_size <= MAX_IMPORT_BATCH:
+        return jsonify({"error": f"skip must be >= 0 and batch_size between 1 and {MAX_IMPORT_BATCH}"}), 400
+    importer = Importer(blockchain, vc_manager, batch_size)  # Signatures are always checked here
+    reports = importer.run(request.stream, skip)
+    return Response(ndjson_lines(reports), mimetype=NDJSON_MIMETYPE)
+
+@app.route('/chain_head', methods=['GET'])
+def chain_head():
+    with blockchain.lock:
+        return jsonify({
+            "height": len(blockchain.chain),
+            "hash": blockchain.block_hashes[-1],
+            "genesis_hash": blockchain.block_hashes[0],
+        }), 200
+
+@app.route('/headers', methods=['GET'])
+def block_headers():
+    """
+    Packed 88-byte headers of blocks start..start+limit-1, concatenated.
+    """
+    start = request.args.get('start', 1, type=int)
+    limit = request.args.get('limit', MAX_HEADERS, type=int)
+    if start < 1 or not 0 < limit <= MAX_HEADERS:
+        return jsonify({"error": f"start must be >= 1 and limit between 1 and {MAX_HEADERS}"}), 400
+    return Response(blockchain.headers(start, limit), mimetype='application/octet-stream')
+
+@app.route('/blocks', methods=['GET'])
+def block_batch():
+    """
+    Blocks start..start+limit-1 as gzip-compressed NDJSON, for peers that
+    already validated their headers.
+    """
+    start = request.args.get('start', 1, type=int)
+    limit = request.args.get('limit', MAX_BLOCKS, type=int)
+    if start < 1 or not 0 < limit <= MAX_BLOCKS:
+        return jsonify({"error": f"start must be >= 1 and limit between 1 and {MAX_BLOCKS}"}), 400
+    with blockchain.lock:
+        blocks = blockchain.chain[start - 1:start - 1 + limit]
+    return Response(encode_blocks(blocks), mimetype='application/gzip')
+
+@app.route('/peers', methods=['GET', 'POST', 'DELETE'])
+def peers():
+    url = request.args.get('url')
+    if request.method != 'GET':
+        # Peers can replace the chain, so only the operator may change them
+        error = _admin_error("Peers can be changed")
+        if error:
+            return error
+        if not url:
+            return jsonify({"error": "Missing url"}), 400
+        if request.method == 'POST':
+            node_sync.add_peer(url)
+        elif not node_sync.remove_peer(url):
+            return jsonify({"message": "Peer not found"}), 404
+    return jsonify({"peers": node_sync.peers}), 200
+
+@app.route('/sync', methods=['POST'])
+def sync_chain():
+    # A sync can replace the chain and ties up the node, so it is left to the operator
+    error = _admin_error("Syncs can be triggered")
+    if error:
+        return error
+    reports = node_sync.sync()
+    return jsonify({"height": len(blockchain.chain), "peers": reports}), 200
+
+@app.route('/consensus', methods=['GET'])
+def consensus_stats():
+    return jsonify(blockchain.consensus.stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def show_metrics():
+    return Response(metrics.expose(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiler', methods=['GET', 'POST'])
+def sampling_profiler():
+    """
+    POST ?action=start|stop toggles the sampling profiler at runtime, GET
+    returns the hottest stacks sampled so far. Stacks reveal internals and
+    sampling costs CPU, so both need the admin token.
+    """
+    error = _admin_error("The profiler can be used")
+    if error:
+        return error
+    if request.method == 'POST':
+        action = request.args.get('action')
+        if action == 'start':
+            profiler.start()
+        elif action == 'stop':
+            profiler.stop()
+        else:
+            return jsonify({"error": "action must be start or stop"}), 400
+    limit = request.args.get('limit', 25, type=int)
+    return jsonify(profiler.report(limit)), 200
 
 if __name__ == '__main__':
     app.run(debug=True)
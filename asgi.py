@@ -0,0 +1,172 @@
+"""
+ASGI entry point, e.g. `uvicorn asgi:application --workers 1`.
+
+The routes on the credential hot path are served natively: the event loop
+parses requests and writes responses, and the handlers shared with app.py
+run on a bounded CryptoPool, which sheds load with 503 once it is full.
+Every other route is delegated to the Flask app in app.py, run on a pool of
+SSI_WSGI_WORKERS threads, so both serving modes expose the same API.
+
+Requires the optional asgiref package (and an ASGI server such as uvicorn).
+"""
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from time import perf_counter
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgiInstance
+from app import app as flask_app
+from executor import CryptoPool, Overloaded
+from metrics import registry as metrics
+from utils import storage
+import handlers
+import wire
+
+crypto_pool = CryptoPool(
+    max_workers=int(os.environ.get('SSI_CRYPTO_WORKERS', 0)) or None,
+    max_pending=int(os.environ.get('SSI_CRYPTO_MAX_PENDING', 0)) or None,
+)
+
+wsgi_pool = ThreadPoolExecutor(int(os.environ.get('SSI_WSGI_WORKERS', 32)), thread_name_prefix='wsgi')
+
+# Bodies of the native routes are decoded in memory
+MAX_BODY_SIZE = int(os.environ.get('SSI_MAX_BODY_BYTES', 16 * 1024 * 1024))
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class WsgiInstance(WsgiToAsgiInstance):
+    """
+    Runs one request through the Flask app. asgiref's own adapter runs every
+    request on a single shared thread (sync_to_async is thread sensitive by
+    default), so one long import or batch would hold up all delegated
+    routes; here each request gets a thread of wsgi_pool instead.
+    """
+
+    async def __call__(self, scope, receive, send):
+        self.scope = scope
+        loop = asyncio.get_running_loop()
+        self.sync_send = lambda message: asyncio.run_coroutine_threadsafe(send(message), loop).result()
+        with SpooledTemporaryFile(max_size=65536) as body:  # /import bodies can be large
+            more_body = True
+            while more_body:
+                message = await receive()
+                body.write(message.get('body', b''))
+                more_body = message.get('more_body', False)
+            body.seek(0)
+            await loop.run_in_executor(wsgi_pool, self._run_wsgi_app, body)
+
+    def _run_wsgi_app(self, body):
+        output = self.wsgi_application(self.build_environ(self.scope, body), self.start_response)
+        try:
+            for chunk in output:  # Streamed responses (/export, /import) are sent as they are produced
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                self.sync_send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(output, 'close'):
+                output.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({'type': 'http.response.body'})
+
+
+async def _read_body(receive, limit=MAX_BODY_SIZE):
+    chunks = []
+    size = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge(f"Request body exceeds {limit} bytes")
+        chunks.append(chunk)
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+def _decode_body(body, content_type):
+    """
+    The request body as CBOR or JSON depending on its Content-Type, or None
+    if it is empty or malformed.
+    """
+    if not body:
+        return None
+    try:
+        if content_type.split(';')[0].strip() == wire.CBOR_MIMETYPE:
+            return wire.cbor_loads(body)
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+async def _send_response(send, data, status=200, headers=(), mimetype=wire.JSON_MIMETYPE):
+    body = wire.cbor_dumps(data) if mimetype == wire.CBOR_MIMETYPE else wire.dumps(data).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', mimetype.encode('ascii')),
+            (b'content-length', str(len(body)).encode('ascii')),
+            *headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _handle(handler, args, body):
+    if storage is not None:
+        storage.refresh()  # Blocking database reads, so done on the pool like the handler itself
+    return handler(args, body)
+
+
+ROUTES = {
+    ('POST', '/issue_credential'): handlers.issue_credential,
+    ('POST', '/verify_credential'): handlers.verify_credential,
+    ('POST', '/verify_credentials/batch'): handlers.verify_credentials_batch,
+    ('POST', '/revoke_credential'): handlers.revoke_credential,
+}
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                crypto_pool.shutdown()
+                wsgi_pool.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        await WsgiInstance(flask_app)(scope, receive, send)
+        return
+
+    started = perf_counter() if metrics.enabled else None
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    args = {key: values[0] for key, values in query.items()}
+    headers = {name: value.decode('latin-1') for name, value in scope.get('headers', ())}
+    mimetype = wire.negotiate(headers.get(b'accept'))
+    try:
+        body = _decode_body(await _read_body(receive), headers.get(b'content-type', ''))
+    except BodyTooLarge as e:
+        await _send_response(send, {"error": str(e)}, 413, mimetype=mimetype)
+        return
+    try:
+        data, status = await crypto_pool.run(_handle, handler, args, body)
+    except Overloaded as e:
+        await _send_response(send, {"error": str(e)}, 503, headers=[(b'retry-after', b'1')], mimetype=mimetype)
+    else:
+        await _send_response(send, data, status, mimetype=mimetype)
+    if started is not None:
+        handlers.record_request_time(started)
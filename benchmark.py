@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter, time
+from urllib.request import Request, urlopen
+
+# Keys created while benchmarking must not end up in the node's real keystore
+os.environ.setdefault('SSI_KEYSTORE_DIR', tempfile.mkdtemp(prefix='ssi-bench-keys-'))
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from blockchain import Blockchain
+from keystore import SUPPORTED_ALGORITHMS, KeyStore
+from vc import VerifiableCredential
+from wire import cbor_dumps, cbor_loads
+
+CLAIMS = {'passport_name_country': 'Alice Example, NL', 'valid_date': '2030-01-01'}
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def percentile(p):
+        return latencies[min(count - 1, int(p / 100 * count))] * 1000 if count else None
+
+    return {
+        'count': count,
+        'throughput_per_second': count / elapsed if elapsed else None,
+        'p50_ms': percentile(50),
+        'p99_ms': percentile(99),
+        'max_ms': latencies[-1] * 1000 if count else None,
+    }
+
+
+def measure(fn, iterations, warmup=None):
+    for _ in range(warmup if warmup is not None else min(10, iterations)):
+        fn()
+    latencies = []
+    began = perf_counter()
+    for _ in range(iterations):
+        start = perf_counter()
+        fn()
+        latencies.append(perf_counter() - start)
+    return summarize(latencies, perf_counter() - began)
+
+
+def run_micro(iterations):
+    results = {}
+
+    # What issuance cost before the keystore: a fresh RSA key for every credential
+    def legacy_create():
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        private_key.sign(json.dumps(CLAIMS).encode('utf-8'), padding.PKCS1v15(), hashes.SHA256())
+
+    results['create_credential[legacy_rsa_keygen]'] = measure(legacy_create, max(1, iterations // 20), warmup=1)
+
+    for algorithm in SUPPORTED_ALGORITHMS:
+        vc_manager = VerifiableCredential(KeyStore(default_algorithm=algorithm))
+        issuer_did = f'bench-issuer-{algorithm}'
+        vc_manager.keystore.create_key(issuer_did)
+        credential_ids = []
+
+        def create():
+            credential_ids.append(vc_manager.create_credential(issuer_did, 'bench-holder', CLAIMS)['credential_id'])
+
+        results[f'create_credential[{algorithm}]'] = measure(create, iterations)
+        ids = iter(credential_ids * 2)
+        results[f'verify_credential[{algorithm}]'] = measure(lambda: vc_manager.verify_credential(next(ids)), iterations)
+
+    for size in (1, 500):
+        blockchain = Blockchain()
+        transactions = [
+            {'type': 'VC_ISSUANCE', 'data': {'issuer_did': 'i', 'subject_did': 's', 'credential_id': str(n)}}
+            for n in range(size)
+        ]
+
+        def seal():
+            blockchain.current_transactions = list(transactions)
+            blockchain.new_block(proof=12345)
+
+        results[f'new_block[{size}_transactions]'] = measure(seal, iterations)
+        block = blockchain.last_block
+        results[f'Blockchain.hash[{size}_transactions]'] = measure(lambda: Blockchain.hash(block), iterations)
+
+    # Response encodings for a full block
+    for name, encode, decode in (('json', lambda o: json.dumps(o).encode('utf-8'), json.loads), ('cbor', cbor_dumps, cbor_loads)):
+        payload = encode(block)
+        results[f'encode_block[{name}]'] = {**measure(lambda: encode(block), iterations), 'bytes': len(payload)}
+        results[f'decode_block[{name}]'] = measure(lambda: decode(payload), iterations)
+    return results
+
+
+class FlaskClient:
+    def __init__(self, verification_cache=False):
+        from app import app
+        from utils import vc_manager
+        self.app = app
+        if not verification_cache:
+            # Every verify request then checks the signature, as it would on a cold cache
+            vc_manager.verification_cache.maxsize = 0
+        self._local = threading.local()
+
+    def post(self, path, json_body=None):
+        # Flask test clients are not thread-safe, so each worker thread gets its own
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post(path, json=json_body)
+        return response.status_code, response.get_json()
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def post(self, path, json_body=None):
+        data = json.dumps(json_body).encode('utf-8') if json_body is not None else b''
+        request = Request(self.base_url + path, data=data, method='POST',
+                          headers={'Content-Type': 'application/json'})
+        with urlopen(request) as response:
+            return response.status, json.loads(response.read() or b'null')
+
+
+def run_load(client, requests, concurrency, verify_ratio, seed, credentials=100):
+    """
+    Drives the issuance and verification endpoints with a fixed-seed mix of
+    requests from concurrency worker threads. The plan, including which of
+    the credentials each verify request checks, is drawn up front, so the
+    same seed sends the same requests however the threads are scheduled.
+    """
+    _, issuer = client.post('/create_issuer_did?name=bench-issuer')
+    _, holder = client.post('/create_holder_did?name=bench-holder')
+    _, verifier = client.post('/create_verifier_did?name=bench-verifier')
+    issuer_did, holder_did, verifier_did = issuer['issuer_did'], holder['holder_did'], verifier['verifier_did']
+    issue_path = (f'/issue_credential?issuer_did={issuer_did}&subject_did={holder_did}'
+                  f'&passport_name_country=bench&valid_date=2030-01-01')
+
+    credential_ids = [client.post(issue_path)[1]['credential_id'] for _ in range(credentials)]
+    for credential_id in credential_ids:
+        client.post(f'/present_credential?holder_did={holder_did}&verifier_did={verifier_did}'
+                    f'&credential_id={credential_id}')
+
+    rng = random.Random(seed)
+    plan = [('verify', rng.choice(credential_ids)) if rng.random() < verify_ratio else ('issue', None)
+            for _ in range(requests)]
+    latencies = {'verify': [], 'issue': []}
+    errors = []
+    lock = threading.Lock()
+    cursor = iter(range(requests))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(cursor, None)
+            if i is None:
+                return
+            kind, credential_id = plan[i]
+            if kind == 'verify':
+                path = f'/verify_credential?verifier_did={verifier_did}&credential_id={credential_id}'
+            else:
+                path = issue_path
+            start = perf_counter()
+            try:
+                status, _ = client.post(path)
+            except Exception as e:
+                status = str(e)
+            elapsed = perf_counter() - start
+            with lock:
+                latencies[kind].append(elapsed)
+                if status not in (200, 201):
+                    errors.append(status)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    began = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - began
+
+    return {
+        'mix': {'verify': verify_ratio, 'issue': 1 - verify_ratio},
+        'concurrency': concurrency,
+        'credentials': credentials,
+        'overall': summarize(latencies['verify'] + latencies['issue'], elapsed),
+        'verify': summarize(latencies['verify'], elapsed),
+        'issue': summarize(latencies['issue'], elapsed),
+        'errors': len(errors),
+    }
+
+
+def environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'git_revision': revision,
+        'timestamp': time(),
+    }
+
+
+def compare(baseline, current):
+    """
+    Prints the relative throughput change of every benchmark present in
+    both result files.
+    """
+    def flatten(results):
+        flat = {}
+        for name, stats in results.get('micro', {}).items():
+            flat[f'micro/{name}'] = stats
+        for name in ('overall', 'verify', 'issue'):
+            if name in results.get('load', {}):
+                flat[f'load/{name}'] = results['load'][name]
+        return flat
+
+    old, new = flatten(baseline), flatten(current)
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name]['throughput_per_second'], new[name]['throughput_per_second']
+        if before and after:
+            print(f"{name:55s} {before:12.1f}/s -> {after:12.1f}/s  ({(after - before) / before * 100:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark issuance, verification and the chain.")
+    parser.add_argument('suite', choices=('micro', 'load', 'all'))
+    parser.add_argument('--iterations', type=int, default=200, help="Iterations per microbenchmark")
+    parser.add_argument('--requests', type=int, default=2000, help="Requests sent by the load generator")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--verify-ratio', type=float, default=0.9)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--credentials', type=int, default=100, help="Credentials the verify requests pick from")
+    parser.add_argument('--verification-cache', action='store_true',
+                        help="Keep the in-process verification cache, so repeated verify requests are cache hits "
+                             "(with --url, set SSI_VERIFICATION_CACHE_SIZE on the server instead)")
+    parser.add_argument('--url', help="Drive a running server instead of the in-process Flask test client")
+    parser.add_argument('--output', help="Write machine-readable results to this JSON file")
+    parser.add_argument('--compare', help="Results file of a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    results = {'environment': environment()}
+    if args.suite in ('micro', 'all'):
+        results['micro'] = run_micro(args.iterations)
+    if args.suite in ('load', 'all'):
+        client = HTTPClient(args.url) if args.url else FlaskClient(args.verification_cache)
+        results['load'] = run_load(client, args.requests, args.concurrency, args.verify_ratio, args.seed,
+                                   args.credentials)
+        results['load']['target'] = args.url or 'flask-test-client'
+        if not args.url:
+            results['load']['verification_cache'] = args.verification_cache
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
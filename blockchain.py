@@ -1,26 +1,207 @@
+import bisect
 import hashlib
-import json
+import logging
+import struct
+import threading
+from concurrent.futures import Future
 from time import time
+from did import DID
+from merkle import merkle_root, merkle_proof
+from consensus import Authority
+from metrics import registry as metrics
+from txindex import TransactionIndex, matches, split_location
+
+# Fixed-size block header: index, timestamp, previous_hash, merkle_root, proof.
+# The proof is last so a miner can reuse the hash state of the first 80 bytes.
+HEADER_FORMAT = '>Qd32s32sQ'
+HEADER_FIELDS = ('index', 'timestamp', 'previous_hash', 'merkle_root', 'proof')
+HEADER_PREFIX_SIZE = struct.calcsize(HEADER_FORMAT) - 8
+
+logger = logging.getLogger(__name__)
+
+def block_header(block):
+    return {field: block[field] for field in HEADER_FIELDS}
+
+def header_bytes(header):
+    return struct.pack(
+        HEADER_FORMAT,
+        header['index'],
+        header['timestamp'],
+        bytes.fromhex(header['previous_hash'].rjust(64, '0')),  # Genesis uses '1'
+        bytes.fromhex(header['merkle_root']),
+        header['proof'],
+    )
+
+def header_prefix(header):
+    # Everything but the proof, i.e. the part of the header a miner hashes once
+    return header_bytes({**header, 'proof': 0})[:HEADER_PREFIX_SIZE]
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, max_block_transactions=500, max_block_latency=0.2, did_registry=None, consensus=None):
         self.chain = []
+        self.block_hashes = []  # Header hash of each block, computed once when it is sealed
+        self.transaction_index = TransactionIndex()  # Updated incrementally as blocks are sealed
         self.current_transactions = []
-        self.dids = []
+        self.did_registry = did_registry if did_registry is not None else DID()
+        self.consensus = consensus or Authority()
+        # Called as listener(event, *args) for 'sealing', 'block', 'seal_aborted', 'reorganized' and 'did'
+        # events; 'seal_aborted' follows a 'sealing' event whose block was not appended
+        self.listeners = []
+        self.max_block_transactions = max_block_transactions
+        self.max_block_latency = max_block_latency  # seconds
+        self.lock = threading.RLock()
+        self._receipts = []  # Futures waiting for the transactions in current_transactions
+        self._pending_since = None
+        self._seal_condition = threading.Condition(self.lock)
+        self._sealer = None
+        self._stopping = False
+        self._seal_requested = False
         self.new_block(previous_hash='1', proof=100)  # Genesis block
 
-    def new_block(self, proof, previous_hash=None):
-        block = {
+    def new_block(self, proof=None, previous_hash=None):
+        """
+        Seals the mempool into a block right away. Without a proof, one is
+        searched by the consensus while the chain lock is held; the background
+        sealer mines off the lock instead.
+        """
+        with self.lock:
+            transactions, receipts = self._take_mempool()
+            try:
+                return self._seal(transactions, receipts, proof=proof, previous_hash=previous_hash)
+            except Exception as e:
+                self._fail_receipts(receipts, e)
+                raise
+
+    def _fail_receipts(self, receipts, error):
+        for receipt in receipts:
+            if not receipt.done():
+                receipt.set_exception(error)
+
+    def _take_mempool(self):
+        transactions, receipts = self.current_transactions, self._receipts
+        self.current_transactions = []
+        self._receipts = []
+        self._pending_since = None
+        self._seal_requested = False
+        return transactions, receipts
+
+    def _block_template(self, transactions, previous_hash=None):
+        return {
             'index': len(self.chain) + 1,
             'timestamp': time(),
-            'transactions': self.current_transactions,
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
+            'transactions': transactions,
+            'merkle_root': merkle_root(transactions),
+            'proof': 0,
+            'previous_hash': previous_hash or self.block_hashes[-1],
         }
-        self.current_transactions = []
-        self.chain.append(block)
+
+    def _seal(self, transactions, receipts, template=None, proof=None, previous_hash=None):
+        """
+        Appends the block of a template mined off the lock, or of a new
+        template. Returns None without appending anything if the tip moved
+        since the template was built, so its proof no longer applies.
+        """
+        with self.lock, metrics.timer('ssi_block_seal_seconds', "Time spent sealing blocks"):
+            try:
+                # Lets a shared state backend append blocks sealed by other workers first
+                for listener in self.listeners:
+                    listener('sealing')
+                if template is not None and (
+                        template['index'] != len(self.chain) + 1 or template['previous_hash'] != self.block_hashes[-1]):
+                    for listener in self.listeners:
+                        listener('seal_aborted')
+                    return None
+                if template is None:
+                    template = self._block_template(transactions, previous_hash)
+                    if proof is None:
+                        proof = self.consensus.seal(header_prefix(template))
+                block = {**template, 'proof': proof}
+                block_hash = self.hash(block)
+            except BaseException:
+                for listener in self.listeners:
+                    listener('seal_aborted')
+                raise
+            self.chain.append(block)
+            self.block_hashes.append(block_hash)
+            self.transaction_index.add_block(block)
+            metrics.inc('ssi_blocks_sealed_total', help_text="Blocks sealed")
+            metrics.inc('ssi_transactions_sealed_total', len(block['transactions']), help_text="Transactions sealed into blocks")
+            for listener in self.listeners:
+                listener('block', block, block_hash)
+        for receipt in receipts:
+            receipt.set_result(block)
         return block
 
+    def load_chain(self, blocks, block_hashes, transaction_index=None):
+        """
+        Replaces the in-memory chain with already validated blocks, e.g. ones
+        read back from storage, without rehashing them. blocks can be any
+        sequence with append and copy, such as storage's lazily read blocks;
+        pass the transaction_index of the blocks if it is known, so they need
+        not be read to build it.
+        """
+        chain = blocks.copy() if hasattr(blocks, 'copy') else list(blocks)
+        hashes = list(block_hashes)
+        if transaction_index is None:
+            transaction_index = TransactionIndex()
+            for block in chain:
+                transaction_index.add_block(block)
+        with self.lock:
+            # Swapped in whole: readers off the lock see either the old chain or the new one
+            self.chain, self.block_hashes, self.transaction_index = chain, hashes, transaction_index
+
+    def view(self):
+        """
+        Returns (chain, block_hashes, transaction_index) as of one moment.
+        Blocks are only ever appended to these, and a reorganization replaces
+        all three, so a reader that keeps to the returned references never
+        mixes blocks of two forks.
+        """
+        with self.lock:
+            return self.chain, self.block_hashes, self.transaction_index
+
+    def append_blocks(self, blocks, block_hashes):
+        """
+        Appends already validated blocks sealed elsewhere, e.g. by another
+        worker sharing the same state backend, without notifying listeners.
+        """
+        with self.lock:
+            for block, block_hash in zip(blocks, block_hashes):
+                self.chain.append(block)
+                self.block_hashes.append(block_hash)
+                self.transaction_index.add_block(block)
+
+    def replace_blocks(self, start, blocks, block_hashes):
+        """
+        Replaces the chain from index start onwards with validated blocks from
+        a peer. start is len(chain) + 1 when the chain is only extended.
+        Returns the blocks that were dropped.
+        """
+        with self.lock:
+            if not 1 <= start <= len(self.chain) + 1:
+                raise ValueError(f"Cannot replace blocks from index {start} of a chain of {len(self.chain)}")
+            dropped = self.chain[start - 1:]
+            if dropped:
+                kept, kept_hashes = self.chain[:start - 1], self.block_hashes[:start - 1]
+                transaction_index = self.transaction_index.truncated(start - 1)
+                for block in blocks:
+                    transaction_index.add_block(block)
+                self.load_chain(kept + list(blocks), kept_hashes + list(block_hashes), transaction_index)
+            else:
+                self.append_blocks(blocks, block_hashes)
+            for listener in self.listeners:
+                listener('reorganized', start, blocks, block_hashes)
+            return dropped
+
+    def headers(self, start=1, limit=None):
+        """
+        Packed headers of blocks start..start+limit-1, concatenated. Peers hash
+        and link them without downloading the transactions.
+        """
+        with self.lock:
+            blocks = self.chain[start - 1:None if limit is None else start - 1 + limit]
+        return b''.join(header_bytes(block) for block in blocks)
+
     def new_transaction(self, transaction_type, data):
         """
         Creates a new transaction to go into the next mined Block.
@@ -28,23 +209,183 @@ class Blockchain:
         :param transaction_type: <str> Type of the transaction (e.g., 'DID_REGISTRATION', 'VC_ISSUANCE', 'VC_REVOCATION')
         :param data: <dict> Data related to the transaction
         """
-        self.current_transactions.append({
-            'type': transaction_type,
-            'data': data,
-        })
-        return self.last_block['index'] + 1
+        with self.lock:
+            self.current_transactions.append({
+                'type': transaction_type,
+                'data': data,
+            })
+            if self._pending_since is None:
+                self._pending_since = time()
+                self._seal_condition.notify()
+            elif len(self.current_transactions) >= self.max_block_transactions:
+                self._seal_condition.notify()
+            return self.last_block['index'] + 1
+
+    def submit_transaction(self, transaction_type, data):
+        """
+        Adds a transaction to the mempool and returns a Future that resolves to
+        the block it was sealed in.
+        """
+        receipt = Future()
+        with self.lock:
+            self.new_transaction(transaction_type, data)
+            self._receipts.append(receipt)
+        return receipt
+
+    def submit_transactions(self, transaction_type, items):
+        """
+        Adds the transactions to the mempool together and asks for the block
+        to be sealed right away, so they all end up in the same block. Returns
+        a Future that resolves to that block.
+        """
+        return self.submit_batch((transaction_type, data) for data in items)
+
+    def submit_batch(self, transactions):
+        """
+        Like submit_transactions, for (transaction_type, data) pairs of
+        different types.
+        """
+        receipt = Future()
+        with self.lock:
+            for transaction_type, data in transactions:
+                self.new_transaction(transaction_type, data)
+            self._receipts.append(receipt)
+            if self._sealer is None:
+                self.new_block()
+            else:
+                self._seal_requested = True
+                self._seal_condition.notify()
+        return receipt
+
+    def add_did(self, did, name, did_type=None):
+        with self.lock:
+            self.did_registry.register(did, name, did_type)
+            did_type = self.did_registry.get_did_type(did)
+            for listener in self.listeners:
+                listener('did', did, name, did_type)
+            return self.submit_transaction('DID_REGISTRATION', {'did': did, 'name': name, 'type': did_type})
+
+    @property
+    def dids(self):
+        return [{'did': record['did'], 'name': record['name']} for record in self.did_registry.records()]
+
+    def start_sealer(self):
+        """
+        Starts a background thread that seals the mempool into a block once it
+        holds max_block_transactions or its oldest transaction is
+        max_block_latency seconds old. Proofs are searched on that thread
+        without holding the chain lock, so requests are never blocked by mining.
+        """
+        with self.lock:
+            if self._sealer is not None:
+                return
+            self._stopping = False
+            self._sealer = threading.Thread(target=self._seal_loop, name='block-sealer', daemon=True)
+            self._sealer.start()
+
+    def stop_sealer(self, flush=True):
+        with self._seal_condition:
+            sealer = self._sealer
+            self._stopping = True
+            self._seal_condition.notify()
+        if sealer is not None:
+            sealer.join()
+        with self.lock:
+            self._sealer = None
+            if flush and self.current_transactions:
+                self.new_block()
+
+    def _seal_loop(self):
+        while True:
+            with self._seal_condition:
+                if self._stopping:
+                    return
+                if not self.current_transactions:
+                    self._seal_condition.wait()
+                    continue
+                remaining = self._pending_since + self.max_block_latency - time()
+                if len(self.current_transactions) < self.max_block_transactions and remaining > 0 \
+                        and not self._seal_requested:
+                    self._seal_condition.wait(remaining)
+                    continue
+                transactions, receipts = self._take_mempool()
+                template = self._block_template(transactions)
+            try:
+                # New transactions keep going into the next block while this one is mined
+                while self._seal(transactions, receipts, template, self.consensus.seal(header_prefix(template))) is None:
+                    # The tip moved while mining, e.g. a block from a peer or another worker;
+                    # mine the transactions again on top of it, still off the lock
+                    metrics.inc('ssi_block_templates_stale_total', help_text="Mined block templates dropped because the tip moved")
+                    with self.lock:
+                        template = self._block_template(transactions)
+            except Exception as e:
+                # The sealer keeps running for the next block; callers waiting
+                # on this one get the error instead of hanging
+                logger.exception("Sealing a block of %d transactions failed", len(transactions))
+                metrics.inc('ssi_block_seal_failures_total', help_text="Blocks that failed to seal")
+                self._fail_receipts(receipts, e)
 
-    def add_did(self, did, name):
-        self.dids.append({
-            'did': did,
-            'name': name,
-        })
-        self.new_transaction('DID_REGISTRATION', {'did': did, 'name': name})
+    def inclusion_proofs(self, credential_id):
+        """
+        Returns a Merkle inclusion proof for every transaction that references
+        the credential, together with the header it is anchored in.
+        """
+        chain, block_hashes, transaction_index = self.view()
+        locations = transaction_index.locations(credential_id)
+        proofs = []
+        for block_index, position in locations:
+            block = chain[block_index - 1]
+            proofs.append({
+                'block_index': block_index,
+                'position': position,
+                'transaction': block['transactions'][position],
+                'header': block_header(block),
+                'header_hash': block_hashes[block_index - 1],
+                'proof': merkle_proof(block['transactions'], position),
+            })
+        return proofs
+
+    def find_transactions(self, did=None, credential_id=None, transaction_type=None, role=None, cursor=0, limit=100):
+        """
+        Looks transactions up through the secondary indexes, so the cost grows
+        with the size of the smallest matching posting list rather than with
+        the chain length.
+
+        :param role: <str> Transaction data field the DID must appear in (e.g., 'subject_did')
+        :param cursor: <int> Packed location of the last transaction examined for the previous page
+        :return: <tuple> (list of matching transactions, cursor for the next page or None)
+        """
+        chain, _, transaction_index = self.view()
+        postings = transaction_index.lookup(did, credential_id, transaction_type)
+        if postings is None:
+            raise ValueError("At least one of did, credential_id or transaction_type is required")
+        results = []
+        # Posting lists are in chain order, so a location is a cursor that stays
+        # valid whichever list happens to be the smallest on the next call
+        position_in_postings = bisect.bisect_right(postings, cursor)
+        location = cursor
+        while position_in_postings < len(postings) and len(results) < limit:
+            location = postings[position_in_postings]
+            block_index, position = split_location(location)
+            position_in_postings += 1
+            block = chain[block_index - 1]
+            transaction = block['transactions'][position]
+            if matches(transaction, did, credential_id, transaction_type, role):
+                results.append({
+                    'block_index': block_index,
+                    'position': position,
+                    'timestamp': block['timestamp'],
+                    **transaction,
+                })
+        next_cursor = location if position_in_postings < len(postings) else None
+        return results, next_cursor
 
     @staticmethod
     def hash(block):
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        if 'merkle_root' not in block:
+            block = {**block, 'merkle_root': merkle_root(block['transactions'])}
+        with metrics.timer('ssi_block_hash_seconds', "Time spent hashing block headers"):
+            return hashlib.sha256(header_bytes(block)).hexdigest()
 
     @property
     def last_block(self):
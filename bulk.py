@@ -0,0 +1,398 @@
+"""
+Streaming bulk import and export of DIDs, credentials, revocations and
+presentations as newline-delimited JSON, one record per line in the same
+format as the storage snapshots, e.g.
+
+    {"kind":"did","did":"...","name":"...","type":"holder"}
+    {"kind":"credential","credential_id":"...","record":{"credential":{...},"signature":{"$bytes":"..."},...}}
+    {"kind":"credential","credential_id":"...","issuer_did":"...","subject_did":"...","claims":{...}}
+    {"kind":"revocation","credential_id":"..."}
+    {"kind":"presentation","credential_id":"...","verifier_did":"..."}
+
+Credentials come either as records signed elsewhere (as exported), whose
+signatures are checked against the issuer's key in the local keystore, or as
+claims that are issued and signed with that key. Signed records of an issuer
+must come in increasing status list index order, so no index is handed out
+twice.
+
+    python bulk.py export -o state.ndjson
+    python bulk.py import state.ndjson --checkpoint state.ndjson.checkpoint
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from canonical import canonicalize
+from keystore import RSA, key_fingerprint, verify
+from statuslist import MAX_INDEX
+from storage import decode_record, encode_record
+from txindex import split_location
+
+KINDS = ('did', 'credential', 'revocation', 'presentation')
+DID_TYPES = (None, 'issuer', 'holder', 'verifier')
+MAX_REPORTED_ERRORS = 100  # Per batch report
+
+
+def export_records(blockchain, vc_manager, kinds=KINDS, chunk_size=1000):
+    """
+    Yields the state as encoded NDJSON lines, reading the registries in
+    chunks instead of copying them.
+    """
+    if 'did' in kinds:
+        for record in blockchain.did_registry.records(chunk_size=chunk_size):
+            yield encode_record({'kind': 'did', **record})
+    if 'credential' in kinds:
+        for credential_id, record in vc_manager.credentials.records(chunk_size=chunk_size):
+            yield encode_record({'kind': 'credential', 'credential_id': credential_id, 'record': record})
+    if 'revocation' in kinds:
+        for credential_id in list(vc_manager.revoked_credentials):
+            yield encode_record({'kind': 'revocation', 'credential_id': credential_id})
+    if 'presentation' in kinds:
+        for credential_id, verifier_did in vc_manager.presentations.items():
+            yield encode_record({'kind': 'presentation', 'credential_id': credential_id, 'verifier_did': verifier_did})
+
+
+class RecordError(ValueError):
+    pass
+
+
+def _require(record, *fields):
+    for field in fields:
+        if not isinstance(record.get(field), str) or not record[field]:
+            raise RecordError(f"Missing or invalid {field}")
+
+
+def _signed_credential(entry):
+    """
+    Checks the fields of a signed credential record before anything is
+    stored. Returns (issuer_did, subject_did, status_index or None).
+    """
+    for field in ('credential', 'signature', 'public_key'):
+        if field not in entry:
+            raise RecordError(f"Missing {field} in credential record")
+    if not isinstance(entry['signature'], bytes) or not isinstance(entry['public_key'], str):
+        raise RecordError("signature must be bytes and public_key a PEM string")
+    if not isinstance(entry.get('signed_bytes'), (bytes, type(None))):
+        raise RecordError("signed_bytes must be bytes")
+    credential = entry['credential']
+    try:
+        issuer_did = credential['issuer']
+        subject_did = credential['credentialSubject']['id']
+        status = credential.get('credentialStatus')
+        status_index = int(status['statusListIndex']) if status is not None else None
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise RecordError(f"Malformed credential: {e!r}") from e
+    if not isinstance(issuer_did, str) or not isinstance(subject_did, str):
+        raise RecordError("Malformed credential: issuer and subject id must be strings")
+    if status_index is not None and not 0 <= status_index <= MAX_INDEX:
+        raise RecordError(f"statusListIndex must be between 0 and {MAX_INDEX}")
+    return issuer_did, subject_did, status_index
+
+
+class Importer:
+    """
+    Loads NDJSON records in batches of batch_size lines. Each batch is
+    validated, applied and anchored in a single block, and the importer waits
+    for that block before reading the next batch, so memory stays bounded by
+    the batch size. After each batch it reports the number of input lines
+    committed so far; passing that number back as skip resumes the import.
+
+    Records already present are not applied again, and only anchored if no
+    block records them yet, so replaying the lines of an interrupted batch is
+    safe.
+    """
+
+    def __init__(self, blockchain, vc_manager, batch_size=5000, verify_signatures=True, workers=None):
+        self.blockchain = blockchain
+        self.vc_manager = vc_manager
+        self.batch_size = batch_size
+        self.verify_signatures = verify_signatures
+        self.workers = workers or os.cpu_count() or 1
+
+    def run(self, lines, skip=0):
+        """
+        :param lines: <iterable> NDJSON lines, as str or bytes
+        :param skip: <int> Leading lines to skip, e.g. the committed count of an interrupted run
+        :return: <generator> One report per batch
+        """
+        batch = []
+        line_number = 0
+        for line in lines:
+            line_number += 1
+            if line_number <= skip:
+                continue
+            batch.append((line_number, line))
+            if len(batch) == self.batch_size:
+                yield self._import_batch(batch)
+                batch = []
+        if batch:
+            yield self._import_batch(batch)
+
+    def _import_batch(self, batch):
+        counts = dict.fromkeys(KINDS, 0)
+        counts['skipped'] = 0
+        errors = []
+        records = []
+        for line_number, line in batch:
+            if not line.strip():
+                continue
+            try:
+                record = decode_record(line)
+                if not isinstance(record, dict) or record.get('kind') not in KINDS:
+                    raise RecordError(f"kind must be one of {', '.join(KINDS)}")
+                records.append((line_number, record))
+            except ValueError as e:
+                errors.append((line_number, str(e)))
+
+        # Signatures and claims are the expensive part, so they are handled for the whole batch up front
+        rejected = self._check_signatures(records) if self.verify_signatures else {}
+        issued = self._issue_claims(records, rejected)
+
+        # Revocations and presentations can refer to credentials earlier in the same batch
+        transactions = []
+        applied_ids = set()  # _anchored only sees sealed blocks, so repeats within the batch are caught here
+        for line_number, record in records:
+            if line_number in rejected:
+                errors.append((line_number, rejected[line_number]))
+                continue
+            key = self._batch_key(record)
+            if key in applied_ids:
+                errors.append((line_number, f"{key[1]} already appears earlier in this batch"))
+                continue
+            try:
+                applied, transaction = getattr(self, '_apply_' + record['kind'])(record, issued)
+            except RecordError as e:
+                errors.append((line_number, str(e)))
+                continue
+            if key is not None:
+                applied_ids.add(key)
+            counts[record['kind'] if applied else 'skipped'] += 1
+            if transaction is not None:
+                transactions.append(transaction)
+        errors.sort()
+        block = self.blockchain.submit_batch(transactions) if transactions else None
+        return {
+            "line": batch[-1][0],
+            "block_index": block.result()['index'] if block is not None else None,
+            "anchored": len(transactions),
+            **counts,
+            "errors": len(errors),
+            "error_lines": [{"line": line_number, "error": error} for line_number, error in errors[:MAX_REPORTED_ERRORS]],
+        }
+
+    @staticmethod
+    def _batch_key(record):
+        # Presentations are not anchored, so repeating one is harmless
+        if record['kind'] == 'presentation':
+            return None
+        ref = record.get('did' if record['kind'] == 'did' else 'credential_id')
+        return (record['kind'], ref) if isinstance(ref, str) else None
+
+    def _anchored(self, transaction_type, credential_id=None, did=None):
+        chain, _, transaction_index = self.blockchain.view()
+        postings = transaction_index.lookup(did=did, credential_id=credential_id)
+        for location in postings:
+            block_index, position = split_location(location)
+            transaction = chain[block_index - 1]['transactions'][position]
+            if transaction['type'] == transaction_type and (
+                    did is None or transaction['data'].get('did') == did):
+                return True
+        return False
+
+    def _check_signatures(self, records):
+        """
+        Verifies the signed credential records of a batch in parallel.
+        Returns {line_number: error} for the ones that fail.
+        """
+        signed = [(line_number, record['record']) for line_number, record in records
+                  if record['kind'] == 'credential' and isinstance(record.get('record'), dict)
+                  and record.get('credential_id') not in self.vc_manager.credentials]
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = pool.map(self._signature_error, [entry for _, entry in signed])
+            return {line_number: error for (line_number, _), error in zip(signed, results) if error is not None}
+
+    def _signature_error(self, entry):
+        try:
+            issuer_did, _, _ = _signed_credential(entry)
+        except RecordError as e:
+            return str(e)
+        credential, signature, signed_bytes = entry['credential'], entry['signature'], entry.get('signed_bytes')
+        try:
+            if signed_bytes is not None and signed_bytes != canonicalize(credential):
+                return "signed_bytes do not match the credential"
+            fingerprint = key_fingerprint(entry['public_key'])
+            if entry.get('key_fingerprint') not in (None, fingerprint):
+                return "key_fingerprint does not match public_key"
+            # The embedded key is chosen by whoever wrote the record, so it must be one of the issuer's own
+            public_key_pem = self._issuer_key(issuer_did, entry.get('key_id'), fingerprint)
+            if public_key_pem is None:
+                return f"public_key is not a key of issuer {issuer_did}"
+            data = signed_bytes if signed_bytes is not None else json.dumps(credential).encode('utf-8')
+            verify(self.vc_manager.public_keys.load(public_key_pem, fingerprint), entry.get('algorithm') or RSA,
+                   signature, data)
+        except Exception as e:
+            return f"Invalid signature: {e!r}"
+        return None
+
+    def _issuer_key(self, issuer_did, key_id, fingerprint):
+        """
+        Returns the PEM of the issuer's keystore key with the given
+        fingerprint, current or rotated out, or None if it has none.
+        """
+        keystore = self.vc_manager.keystore
+        key_ids = [key_id] if key_id is not None else [key['key_id'] for key in keystore.list_keys(issuer_did)]
+        for candidate in key_ids:
+            if keystore.get_key_fingerprint(issuer_did, candidate) == fingerprint:
+                return keystore.get_public_key_pem(issuer_did, candidate)
+        return None
+
+    def _issue_claims(self, records, rejected):
+        """
+        Issues the claims records of a batch, signing each issuer's share in
+        parallel. Returns the credential_ids issued and adds the invalid
+        records to rejected.
+        """
+        by_issuer = {}
+        for line_number, record in records:
+            if record['kind'] != 'credential' or 'claims' not in record:
+                continue
+            try:
+                _require(record, 'credential_id', 'issuer_did', 'subject_did')
+                if not isinstance(record['claims'], dict):
+                    raise RecordError("claims must be an object")
+                if not self.vc_manager.keystore.has_key(record['issuer_did']):
+                    raise RecordError(f"No signing key for issuer {record['issuer_did']}")
+            except RecordError as e:
+                rejected[line_number] = str(e)
+                continue
+            if record['credential_id'] not in self.vc_manager.credentials:
+                by_issuer.setdefault(record['issuer_did'], []).append(
+                    (record['subject_did'], record['claims'], record['credential_id']))
+        issued = set()
+        for issuer_did, entries in by_issuer.items():
+            entries = list({entry[2]: entry for entry in entries}.values())  # Ids repeated within the batch are issued once
+            for credential in self.vc_manager.create_credentials(issuer_did, entries, max_workers=self.workers):
+                issued.add(credential['credential_id'])
+        return issued
+
+    def _apply_did(self, record, issued):
+        _require(record, 'did', 'name')
+        did, name, did_type = record['did'], record['name'], record.get('type')
+        if did_type not in DID_TYPES:
+            raise RecordError(f"Unsupported DID type: {did_type}")
+        registry = self.blockchain.did_registry
+        transaction = ('DID_REGISTRATION', {'did': did, 'name': name, 'type': did_type})
+        if did in registry and registry.get_did_document(did) == {'name': name, 'type': did_type}:
+            return False, None if self._anchored('DID_REGISTRATION', did=did) else transaction
+        registry.register(did, name, did_type)
+        for listener in self.blockchain.listeners:
+            listener('did', did, name, did_type)
+        return True, transaction
+
+    def _apply_credential(self, record, issued):
+        _require(record, 'credential_id')
+        credential_id = record['credential_id']
+        existing = self.vc_manager.credentials.get(credential_id)
+        if existing is None:
+            entry = record.get('record')
+            if not isinstance(entry, dict):
+                raise RecordError("Credential needs a signed record or claims")
+            issuer_did, _, status_index = _signed_credential(entry)
+            if status_index is not None and not self.vc_manager.status_lists.claim(issuer_did, status_index):
+                raise RecordError(f"Status list index {status_index} of {issuer_did} is already in use")
+            existing = self.vc_manager.import_credential(credential_id, entry)
+        elif credential_id not in issued:
+            transaction = None if self._anchored('VC_ISSUANCE', credential_id) else self._issuance(credential_id, existing)
+            return False, transaction
+        return True, self._issuance(credential_id, existing)
+
+    @staticmethod
+    def _issuance(credential_id, record):
+        return 'VC_ISSUANCE', {'issuer_did': record.issuer, 'subject_did': record.subject, 'credential_id': credential_id}
+
+    def _apply_revocation(self, record, issued):
+        _require(record, 'credential_id')
+        credential_id = record['credential_id']
+        credential = self.vc_manager.credentials.get(credential_id)
+        if credential is None:
+            raise RecordError(f"Unknown credential {credential_id}")
+        transaction = ('VC_REVOCATION', {'issuer_did': credential.issuer, 'credential_id': credential_id})
+        if not self.vc_manager.revoke_credential(credential_id):
+            return False, None if self._anchored('VC_REVOCATION', credential_id) else transaction
+        return True, transaction
+
+    def _apply_presentation(self, record, issued):
+        _require(record, 'credential_id', 'verifier_did')
+        if record['credential_id'] not in self.vc_manager.credentials:
+            raise RecordError(f"Unknown credential {record['credential_id']}")
+        return self.vc_manager.present_credential(record['credential_id'], record['verifier_did']), None
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)['line']
+    except FileNotFoundError:
+        return 0
+
+
+def _write_checkpoint(path, line):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'line': line}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import and export of the node's DIDs and credentials.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help="Write the state as NDJSON")
+    export_parser.add_argument('-o', '--output', help="Output file (default: stdout)")
+    export_parser.add_argument('--kinds', default=','.join(KINDS), help="Comma-separated record kinds to export")
+    import_parser = commands.add_parser('import', help="Load NDJSON records")
+    import_parser.add_argument('input', help="Input file, or - for stdin")
+    import_parser.add_argument('--batch-size', type=int, default=5000, help="Records per anchoring block")
+    import_parser.add_argument('--checkpoint', help="Resume from and record progress in this file")
+    import_parser.add_argument('--skip', type=int, default=0, help="Lines to skip, if no checkpoint is used")
+    import_parser.add_argument('--no-signatures', action='store_true', help="Skip checking signed credential records, for trusted input only")
+    import_parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    # Works on the state configured for the node, as app.py would load it
+    from utils import blockchain, vc_manager
+
+    if args.command == 'export':
+        kinds = [kind for kind in args.kinds.split(',') if kind]
+        unknown = set(kinds) - set(KINDS)
+        if unknown:
+            parser.error(f"Unknown kinds: {', '.join(sorted(unknown))}")
+        output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+        try:
+            for line in export_records(blockchain, vc_manager, kinds):
+                output.write(line)
+        finally:
+            if args.output:
+                output.close()
+        return 0
+
+    skip = _read_checkpoint(args.checkpoint) if args.checkpoint else args.skip
+    importer = Importer(blockchain, vc_manager, args.batch_size, not args.no_signatures, args.workers)
+    source = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+    errors = 0
+    try:
+        for report in importer.run(source, skip):
+            if args.checkpoint:
+                _write_checkpoint(args.checkpoint, report['line'])
+            errors += report['errors']
+            print(json.dumps(report), flush=True)
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
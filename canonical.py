@@ -0,0 +1,20 @@
+import json
+
+# JCS-style (RFC 8785) canonical form: sorted keys, no insignificant whitespace,
+# UTF-8 output and no NaN/Infinity. Building the encoder once keeps the C
+# accelerated path and skips the per-call setup json.dumps does for
+# non-default options.
+_encoder = json.JSONEncoder(
+    sort_keys=True,
+    separators=(',', ':'),
+    ensure_ascii=False,
+    allow_nan=False,
+)
+
+
+def canonicalize(obj):
+    """
+    Returns the canonical UTF-8 bytes of a JSON-compatible object. These are
+    the exact bytes that get signed and verified.
+    """
+    return _encoder.encode(obj).encode('utf-8')
@@ -0,0 +1,196 @@
+"""
+Block sealing strategies. Blockchain asks its consensus for the proof of a
+block header; the header must not change while the proof is searched.
+"""
+import hashlib
+import multiprocessing
+import os
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from time import perf_counter
+from metrics import registry as metrics
+
+AUTHORITY = 'authority'
+PROOF_OF_WORK = 'pow'
+
+_pack_proof = struct.Struct('>Q').pack
+MAX_PROOF = 2 ** 64 - 1
+
+
+def target_for(difficulty):
+    """
+    Header hashes below the target, as 32 big-endian bytes, satisfy the
+    difficulty (the number of leading zero bits required).
+    """
+    return (1 << (256 - difficulty)).to_bytes(32, 'big')
+
+
+def meets_difficulty(block_hash, difficulty):
+    return not difficulty or bytes.fromhex(block_hash) < target_for(difficulty)
+
+
+def search_nonces(prefix, target, start, count):
+    """
+    Tries proofs start..start+count-1 for a header whose first 80 bytes are
+    prefix. The SHA-256 state of the prefix is computed once and copied per
+    attempt. Returns (proof or None, number of hashes computed).
+    """
+    midstate = hashlib.sha256(prefix)
+    for proof in range(start, min(start + count, MAX_PROOF + 1)):
+        attempt = midstate.copy()
+        attempt.update(_pack_proof(proof))
+        if attempt.digest() < target:
+            return proof, proof - start + 1
+    return None, count
+
+
+def _warm_up(_):
+    return os.getpid()
+
+
+class Authority:
+    """
+    No-op consensus for trusted deployments: blocks are sealed immediately
+    with a fixed proof and every header is accepted, so chains are only taken
+    from peers the operator configured, starting at the pinned genesis block.
+    """
+
+    name = AUTHORITY
+    difficulty = 0
+
+    def seal(self, prefix):
+        return 0
+
+    def verify(self, block_hash):
+        return True
+
+    def start(self):
+        pass
+
+    def stats(self):
+        return {"algorithm": self.name}
+
+    def shutdown(self):
+        pass
+
+
+class ProofOfWork:
+    """
+    Searches for a proof that puts the header hash below 2**(256 - difficulty).
+    Nonce ranges of chunk_size are handed to a process pool, with at most two
+    ranges per worker in flight, until one of them finds a proof.
+    """
+
+    name = PROOF_OF_WORK
+
+    def __init__(self, difficulty=16, workers=None, chunk_size=1 << 16):
+        if not 1 <= difficulty <= 255:
+            raise ValueError("difficulty must be between 1 and 255 bits")
+        self.difficulty = difficulty
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.target = target_for(difficulty)
+        self.blocks_mined = 0
+        self.hashes = 0
+        self.mining_seconds = 0.0
+        self.last_hash_rate = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the worker processes. Call it before the application starts
+        its own threads, so the workers are forked from a single-threaded
+        process.
+        """
+        if self.workers > 1 and self._pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=context)
+            list(self._pool.map(_warm_up, range(self.workers)))
+
+    def seal(self, prefix):
+        """
+        :param prefix: <bytes> First 80 bytes of the packed header, everything but the proof
+        :return: <int> Proof
+        """
+        with self._lock:  # One search at a time; concurrent searches would only compete for the workers
+            began = perf_counter()
+            if self.workers > 1:
+                self.start()
+                proof, hashes = self._search_parallel(prefix)
+            else:
+                proof, hashes = self._search_serial(prefix)
+            elapsed = perf_counter() - began
+        with self._stats_lock:
+            self.blocks_mined += 1
+            self.hashes += hashes
+            self.mining_seconds += elapsed
+            self.last_hash_rate = hashes / elapsed if elapsed else None
+        metrics.inc('ssi_pow_hashes_total', hashes, help_text="Header hashes computed while mining")
+        metrics.histogram('ssi_pow_mining_seconds', "Time spent mining blocks").observe(elapsed)
+        return proof
+
+    def _search_serial(self, prefix):
+        hashes = 0
+        for start in range(0, MAX_PROOF + 1, self.chunk_size):
+            proof, tried = search_nonces(prefix, self.target, start, self.chunk_size)
+            hashes += tried
+            if proof is not None:
+                return proof, hashes
+        raise RuntimeError("Proof space exhausted")
+
+    def _search_parallel(self, prefix):
+        starts = iter(range(0, MAX_PROOF + 1, self.chunk_size))
+        pending = set()
+        hashes = 0
+        found = None
+        try:
+            while found is None:
+                while len(pending) < self.workers * 2:
+                    start = next(starts, None)
+                    if start is None:
+                        break
+                    pending.add(self._pool.submit(search_nonces, prefix, self.target, start, self.chunk_size))
+                if not pending:
+                    raise RuntimeError("Proof space exhausted")
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    proof, tried = future.result()
+                    hashes += tried
+                    if proof is not None and (found is None or proof < found):
+                        found = proof
+        finally:
+            for future in pending:
+                future.cancel()
+        return found, hashes
+
+    def verify(self, block_hash):
+        return bytes.fromhex(block_hash) < self.target
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "algorithm": self.name,
+                "difficulty": self.difficulty,
+                "workers": self.workers,
+                "blocks_mined": self.blocks_mined,
+                "hashes": self.hashes,
+                "last_hash_rate": self.last_hash_rate,
+                "hash_rate": self.hashes / self.mining_seconds if self.mining_seconds else None,
+            }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+
+def create_consensus(name=AUTHORITY, difficulty=16, workers=None):
+    if name == AUTHORITY:
+        return Authority()
+    if name == PROOF_OF_WORK:
+        return ProofOfWork(difficulty, workers)
+    raise ValueError(f"Unsupported consensus: {name}")
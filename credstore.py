@@ -0,0 +1,242 @@
+import json
+import sys
+import threading
+from collections.abc import Mapping, MutableMapping
+
+RECORD_FIELDS = ('credential', 'signed_bytes', 'signature', 'public_key', 'algorithm', 'key_id', 'key_fingerprint')
+
+
+class KeyTable:
+    """
+    Issuer public keys shared by every credential they signed. Records hold
+    a small integer reference instead of their own copy of the PEM.
+    """
+
+    def __init__(self):
+        self._keys = []  # ref -> (public_key_pem, algorithm, key_id, key_fingerprint)
+        self._refs = {}  # (public_key_pem, algorithm, key_id, key_fingerprint) -> ref
+        self._lock = threading.Lock()
+
+    def intern(self, public_key_pem, algorithm, key_id, key_fingerprint):
+        key = (public_key_pem, algorithm, key_id, key_fingerprint)
+        ref = self._refs.get(key)
+        if ref is not None:
+            return ref
+        with self._lock:
+            ref = self._refs.get(key)
+            if ref is None:
+                ref = self._refs[key] = len(self._keys)
+                self._keys.append(key)
+            return ref
+
+    def get(self, ref):
+        return self._keys[ref]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getstate__(self):
+        return self._keys
+
+    def __setstate__(self, keys):
+        self._keys = keys
+        self._refs = {key: ref for ref, key in enumerate(keys)}
+        self._lock = threading.Lock()
+
+    def nbytes(self):
+        return sys.getsizeof(self._keys) + sys.getsizeof(self._refs) + sum(
+            sys.getsizeof(key) + sum(sys.getsizeof(value) for value in key if value is not None)
+            for key in self._keys
+        )
+
+
+class CredentialRecord(Mapping):
+    """
+    Compact credential record. The credential is kept only as the bytes that
+    were signed and decoded on access, the issuer key is a KeyTable
+    reference, and issuer and subject DIDs are interned. Reads like the dict
+    records it replaces, e.g. record['credential']['issuer'].
+    """
+
+    __slots__ = ('issuer', 'subject', 'status_index', 'encoded', 'canonical', 'signature', 'key_ref', 'key_table')
+
+    def __init__(self, issuer, subject, status_index, encoded, canonical, signature, key_ref, key_table):
+        self.issuer = issuer
+        self.subject = subject
+        self.status_index = status_index  # Index in the issuer's status list, or -1
+        self.encoded = encoded  # Serialized credential
+        self.canonical = canonical  # False for records signed over plain json.dumps output
+        self.signature = signature
+        self.key_ref = key_ref
+        self.key_table = key_table
+
+    @property
+    def credential(self):
+        return json.loads(self.encoded)
+
+    @property
+    def signed_bytes(self):
+        return self.encoded if self.canonical else None
+
+    def as_dict(self, credential_id, credential=None):
+        """
+        The record as a plain dict, as returned to clients. Pass the decoded
+        credential if the caller already has it.
+        """
+        public_key, algorithm, key_id, key_fingerprint = self.key_table.get(self.key_ref)
+        return {
+            "credential_id": credential_id,
+            "credential": credential if credential is not None else self.credential,
+            "signed_bytes": self.signed_bytes,
+            "signature": self.signature,
+            "public_key": public_key,
+            "algorithm": algorithm,
+            "key_id": key_id,
+            "key_fingerprint": key_fingerprint,
+        }
+
+    def __getitem__(self, field):
+        if field == 'credential':
+            return self.credential
+        if field == 'signed_bytes':
+            return self.signed_bytes
+        if field == 'signature':
+            return self.signature
+        public_key, algorithm, key_id, key_fingerprint = self.key_table.get(self.key_ref)
+        if field == 'public_key':
+            return public_key
+        if field == 'algorithm':
+            return algorithm
+        if field == 'key_id':
+            return key_id
+        if field == 'key_fingerprint':
+            return key_fingerprint
+        raise KeyError(field)
+
+    def __iter__(self):
+        return iter(RECORD_FIELDS)
+
+    def __len__(self):
+        return len(RECORD_FIELDS)
+
+    def nbytes(self):
+        """
+        Bytes held by this record alone; the shared key and interned DIDs are
+        accounted for by the store.
+        """
+        return sys.getsizeof(self) + sys.getsizeof(self.encoded) + sys.getsizeof(self.signature)
+
+
+class CredentialStore(MutableMapping):
+    """
+    credential_id -> CredentialRecord. Plain dict records assigned to the
+    store (e.g. when restoring persisted state) are converted on the way in.
+    """
+
+    def __init__(self):
+        self._records = {}
+        self._order = []  # credential_ids in insertion order, for paging through the store
+        self.key_table = KeyTable()
+
+    def add(self, credential_id, credential, signed_bytes, signature, public_key, algorithm, key_id, key_fingerprint):
+        status = credential.get('credentialStatus')
+        canonical = signed_bytes is not None
+        record = CredentialRecord(
+            sys.intern(credential['issuer']),
+            sys.intern(credential['credentialSubject']['id']),
+            int(status['statusListIndex']) if status is not None else -1,
+            signed_bytes if canonical else json.dumps(credential).encode('utf-8'),
+            canonical,
+            signature,
+            self.key_table.intern(public_key, algorithm, key_id, key_fingerprint),
+            self.key_table,
+        )
+        self._put(credential_id, record)
+        return record
+
+    def _put(self, credential_id, record):
+        if credential_id not in self._records:
+            self._order.append(credential_id)
+        self._records[credential_id] = record
+
+    def __setitem__(self, credential_id, record):
+        if isinstance(record, CredentialRecord) and record.key_table is self.key_table:
+            self._put(credential_id, record)
+            return
+        self.add(
+            credential_id,
+            record['credential'],
+            record.get('signed_bytes'),
+            record['signature'],
+            record['public_key'],
+            record.get('algorithm', 'RSA'),
+            record.get('key_id'),
+            record.get('key_fingerprint'),
+        )
+
+    def __getitem__(self, credential_id):
+        return self._records[credential_id]
+
+    def get(self, credential_id, default=None):
+        return self._records.get(credential_id, default)
+
+    def __contains__(self, credential_id):
+        return credential_id in self._records
+
+    def __delitem__(self, credential_id):
+        del self._records[credential_id]
+        self._order.remove(credential_id)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def items(self):
+        return self._records.items()
+
+    def records(self, start=0, chunk_size=1000):
+        """
+        Yields (credential_id, record) in insertion order from position start.
+        The store is read in chunks, so it can be streamed while credentials
+        are still being added.
+        """
+        position = start
+        while True:
+            credential_ids = self._order[position:position + chunk_size]
+            if not credential_ids:
+                return
+            for credential_id in credential_ids:
+                yield credential_id, self._records[credential_id]
+            position += len(credential_ids)
+
+    def memory_report(self):
+        """
+        Approximate memory held by the store, for sizing nodes.
+        """
+        records = list(self._records.items())
+        record_bytes = 0
+        id_bytes = 0
+        dids = {}
+        for credential_id, record in records:
+            record_bytes += record.nbytes()
+            id_bytes += sys.getsizeof(credential_id)
+            dids[id(record.issuer)] = record.issuer
+            dids[id(record.subject)] = record.subject
+        did_bytes = sum(sys.getsizeof(did) for did in dids.values())
+        key_bytes = self.key_table.nbytes()
+        index_bytes = sys.getsizeof(self._records) + sys.getsizeof(self._order)
+        total = record_bytes + id_bytes + did_bytes + key_bytes + index_bytes
+        return {
+            "credentials": len(records),
+            "keys": len(self.key_table),
+            "distinct_dids": len(dids),
+            "record_bytes": record_bytes,
+            "credential_id_bytes": id_bytes,
+            "did_bytes": did_bytes,
+            "key_table_bytes": key_bytes,
+            "index_bytes": index_bytes,
+            "total_bytes": total,
+            "bytes_per_credential": total / len(records) if records else 0,
+        }
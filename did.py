@@ -1,27 +1,178 @@
+import threading
 import uuid
+from collections import OrderedDict
+from time import monotonic
+
+class DIDResolver:
+    """
+    LRU cache of resolved DID documents. Entries expire after ttl seconds and
+    are dropped as soon as the registry changes the DID.
+    """
+
+    def __init__(self, registry, maxsize=100000, ttl=300):
+        self.registry = registry
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._documents = OrderedDict()  # did -> (expires_at, document)
+        self._lock = threading.Lock()
+
+    def resolve(self, did):
+        now = monotonic()
+        with self._lock:
+            cached = self._documents.get(did)
+            if cached is not None and cached[0] > now:
+                self._documents.move_to_end(did)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        document = self.registry.build_did_document(did)
+        if document is None:
+            return None
+        with self._lock:
+            self._documents[did] = (now + self.ttl, document)
+            self._documents.move_to_end(did)
+            while len(self._documents) > self.maxsize:
+                self._documents.popitem(last=False)
+        return document
+
+    def invalidate(self, did):
+        with self._lock:
+            self._documents.pop(did, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._documents), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
 
 class DID:
-    def __init__(self):
-        self.did_registry = {}
+    """
+    DID registry shared by every role.
+
+    Records are stored as compact (name, type) tuples keyed by DID, with hash
+    indexes by name and by type so lookups never scan the registry.
+    """
+
+    def __init__(self, cache_size=100000, cache_ttl=300):
+        self.did_registry = {}  # did -> (name, type)
+        self._order = []  # dids in registration order, for cursor pagination
+        self._by_name = {}  # name -> did, or a list of dids when the name is shared
+        self._by_type = {}  # type -> set of dids
+        self._lock = threading.RLock()
+        self.resolver = DIDResolver(self, cache_size, cache_ttl)
 
     def create_issuer_did(self, name):
-        did = f"{uuid.uuid4()}"
-        self.did_registry[did] = {"name": name, "type": "issuer"}
-        return did
+        return self.register(str(uuid.uuid4()), name, "issuer")
 
     def create_holder_did(self, name):
-        did = f"{uuid.uuid4()}"
-        self.did_registry[did] = {"name": name, "type": "holder"}
-        return did
-    
+        return self.register(str(uuid.uuid4()), name, "holder")
+
     def create_verifier_did(self, name):
-        did = f"{uuid.uuid4()}"
-        self.did_registry[did] = {"name": name, "type": "verifier"}  # Corrected type to 'verifier'
+        return self.register(str(uuid.uuid4()), name, "verifier")
+
+    def register(self, did, name, did_type=None):
+        """
+        Adds or updates a DID. Registering a known DID again without a type
+        keeps the type it already has.
+        """
+        with self._lock:
+            existing = self.did_registry.get(did)
+            if existing is not None:
+                if did_type is None:
+                    did_type = existing[1]
+                if existing == (name, did_type):
+                    return did
+                self._unindex(did, *existing)
+            else:
+                self._order.append(did)
+            self.did_registry[did] = (name, did_type)
+            self._index(did, name, did_type)
+        self.resolver.invalidate(did)
         return did
 
+    def _index(self, did, name, did_type):
+        dids = self._by_name.get(name)
+        if dids is None:
+            self._by_name[name] = did
+        elif isinstance(dids, list):
+            dids.append(did)
+        else:
+            self._by_name[name] = [dids, did]
+        self._by_type.setdefault(did_type, set()).add(did)
+
+    def _unindex(self, did, name, did_type):
+        dids = self._by_name.get(name)
+        if isinstance(dids, list):
+            dids.remove(did)
+            if len(dids) == 1:
+                self._by_name[name] = dids[0]
+        elif dids == did:
+            del self._by_name[name]
+        self._by_type.get(did_type, set()).discard(did)
+
     def get_did_document(self, did):
-        return self.did_registry.get(did, None)
+        record = self.did_registry.get(did)
+        if record is None:
+            return None
+        return {"name": record[0], "type": record[1]}
 
     def get_did_name(self, did):
-        did_doc = self.did_registry.get(did, None)
-        return did_doc.get("name") if did_doc else None
+        record = self.did_registry.get(did)
+        return record[0] if record else None
+
+    def get_did_type(self, did):
+        record = self.did_registry.get(did)
+        return record[1] if record else None
+
+    def resolve(self, did):
+        return self.resolver.resolve(did)
+
+    def build_did_document(self, did):
+        record = self.did_registry.get(did)
+        if record is None:
+            return None
+        return {
+            "@context": "https://www.w3.org/ns/did/v1",
+            "id": did,
+            "name": record[0],
+            "type": record[1],
+        }
+
+    def find_by_name(self, name, did_type=None):
+        with self._lock:
+            dids = self._by_name.get(name)
+            if dids is None:
+                return []
+            dids = list(dids) if isinstance(dids, list) else [dids]
+        if did_type is not None:
+            dids = [did for did in dids if self.did_registry[did][1] == did_type]
+        return dids
+
+    def find_by_type(self, did_type):
+        with self._lock:
+            return list(self._by_type.get(did_type, ()))
+
+    def records(self, start=0, stop=None, chunk_size=1000):
+        """
+        Yields {"did", "name", "type"} for DIDs in registration order, from
+        position start up to (not including) stop. The registry is read in
+        chunks so callers can stream it without copying it.
+        """
+        position = start
+        while True:
+            with self._lock:
+                end = len(self._order) if stop is None else min(stop, len(self._order))
+                dids = self._order[position:min(position + chunk_size, end)]
+            if not dids:
+                return
+            for did in dids:
+                name, did_type = self.did_registry[did]
+                yield {"did": did, "name": name, "type": did_type}
+            position += len(dids)
+
+    def __len__(self):
+        return len(self.did_registry)
+
+    def __contains__(self, did):
+        return did in self.did_registry
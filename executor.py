@@ -0,0 +1,42 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Overloaded(Exception):
+    """
+    Raised when a pool has no free slot for more work; callers should shed
+    the request (e.g. answer 503) instead of queueing it.
+    """
+
+
+class CryptoPool:
+    """
+    Bounded worker pool for signing and verification. At most max_pending
+    jobs are queued or running; beyond that submit raises Overloaded.
+    """
+
+    def __init__(self, max_workers=None, max_pending=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers * 64
+        self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='crypto')
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def submit(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise Overloaded("Crypto pool is saturated")
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
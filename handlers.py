@@ -0,0 +1,113 @@
+"""
+Credential hot-path request handling shared by the Flask app (app.py) and the
+native ASGI routes (asgi.py).
+
+Each handler takes the query arguments and the decoded request body and
+returns (response data, HTTP status). Handlers block while they sign or
+verify, so the ASGI front end runs them on its bounded crypto pool. Chain
+mutations take the chain lock like every other writer (the sealer, sync,
+bulk import), whichever front end serves the request.
+"""
+import logging
+from time import perf_counter
+from keystore import UnknownIssuer
+from metrics import registry as metrics
+from roles import Verifier
+from utils import blockchain, did_manager, vc_manager
+from vc import MAX_VERIFY_BATCH
+
+logger = logging.getLogger(__name__)
+
+
+def issue_credential(args, body=None):
+    issuer_did = args.get('issuer_did')
+    subject_did = args.get('subject_did')
+    diploma_name = args.get('passport_name_country')
+    graduation_date = args.get('valid_date')
+
+    if not all([issuer_did, subject_did, diploma_name, graduation_date]):
+        error_message = {"error": "Missing required parameters"}
+        logger.error(f"Error: {error_message}")
+        return error_message, 400
+
+    credential_data = {
+        'passport_name_country': diploma_name,
+        'valid_date': graduation_date,
+    }
+
+    issuer_name = did_manager.get_did_name(issuer_did) or "unknown issuer"
+    logger.debug(f"Issuer Name: {issuer_name}")
+
+    try:
+        credential = vc_manager.create_credential(issuer_did, subject_did, credential_data)
+    except UnknownIssuer:
+        return {"message": "Issuer not found"}, 404
+    blockchain.submit_transaction('VC_ISSUANCE', {
+        'issuer_did': issuer_did,
+        'subject_did': subject_did,
+        'credential_id': credential['credential_id'],
+    })  # Sealed into a block by the background sealer
+
+    logger.debug("Credential issued successfully.")
+    logger.debug(f"Credential Data: {credential}")
+
+    return {"credential_id": credential["credential_id"], "credential": credential["credential"]}, 201
+
+
+def verify_credential(args, body=None):
+    verifier_did = args.get('verifier_did')
+    credential_id = args.get('credential_id')
+
+    if not all([verifier_did, credential_id]):
+        logger.error("Missing verifier_did or credential_id")
+        return {"error": "Missing verifier_did or credential_id"}, 400
+
+    verifier = Verifier(verifier_did=verifier_did)
+    is_valid = verifier.verify_credential(credential_id)
+
+    logger.debug(f"Verification result for credential {credential_id}: {is_valid}")
+
+    return {"valid": is_valid}, 200
+
+
+def verify_credentials_batch(args, body):
+    verifier_did = body.get('verifier_did') if isinstance(body, dict) else None
+    credential_ids = body.get('credential_ids') if isinstance(body, dict) else None
+
+    if not verifier_did or not isinstance(credential_ids, list):
+        logger.error("Missing verifier_did or credential_ids")
+        return {"error": "Missing verifier_did or credential_ids"}, 400
+    if len(credential_ids) > MAX_VERIFY_BATCH:
+        return {"error": f"At most {MAX_VERIFY_BATCH} credential_ids per request"}, 413
+
+    start = perf_counter()
+    results = vc_manager.verify_credentials(credential_ids, verifier_did)
+    elapsed_ms = (perf_counter() - start) * 1000
+
+    logger.debug(f"Verified {len(results)} credentials in {elapsed_ms:.1f} ms")
+
+    return {
+        "results": results,
+        "count": len(results),
+        "valid": sum(1 for result in results if result['valid']),
+        "elapsed_ms": elapsed_ms,
+    }, 200
+
+
+def revoke_credential(args, body=None):
+    issuer_did = args.get('issuer_did')
+    credential_id = args.get('credential_id')
+    credential = vc_manager.credentials.get(credential_id)
+    if credential and credential.issuer == issuer_did:
+        if vc_manager.revoke_credential(credential_id):
+            blockchain.submit_transaction('VC_REVOCATION', {
+                'issuer_did': issuer_did,
+                'credential_id': credential_id,
+            })  # Sealed into a block by the background sealer
+        return {"message": "Credential revoked"}, 200
+    return {"message": "Credential not found or unauthorized"}, 404
+
+
+def record_request_time(started):
+    metrics.histogram('ssi_http_request_seconds', "Time spent handling HTTP requests").observe(perf_counter() - started)
+    metrics.inc('ssi_http_requests_total', help_text="HTTP requests handled")
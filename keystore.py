@@ -0,0 +1,266 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519, padding
+from metrics import registry as metrics
+
+RSA = 'RSA'
+ED25519 = 'Ed25519'
+ECDSA_P256 = 'ECDSA-P256'
+SUPPORTED_ALGORITHMS = (RSA, ED25519, ECDSA_P256)
+
+
+class UnknownIssuer(LookupError):
+    """
+    Raised when signing for a DID that has no key in the keystore.
+    """
+
+
+def generate_private_key(algorithm):
+    if algorithm == RSA:
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    if algorithm == ED25519:
+        return ed25519.Ed25519PrivateKey.generate()
+    if algorithm == ECDSA_P256:
+        return ec.generate_private_key(ec.SECP256R1())
+    raise ValueError(f"Unsupported key algorithm: {algorithm}")
+
+
+def sign(private_key, algorithm, data):
+    if algorithm == RSA:
+        return private_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+    if algorithm == ED25519:
+        return private_key.sign(data)
+    if algorithm == ECDSA_P256:
+        return private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+    raise ValueError(f"Unsupported key algorithm: {algorithm}")
+
+
+def verify(public_key, algorithm, signature, data):
+    """
+    Raises cryptography.exceptions.InvalidSignature if the signature does not match.
+    """
+    if algorithm == RSA:
+        public_key.verify(signature, data, padding.PKCS1v15(), hashes.SHA256())
+    elif algorithm == ED25519:
+        public_key.verify(signature, data)
+    elif algorithm == ECDSA_P256:
+        public_key.verify(signature, data, ec.ECDSA(hashes.SHA256()))
+    else:
+        raise ValueError(f"Unsupported key algorithm: {algorithm}")
+
+
+def serialize_public_key(key):
+    if isinstance(key, (rsa.RSAPublicKey, ec.EllipticCurvePublicKey, ed25519.Ed25519PublicKey)):
+        return key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode('utf-8')
+    raise TypeError("Unsupported key type for serialization")
+
+
+def key_fingerprint(public_key_pem):
+    return hashlib.sha256(public_key_pem.encode('utf-8')).hexdigest()
+
+
+class PublicKeyCache:
+    """
+    LRU cache of loaded public key objects keyed by key fingerprint, so a
+    verifier parses each issuer PEM once instead of once per verification.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, public_key_pem, fingerprint=None):
+        fingerprint = fingerprint or key_fingerprint(public_key_pem)
+        with self._lock:
+            public_key = self._keys.get(fingerprint)
+            if public_key is not None:
+                self._keys.move_to_end(fingerprint)
+                self.hits += 1
+                return public_key
+            self.misses += 1
+        public_key = serialization.load_pem_public_key(public_key_pem.encode('utf-8'))
+        with self._lock:
+            self._keys[fingerprint] = public_key
+            self._keys.move_to_end(fingerprint)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+        return public_key
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._keys), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class KeyStore:
+    """
+    One signing key pair per issuer DID.
+
+    Loaded key objects are cached in memory; when a path is given every key is
+    also persisted there as a JSON file holding PKCS8 PEM private keys. Rotation
+    adds a new active key and keeps the old ones so earlier credentials still
+    resolve by key_id.
+    """
+
+    def __init__(self, path=None, default_algorithm=RSA, passphrase=None):
+        if default_algorithm not in SUPPORTED_ALGORITHMS:
+            raise ValueError(f"Unsupported key algorithm: {default_algorithm}")
+        self.path = path
+        self.default_algorithm = default_algorithm
+        self.passphrase = passphrase.encode('utf-8') if isinstance(passphrase, str) else passphrase
+        self._entries = {}  # did -> {"active": key_id, "keys": {key_id: {...}}}
+        self._private_keys = {}  # (did, key_id) -> loaded private key object
+        self._public_pems = {}  # (did, key_id) -> PEM string
+        self._fingerprints = {}  # (did, key_id) -> sha256 of the PEM
+        self._lock = threading.RLock()
+        if path:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+
+    def create_key(self, did, algorithm=None):
+        with self._lock:
+            entry = self._entry(did)
+            if entry and entry['active']:
+                return entry['active']
+            return self._add_key(did, algorithm)
+
+    def rotate_key(self, did, algorithm=None):
+        with self._lock:
+            return self._add_key(did, algorithm)
+
+    def has_key(self, did):
+        with self._lock:
+            return self._entry(did) is not None
+
+    def get_signing_key(self, did):
+        """
+        Returns (key_id, algorithm, private_key) for the active key of the DID.
+        Keys are only created with the DID, so an unknown DID raises
+        UnknownIssuer.
+        """
+        with self._lock:
+            entry = self._entry(did)
+            if not entry or not entry['active']:
+                raise UnknownIssuer(f"No signing key for {did}")
+            key_id = entry['active']
+            return key_id, entry['keys'][key_id]['algorithm'], self._private_key(did, key_id)
+
+    def get_public_key_pem(self, did, key_id=None):
+        with self._lock:
+            entry = self._entry(did)
+            if not entry:
+                return None
+            key_id = key_id or entry['active']
+            if key_id not in entry['keys']:
+                return None
+            pem = self._public_pems.get((did, key_id))
+            if pem is None:
+                pem = serialize_public_key(self._private_key(did, key_id).public_key())
+                self._public_pems[(did, key_id)] = pem
+            return pem
+
+    def get_key_fingerprint(self, did, key_id=None):
+        with self._lock:
+            key_id = key_id or (self._entry(did) or {}).get('active')
+            fingerprint = self._fingerprints.get((did, key_id))
+            if fingerprint is None:
+                pem = self.get_public_key_pem(did, key_id)
+                if pem is None:
+                    return None
+                fingerprint = key_fingerprint(pem)
+                self._fingerprints[(did, key_id)] = fingerprint
+            return fingerprint
+
+    def list_keys(self, did):
+        with self._lock:
+            entry = self._entry(did)
+            if not entry:
+                return []
+            return [
+                {
+                    "key_id": key_id,
+                    "algorithm": key['algorithm'],
+                    "created": key['created'],
+                    "active": key_id == entry['active'],
+                }
+                for key_id, key in entry['keys'].items()
+            ]
+
+    def _add_key(self, did, algorithm=None):
+        algorithm = algorithm or self.default_algorithm
+        with metrics.timer('ssi_key_generation_seconds', "Time spent generating issuer keys"):
+            private_key = generate_private_key(algorithm)
+        key_id = str(uuid.uuid4())
+        entry = self._entry(did) or {"active": None, "keys": {}}
+        entry['keys'][key_id] = {
+            "algorithm": algorithm,
+            "created": datetime.utcnow().isoformat() + 'Z',
+            "private_key": self._serialize_private_key(private_key),
+        }
+        entry['active'] = key_id
+        self._entries[did] = entry
+        self._private_keys[(did, key_id)] = private_key
+        self._persist(did)
+        return key_id
+
+    def _entry(self, did):
+        entry = self._entries.get(did)
+        if entry is None and self.path:
+            entry = self._load(did)
+        return entry
+
+    def _private_key(self, did, key_id):
+        private_key = self._private_keys.get((did, key_id))
+        if private_key is None:
+            pem = self._entries[did]['keys'][key_id]['private_key']
+            private_key = serialization.load_pem_private_key(pem.encode('utf-8'), password=self.passphrase)
+            self._private_keys[(did, key_id)] = private_key
+        return private_key
+
+    def _serialize_private_key(self, private_key):
+        if self.passphrase:
+            encryption = serialization.BestAvailableEncryption(self.passphrase)
+        else:
+            encryption = serialization.NoEncryption()
+        return private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=encryption
+        ).decode('utf-8')
+
+    def _file_for(self, did):
+        # DIDs come straight from request arguments, so never use them as a path
+        return os.path.join(self.path, hashlib.sha256(did.encode('utf-8')).hexdigest() + '.json')
+
+    def _persist(self, did):
+        if not self.path:
+            return
+        filename = self._file_for(did)
+        tmp_filename = filename + '.tmp'
+        # Private keys, so readable by the node's user only
+        with os.fdopen(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump({"did": did, **self._entries[did]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+
+    def _load(self, did):
+        try:
+            with open(self._file_for(did)) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        entry = {"active": data['active'], "keys": data['keys']}
+        self._entries[did] = entry
+        return entry
@@ -0,0 +1,66 @@
+import hashlib
+from canonical import canonicalize
+
+# Leaves and inner nodes are domain-separated (RFC 6962) so an inner node can
+# never be passed off as a transaction.
+_LEAF_PREFIX = b'\x00'
+_NODE_PREFIX = b'\x01'
+
+EMPTY_ROOT = hashlib.sha256(b'').hexdigest()
+
+
+def leaf_hash(transaction):
+    return hashlib.sha256(_LEAF_PREFIX + canonicalize(transaction)).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(_NODE_PREFIX + left + right).digest()
+
+
+def _next_level(level):
+    # An unpaired last node is promoted as is instead of being duplicated
+    paired = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        paired.append(level[-1])
+    return paired
+
+
+def merkle_root(transactions):
+    level = [leaf_hash(transaction) for transaction in transactions]
+    if not level:
+        return EMPTY_ROOT
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0].hex()
+
+
+def merkle_proof(transactions, position):
+    """
+    Returns the sibling path from the transaction at position up to the root,
+    as a list of {"hash": <hex>, "side": 'left' | 'right'} entries.
+    """
+    level = [leaf_hash(transaction) for transaction in transactions]
+    if not 0 <= position < len(level):
+        raise IndexError("Transaction position out of range")
+    proof = []
+    while len(level) > 1:
+        sibling = position ^ 1
+        if sibling < len(level):
+            proof.append({
+                "hash": level[sibling].hex(),
+                "side": 'left' if sibling < position else 'right',
+            })
+        level = _next_level(level)
+        position //= 2
+    return proof
+
+
+def verify_proof(transaction, proof, root):
+    current = leaf_hash(transaction)
+    for step in proof:
+        sibling = bytes.fromhex(step['hash'])
+        if step['side'] == 'left':
+            current = node_hash(sibling, current)
+        else:
+            current = node_hash(current, sibling)
+    return current.hex() == root
@@ -0,0 +1,203 @@
+import sys
+import threading
+import traceback
+from collections import Counter as _FrameCounter
+from time import perf_counter, sleep
+
+# Latency buckets in seconds, from fast hash operations up to slow RSA keygen
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def expose(self):
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+            lines.append(f"{self.name}_sum {self.sum}")
+            lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Registry:
+    """
+    Named counters and histograms, rendered in the Prometheus text format.
+    While disabled, timer() hands out a shared no-op context manager and
+    inc() returns immediately, so instrumented code pays one attribute check.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help_text='', buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Histogram(name, help_text, buckets)
+            return metric
+
+    def counter(self, name, help_text=''):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Counter(name, help_text)
+            return metric
+
+    def timer(self, name, help_text=''):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self._metrics.get(name) or self.histogram(name, help_text))
+
+    def inc(self, name, amount=1, help_text=''):
+        if not self.enabled:
+            return
+        (self._metrics.get(name) or self.counter(name, help_text)).inc(amount)
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads every interval seconds from a
+    background thread and counts the frames seen. Nothing runs while the
+    profiler is stopped.
+    """
+
+    def __init__(self, interval=0.005, max_depth=20):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks = _FrameCounter()
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._stacks = _FrameCounter()
+            self.samples = 0
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while self._running:
+            keys = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = traceback.extract_stack(frame, limit=self.max_depth)
+                keys.append(';'.join(f"{entry.name} ({entry.filename.rsplit('/', 1)[-1]}:{entry.lineno})" for entry in stack))
+            with self._lock:  # report() reads the counter from request threads
+                for key in keys:
+                    self._stacks[key] += 1
+                self.samples += 1
+            sleep(self.interval)
+
+    def report(self, limit=25):
+        """
+        Returns the most frequently sampled stacks, root frame first.
+        """
+        with self._lock:
+            stacks = self._stacks.most_common(limit)
+            samples = self.samples
+        return {
+            'running': self._running,
+            'samples': samples,
+            'interval': self.interval,
+            'top_stacks': [{'stack': stack.split(';'), 'count': count} for stack, count in stacks],
+        }
+
+
+registry = Registry()
+profiler = SamplingProfiler()
@@ -0,0 +1,135 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class PresentationRegistry:
+    """
+    Which verifiers each credential was presented to, indexed in both
+    directions so presenting, withdrawing and listing are all O(1) per entry.
+    """
+
+    def __init__(self):
+        self._verifiers = {}  # credential_id -> set of verifier dids
+        self._credentials = {}  # verifier did -> set of credential_ids
+        self._lock = threading.Lock()
+
+    def present(self, credential_id, verifier_did):
+        """
+        Returns False if the credential was already presented to the verifier.
+        """
+        with self._lock:
+            verifiers = self._verifiers.setdefault(credential_id, set())
+            if verifier_did in verifiers:
+                return False
+            verifiers.add(verifier_did)
+            self._credentials.setdefault(verifier_did, set()).add(credential_id)
+            return True
+
+    def withdraw(self, credential_id, verifier_did):
+        """
+        Returns False if the credential was not presented to the verifier.
+        """
+        with self._lock:
+            verifiers = self._verifiers.get(credential_id)
+            if not verifiers or verifier_did not in verifiers:
+                return False
+            verifiers.discard(verifier_did)
+            if not verifiers:
+                del self._verifiers[credential_id]
+            credentials = self._credentials[verifier_did]
+            credentials.discard(credential_id)
+            if not credentials:
+                del self._credentials[verifier_did]
+            return True
+
+    def is_presented(self, credential_id, verifier_did):
+        return verifier_did in self._verifiers.get(credential_id, ())
+
+    def verifiers(self, credential_id):
+        with self._lock:
+            return set(self._verifiers.get(credential_id, ()))
+
+    def credentials(self, verifier_did):
+        with self._lock:
+            return set(self._credentials.get(verifier_did, ()))
+
+    def items(self):
+        """
+        Yields (credential_id, verifier_did) for every presentation.
+        """
+        with self._lock:
+            pairs = [(credential_id, verifier_did)
+                     for credential_id, verifiers in self._verifiers.items()
+                     for verifier_did in verifiers]
+        return iter(pairs)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(verifiers) for verifiers in self._verifiers.values())
+
+
+class VerificationCache:
+    """
+    Per-verifier LRU cache of verification results. Entries expire after ttl
+    seconds and are dropped as soon as the credential is revoked or the
+    holder withdraws the verifier's access.
+    """
+
+    def __init__(self, maxsize=100000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()  # (verifier_did, credential_id) -> (expires_at, valid)
+        self._by_credential = {}  # credential_id -> set of verifier dids with a cached result
+        self._lock = threading.Lock()
+
+    def get(self, verifier_did, credential_id):
+        """
+        Returns the cached result, or None on a miss.
+        """
+        key = (verifier_did, credential_id)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[0] > monotonic():
+                self._results.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            return None
+
+    def put(self, verifier_did, credential_id, valid):
+        key = (verifier_did, credential_id)
+        with self._lock:
+            self._results[key] = (monotonic() + self.ttl, valid)
+            self._results.move_to_end(key)
+            self._by_credential.setdefault(credential_id, set()).add(verifier_did)
+            while len(self._results) > self.maxsize:
+                (evicted_verifier, evicted_id), _ = self._results.popitem(last=False)
+                self._forget(evicted_id, evicted_verifier)
+
+    def invalidate(self, credential_id, verifier_did=None):
+        """
+        Drops the cached results of one verifier, or of every verifier when
+        verifier_did is None.
+        """
+        with self._lock:
+            if verifier_did is None:
+                verifiers = self._by_credential.pop(credential_id, ())
+            else:
+                verifiers = (verifier_did,)
+                self._forget(credential_id, verifier_did)
+            for verifier in verifiers:
+                self._results.pop((verifier, credential_id), None)
+
+    def _forget(self, credential_id, verifier_did):
+        verifiers = self._by_credential.get(credential_id)
+        if verifiers is not None:
+            verifiers.discard(verifier_did)
+            if not verifiers:
+                del self._by_credential[credential_id]
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._results), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
@@ -1,24 +1,31 @@
 import json
+import uuid
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
-from did import DID
+from utils import did_manager as shared_did_manager, vc_manager as shared_vc_manager
+from keystore import KeyStore
 from vc import VerifiableCredential
 
 class Issuer:
-    def __init__(self, name, did=None):
-        self.did_manager = DID()
-        self.did = did or self.did_manager.create_issuer_did(name)
+    def __init__(self, name, did=None, keystore=None, key_algorithm=None, did_manager=None):
+        self.did_manager = did_manager if did_manager is not None else shared_did_manager
+        self.did = did or str(uuid.uuid4())
         self.name = name
+        self.keystore = keystore if keystore is not None else KeyStore()
+        # The key comes first, so an unsupported algorithm leaves no issuer DID without a key behind
+        self.keystore.create_key(self.did, key_algorithm)
+        if did is None:
+            self.did_manager.register(self.did, name, "issuer")
 
     def issue_credential(self, subject_did, credential_data):
-        vc_manager = VerifiableCredential()
+        vc_manager = VerifiableCredential(self.keystore)
         return vc_manager.create_credential(self.did, subject_did, credential_data)
 
 class Holder:
-    def __init__(self, name):
-        self.did_manager = DID()
+    def __init__(self, name, did_manager=None):
+        self.did_manager = did_manager if did_manager is not None else shared_did_manager
         self.did = self.did_manager.create_holder_did(name)
         self.name = name
 
@@ -26,10 +33,11 @@ class Holder:
         return self.did
 
 class Verifier:
-    def __init__(self, verifier_did=None, name=None):
+    def __init__(self, verifier_did=None, name=None, did_manager=None, vc_manager=None):
         self.verifier_did = verifier_did
         self.name = name
-        self.did_manager = DID()
+        self.did_manager = did_manager if did_manager is not None else shared_did_manager
+        self.vc_manager = vc_manager if vc_manager is not None else shared_vc_manager
 
     def get_verifier_did(self):
         return self.verifier_did
@@ -43,10 +51,7 @@ class Verifier:
         return self.did_manager.get_did_name(self.verifier_did)
 
     def verify_credential(self, credential_id):
-        vc_manager = VerifiableCredential()
-        credential = vc_manager.credentials.get(credential_id)
-        if not credential:
-            return False
-        credential_data = credential['credential']
-        signature = credential['signature']
-        return vc_manager.verify_credential(credential_data, signature)
+        return self.vc_manager.verify_credential(credential_id, self.verifier_did)
+
+    def presented_credentials(self):
+        return self.vc_manager.presentations.credentials(self.verifier_did)
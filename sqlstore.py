@@ -0,0 +1,455 @@
+import json
+import queue
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from time import monotonic
+from storage import encode_record, decode_record
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    idx INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dids (
+    did TEXT PRIMARY KEY,
+    name TEXT,
+    type TEXT
+);
+CREATE TABLE IF NOT EXISTS keys (
+    id INTEGER PRIMARY KEY,
+    public_key TEXT NOT NULL,
+    algorithm TEXT,
+    key_id TEXT,
+    key_fingerprint TEXT,
+    UNIQUE (public_key, algorithm, key_id, key_fingerprint)
+);
+CREATE TABLE IF NOT EXISTS credentials (
+    credential_id TEXT PRIMARY KEY,
+    key_ref INTEGER NOT NULL REFERENCES keys (id),
+    encoded BLOB NOT NULL,
+    canonical INTEGER NOT NULL,
+    signature BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS revocations (
+    credential_id TEXT PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS presentations (
+    credential_id TEXT NOT NULL,
+    verifier_did TEXT NOT NULL,
+    PRIMARY KEY (credential_id, verifier_did)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS status_counters (
+    issuer_did TEXT PRIMARY KEY,
+    next_index INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    extra TEXT
+);
+"""
+
+
+def connect(path, timeout=30.0):
+    connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+class ConnectionPool:
+    """
+    Fixed-size pool of read connections. WAL mode lets readers in every
+    worker process run concurrently with the single writer.
+    """
+
+    def __init__(self, path, size=4):
+        self._connections = queue.Queue()
+        for _ in range(size):
+            self._connections.put(connect(path))
+
+    @contextmanager
+    def connection(self):
+        connection = self._connections.get()
+        try:
+            yield connection
+        finally:
+            self._connections.put(connection)
+
+    def close(self):
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+
+class SQLiteStorage:
+    """
+    State backend shared by every worker process of a node through one
+    SQLite database in WAL mode.
+
+    Each worker keeps serving reads from its in-memory state. Its own changes
+    are queued and committed in batches every flush_interval seconds (or once
+    batch_size are pending), each together with a row in the changes table.
+    refresh() applies the changes other workers committed since the last
+    call. Sealing a block takes the database write lock, appends any blocks
+    other workers sealed first and commits the new block with the pending
+    batch, so all workers share one chain. Status list indexes are leased
+    from a counter per issuer, so no two workers hand out the same one.
+    """
+
+    def __init__(self, path, pool_size=4, batch_size=256, flush_interval=0.01, refresh_interval=0.02):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.origin = uuid.uuid4().hex  # Identifies this worker's rows in the change feed
+        self.blockchain = None
+        self.vc_manager = None
+        self._writer = connect(path)
+        self._writer.executescript(SCHEMA)
+        self.pool = ConnectionPool(path, pool_size)
+        self._write_lock = threading.Lock()
+        self._pending = []  # (sql, params, kind, key, extra) waiting for the next batch
+        self._pending_lock = threading.Condition()
+        self._sealing_batch = None
+        self._key_refs = {}
+        self._last_seq = 0
+        self._last_refresh = 0.0
+        self._refresh_lock = threading.Lock()
+        self._stopping = False
+        self._flusher = None
+
+    def attach(self, blockchain, vc_manager):
+        """
+        Loads the shared state into blockchain and vc_manager, then keeps the
+        database up to date with their changes.
+        """
+        self.blockchain = blockchain
+        self.vc_manager = vc_manager
+        with blockchain.lock:
+            with self._write_lock:
+                self._writer.execute('BEGIN IMMEDIATE')
+                try:
+                    if self._writer.execute('SELECT 1 FROM blocks LIMIT 1').fetchone() is None:
+                        # First worker to start publishes its genesis block
+                        for block, block_hash in zip(blockchain.chain, blockchain.block_hashes):
+                            self._insert_block(block, block_hash)
+                    self._writer.execute('COMMIT')
+                except BaseException:
+                    self._writer.execute('ROLLBACK')
+                    raise
+            self._load()
+            self._seed_status_counters()
+            blockchain.listeners.append(self._on_chain_event)
+        vc_manager.listeners.append(self._on_credential_event)
+        vc_manager.status_lists.allocator = self.reserve_status_indexes
+        self._flusher = threading.Thread(target=self._flush_loop, name='sqlite-flusher', daemon=True)
+        self._flusher.start()
+
+    def _load(self):
+        with self.pool.connection() as connection:
+            # Read before the tables: changes committed meanwhile are applied twice, which is harmless
+            self._last_seq = connection.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+            blocks = []
+            block_hashes = []
+            for block_hash, body in connection.execute('SELECT hash, body FROM blocks ORDER BY idx'):
+                blocks.append(decode_record(body))
+                block_hashes.append(block_hash)
+            self.blockchain.load_chain(blocks, block_hashes)
+            for did, name, did_type in connection.execute('SELECT did, name, type FROM dids ORDER BY rowid'):
+                self.blockchain.did_registry.register(did, name, did_type)
+            for row in connection.execute(
+                    'SELECT c.credential_id, c.encoded, c.canonical, c.signature, k.public_key, k.algorithm, '
+                    'k.key_id, k.key_fingerprint FROM credentials c JOIN keys k ON k.id = c.key_ref ORDER BY c.rowid'):
+                self.vc_manager.restore_credential(row[0], self._record(row[1:]))
+            for (credential_id,) in connection.execute('SELECT credential_id FROM revocations'):
+                self.vc_manager.restore_revocation(credential_id)
+            for credential_id, verifier_did in connection.execute('SELECT credential_id, verifier_did FROM presentations'):
+                self.vc_manager.restore_presentation(credential_id, verifier_did)
+
+    def _seed_status_counters(self):
+        # Databases written before the counters existed only have the indexes of the stored credentials
+        counters = [(issuer_did, status_list.next_index)
+                    for issuer_did, status_list in self.vc_manager.status_lists.lists.items()]
+        with self._write_lock:
+            self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                self._writer.executemany(
+                    'INSERT INTO status_counters (issuer_did, next_index) VALUES (?, ?) '
+                    'ON CONFLICT (issuer_did) DO UPDATE SET next_index = MAX(next_index, excluded.next_index)',
+                    counters,
+                )
+                self._writer.execute('COMMIT')
+            except BaseException:
+                self._writer.execute('ROLLBACK')
+                raise
+
+    @staticmethod
+    def _record(row):
+        encoded, canonical, signature, public_key, algorithm, key_id, key_fingerprint = row
+        return {
+            "credential": json.loads(encoded),
+            "signed_bytes": bytes(encoded) if canonical else None,
+            "signature": bytes(signature),
+            "public_key": public_key,
+            "algorithm": algorithm,
+            "key_id": key_id,
+            "key_fingerprint": key_fingerprint,
+        }
+
+    def refresh(self, force=False):
+        """
+        Applies DIDs, credentials, revocations, presentations and blocks that
+        other workers committed since the last refresh. Calls within
+        refresh_interval of the previous one return immediately.
+        """
+        now = monotonic()
+        if not force and now - self._last_refresh < self.refresh_interval:
+            return
+        if not self._refresh_lock.acquire(blocking=force):
+            return  # Another thread of this worker is already refreshing
+        try:
+            self._last_refresh = now
+            with self.pool.connection() as connection:
+                changes = connection.execute(
+                    'SELECT seq, kind, key, extra FROM changes WHERE seq > ? AND origin != ? ORDER BY seq',
+                    (self._last_seq, self.origin),
+                ).fetchall()
+                for _, kind, key, extra in changes:
+                    self._apply(connection, kind, key, extra)
+                if changes:
+                    self._last_seq = changes[-1][0]
+                with self.blockchain.lock:
+                    self._append_new_blocks(connection)
+        finally:
+            self._refresh_lock.release()
+
+    def _apply(self, connection, kind, key, extra):
+        if kind == 'did':
+            row = connection.execute('SELECT name, type FROM dids WHERE did = ?', (key,)).fetchone()
+            if row is not None:
+                self.blockchain.did_registry.register(key, *row)
+        elif kind == 'credential':
+            row = connection.execute(
+                'SELECT c.encoded, c.canonical, c.signature, k.public_key, k.algorithm, k.key_id, k.key_fingerprint '
+                'FROM credentials c JOIN keys k ON k.id = c.key_ref WHERE c.credential_id = ?', (key,)).fetchone()
+            if row is not None and key not in self.vc_manager.credentials:
+                self.vc_manager.restore_credential(key, self._record(row))
+        elif kind == 'revocation':
+            self.vc_manager.restore_revocation(key)
+        elif kind in ('presented', 'access_revoked'):
+            self.vc_manager.restore_presentation(key, extra, kind == 'presented')
+
+    def _append_new_blocks(self, connection):
+        height = len(self.blockchain.chain)
+        row = connection.execute('SELECT hash FROM blocks WHERE idx = ?', (height,)).fetchone()
+        if row is not None and row[0] != self.blockchain.block_hashes[-1]:
+            # Another worker switched to a longer chain from a peer
+            blocks = []
+            block_hashes = []
+            for block_hash, body in connection.execute('SELECT hash, body FROM blocks ORDER BY idx'):
+                blocks.append(decode_record(body))
+                block_hashes.append(block_hash)
+            self.blockchain.load_chain(blocks, block_hashes)
+            return
+        rows = connection.execute(
+            'SELECT hash, body FROM blocks WHERE idx > ? ORDER BY idx', (len(self.blockchain.chain),)
+        ).fetchall()
+        if rows:
+            self.blockchain.append_blocks([decode_record(body) for _, body in rows], [block_hash for block_hash, _ in rows])
+
+    def _on_chain_event(self, event, *args):
+        if event == 'sealing':
+            # Held until the 'block' or 'seal_aborted' event ends the transaction
+            self._write_lock.acquire()
+            self._sealing_batch = self._take_pending()
+            try:
+                self._writer.execute('BEGIN IMMEDIATE')
+                self._write(self._sealing_batch)
+                self._append_new_blocks(self._writer)
+            except BaseException:
+                self._end_sealing(commit=False)
+                raise
+        elif event == 'block':
+            block, block_hash = args
+            try:
+                self._insert_block(block, block_hash)
+            except BaseException:
+                self._end_sealing(commit=False)
+                raise
+            self._end_sealing(commit=True)
+        elif event == 'seal_aborted':
+            self._end_sealing(commit=False)
+        elif event == 'reorganized':
+            start, blocks, block_hashes = args
+            with self._write_lock:
+                pending = self._take_pending()
+                try:
+                    self._writer.execute('BEGIN IMMEDIATE')
+                    self._write(pending)
+                    self._writer.execute('DELETE FROM blocks WHERE idx >= ?', (start,))
+                    for block, block_hash in zip(blocks, block_hashes):
+                        self._insert_block(block, block_hash)
+                    self._writer.execute('COMMIT')
+                except BaseException:
+                    self._abort(pending)
+                    raise
+        elif event == 'did':
+            did, name, did_type = args
+            self._queue(
+                'INSERT INTO dids (did, name, type) VALUES (?, ?, ?) '
+                'ON CONFLICT (did) DO UPDATE SET name = excluded.name, type = excluded.type',
+                (did, name, did_type), 'did', did,
+            )
+
+    def _end_sealing(self, commit):
+        # Ends the transaction opened on 'sealing' and always releases the write lock
+        batch, self._sealing_batch = self._sealing_batch, None
+        if batch is None:
+            return  # Already ended
+        try:
+            if commit:
+                try:
+                    self._writer.execute('COMMIT')
+                    return
+                except BaseException:
+                    self._abort(batch)
+                    raise
+            self._abort(batch)
+        finally:
+            self._write_lock.release()
+
+    def reserve_status_indexes(self, issuer_did, count, start=None):
+        """
+        Takes count status list indexes of the issuer from the shared counter
+        and returns the first. With start, claims start..start+count-1 instead
+        and returns None if the counter has already passed start.
+        """
+        with self._write_lock:
+            self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._writer.execute(
+                    'SELECT next_index FROM status_counters WHERE issuer_did = ?', (issuer_did,)).fetchone()
+                next_index = row[0] if row is not None else 0
+                if start is None:
+                    start = next_index
+                elif start < next_index:
+                    self._writer.execute('ROLLBACK')
+                    return None
+                self._writer.execute(
+                    'INSERT INTO status_counters (issuer_did, next_index) VALUES (?, ?) '
+                    'ON CONFLICT (issuer_did) DO UPDATE SET next_index = excluded.next_index',
+                    (issuer_did, start + count),
+                )
+                self._writer.execute('COMMIT')
+            except BaseException:
+                if self._writer.in_transaction:
+                    self._writer.execute('ROLLBACK')
+                raise
+        return start
+
+    def _on_credential_event(self, event, credential_id, record):
+        if event == 'issued':
+            public_key, algorithm, key_id, key_fingerprint = record.key_table.get(record.key_ref)
+            self._queue(
+                'INSERT OR IGNORE INTO credentials (credential_id, key_ref, encoded, canonical, signature) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (credential_id, (public_key, algorithm, key_id, key_fingerprint), record.encoded,
+                 int(record.canonical), record.signature),
+                'credential', credential_id,
+            )
+        elif event == 'revoked':
+            self._queue('INSERT OR IGNORE INTO revocations (credential_id) VALUES (?)', (credential_id,),
+                        'revocation', credential_id)
+        elif event == 'presented':
+            self._queue('INSERT OR IGNORE INTO presentations (credential_id, verifier_did) VALUES (?, ?)',
+                        (credential_id, record), event, credential_id, record)
+        elif event == 'access_revoked':
+            self._queue('DELETE FROM presentations WHERE credential_id = ? AND verifier_did = ?',
+                        (credential_id, record), event, credential_id, record)
+
+    def _queue(self, sql, params, kind, key, extra=None):
+        with self._pending_lock:
+            self._pending.append((sql, params, kind, key, extra))
+            if len(self._pending) >= self.batch_size:
+                self._pending_lock.notify()
+
+    def _take_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        return pending
+
+    def _abort(self, pending):
+        # Rolls back the open transaction and queues its changes again for the next batch
+        if self._writer.in_transaction:
+            self._writer.execute('ROLLBACK')
+        self._key_refs.clear()  # Keys inserted by the rolled back transaction are gone
+        with self._pending_lock:
+            self._pending[:0] = pending
+
+    def _write(self, pending):
+        """
+        Writes a batch of queued changes inside the writer's open transaction.
+        """
+        for sql, params, kind, key, extra in pending:
+            if kind == 'credential':
+                params = (params[0], self._key_ref(*params[1]), *params[2:])
+            self._writer.execute(sql, params)
+        self._writer.executemany(
+            'INSERT INTO changes (origin, kind, key, extra) VALUES (?, ?, ?, ?)',
+            [(self.origin, kind, key, extra) for _, _, kind, key, extra in pending],
+        )
+
+    def _key_ref(self, public_key, algorithm, key_id, key_fingerprint):
+        key = (public_key, algorithm, key_id, key_fingerprint)
+        ref = self._key_refs.get(key)
+        if ref is None:
+            self._writer.execute(
+                'INSERT OR IGNORE INTO keys (public_key, algorithm, key_id, key_fingerprint) VALUES (?, ?, ?, ?)', key)
+            ref = self._writer.execute(
+                'SELECT id FROM keys WHERE public_key = ? AND algorithm IS ? AND key_id IS ? AND key_fingerprint IS ?',
+                key).fetchone()[0]
+            self._key_refs[key] = ref
+        return ref
+
+    def _insert_block(self, block, block_hash):
+        self._writer.execute('INSERT INTO blocks (idx, hash, body) VALUES (?, ?, ?)',
+                             (block['index'], block_hash, encode_record(block)))
+
+    def flush(self):
+        with self._pending_lock:
+            if not self._pending:
+                return
+        with self._write_lock:
+            pending = self._take_pending()
+            try:
+                self._writer.execute('BEGIN IMMEDIATE')
+                self._write(pending)
+                self._writer.execute('COMMIT')
+            except BaseException:
+                self._abort(pending)
+                raise
+
+    def _flush_loop(self):
+        while not self._stopping:
+            with self._pending_lock:
+                if len(self._pending) < self.batch_size:
+                    self._pending_lock.wait(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.OperationalError:
+                pass  # e.g. the database stayed locked; the batch is retried on the next round
+
+    def close(self):
+        self._stopping = True
+        with self._pending_lock:
+            self._pending_lock.notify()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        self.pool.close()
+        self._writer.close()
@@ -0,0 +1,163 @@
+import base64
+import gzip
+import hashlib
+import threading
+
+# 16KB of bits, the minimum list size StatusList2021 recommends for herd privacy
+DEFAULT_LIST_SIZE = 131072
+# Highest index accepted from outside, e.g. on import: lists grow to fit, so 2MB of bits at most
+MAX_INDEX = 2 ** 24 - 1
+
+
+class StatusList:
+    """
+    Revocation bitstring of a single issuer. Bit i is set when the credential
+    with statusListIndex i is revoked; index 0 is the most significant bit of
+    the first byte, as in StatusList2021.
+    """
+
+    def __init__(self, issuer_did, size=DEFAULT_LIST_SIZE):
+        self.issuer_did = issuer_did
+        self.bits = bytearray(size // 8)
+        self.next_index = 0
+        self._encoded = None  # (gzip bytes, etag), cleared whenever a bit changes
+
+    @property
+    def size(self):
+        return len(self.bits) * 8
+
+    def allocate(self):
+        index = self.next_index
+        self.reserve(index)
+        return index
+
+    def reserve(self, index):
+        while index >= self.size:
+            self.bits.extend(bytes(len(self.bits)))  # Grow by doubling
+            self._encoded = None
+        self.next_index = max(self.next_index, index + 1)
+
+    def set_revoked(self, index, revoked=True):
+        self.reserve(index)
+        mask = 0x80 >> (index % 8)
+        if revoked:
+            self.bits[index // 8] |= mask
+        else:
+            self.bits[index // 8] &= ~mask
+        self._encoded = None
+
+    def is_revoked(self, index):
+        if index >= self.size:
+            return False
+        return bool(self.bits[index // 8] & (0x80 >> (index % 8)))
+
+    def encoded(self):
+        """
+        Returns (gzip compressed bitstring, etag). The result is cached until
+        the next revocation.
+        """
+        if self._encoded is None:
+            data = gzip.compress(bytes(self.bits), mtime=0)
+            self._encoded = (data, hashlib.sha256(data).hexdigest()[:32])
+        return self._encoded
+
+    def to_document(self, url):
+        data, _ = self.encoded()
+        return {
+            "id": url,
+            "type": "StatusList2021",
+            "issuer": self.issuer_did,
+            "statusPurpose": "revocation",
+            "size": self.size,
+            "encodedList": base64.urlsafe_b64encode(data).decode('ascii').rstrip('='),
+        }
+
+
+class StatusListRegistry:
+    """
+    Status lists of all issuers. Indexes are allocated from each list's own
+    counter unless an allocator is set: a shared state backend sets one so
+    that every worker process leases its indexes from the same counter.
+    """
+
+    def __init__(self, list_size=DEFAULT_LIST_SIZE, lease_size=64):
+        self.list_size = list_size
+        self.lease_size = lease_size
+        self.lists = {}  # issuer_did -> StatusList
+        # allocator(issuer_did, count, start=None) -> first index of count reserved ones,
+        # or None if start was given and is already taken
+        self.allocator = None
+        self._leases = {}  # issuer_did -> [next index, end] of the range leased from the allocator
+        self._released = {}  # issuer_did -> allocated indexes that ended up unused, handed out again first
+        self._lock = threading.Lock()
+
+    def _list(self, issuer_did):
+        status_list = self.lists.get(issuer_did)
+        if status_list is None:
+            status_list = StatusList(issuer_did, self.list_size)
+            self.lists[issuer_did] = status_list
+        return status_list
+
+    def allocate(self, issuer_did):
+        with self._lock:
+            released = self._released.get(issuer_did)
+            if released:
+                return released.pop()
+            status_list = self._list(issuer_did)
+            if self.allocator is None:
+                return status_list.allocate()
+            lease = self._leases.get(issuer_did)
+            if lease is None or lease[0] == lease[1]:
+                start = self.allocator(issuer_did, self.lease_size)
+                lease = self._leases[issuer_did] = [start, start + self.lease_size]
+            index = lease[0]
+            lease[0] += 1
+            status_list.reserve(index)
+            return index
+
+    def release(self, issuer_did, index):
+        """
+        Hands back an allocated index that no credential ended up using,
+        e.g. because signing failed, so it is not lost.
+        """
+        with self._lock:
+            self._released.setdefault(issuer_did, []).append(index)
+
+    def reserve(self, issuer_did, index):
+        with self._lock:
+            self._list(issuer_did).reserve(index)
+
+    def claim(self, issuer_did, index):
+        """
+        Reserves an index chosen by the caller, e.g. one carried by an imported
+        credential. Returns False if it may already be allocated.
+        """
+        with self._lock:
+            status_list = self._list(issuer_did)
+            if index < status_list.next_index:
+                return False
+            if self.allocator is not None and self.allocator(issuer_did, 1, index) is None:
+                return False
+            status_list.reserve(index)
+            return True
+
+    def revoke(self, issuer_did, index):
+        with self._lock:
+            self._list(issuer_did).set_revoked(index)
+
+    def is_revoked(self, issuer_did, index):
+        status_list = self.lists.get(issuer_did)
+        return status_list is not None and status_list.is_revoked(index)
+
+    def get(self, issuer_did):
+        return self.lists.get(issuer_did)
+
+    def document(self, issuer_did, url):
+        """
+        Returns (status list document, etag), or None for an unknown issuer.
+        """
+        with self._lock:
+            status_list = self.lists.get(issuer_did)
+            if status_list is None:
+                return None
+            return status_list.to_document(url), status_list.encoded()[1]
@@ -0,0 +1,510 @@
+import base64
+import bisect
+import json
+import logging
+import mmap
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from time import time
+from txindex import TransactionIndex, pack_location
+
+# Records are JSON lines; bytes values (signatures, signed credential bytes)
+# are wrapped as {"$bytes": <base64>} so they round-trip exactly.
+_BYTES_KEY = '$bytes'
+
+logger = logging.getLogger(__name__)
+
+
+def _default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {_BYTES_KEY: base64.b64encode(value).decode('ascii')}
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, Mapping):
+        return dict(value)  # Compact credential records
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _object_hook(obj):
+    if len(obj) == 1 and _BYTES_KEY in obj:
+        return base64.b64decode(obj[_BYTES_KEY])
+    return obj
+
+
+def encode_record(record):
+    return json.dumps(record, default=_default, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def decode_record(line):
+    return json.loads(line, object_hook=_object_hook)
+
+
+class SegmentedLog:
+    """
+    Append-only log of JSON records split into segment files named after the
+    sequence number of their first record. Writes are flushed immediately and
+    fsynced in batches of fsync_batch records or every fsync_interval seconds.
+    """
+
+    def __init__(self, path, segment_size=100000, fsync_batch=256, fsync_interval=0.05, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.segment_size = segment_size
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment_start = None
+        self._unsynced = 0
+        self._last_sync = time()
+        self._maps = {}  # segment start -> mmap, for read_at
+        self._maps_lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.next_seq = self._recover()
+
+    def _segments(self):
+        names = [name for name in os.listdir(self.path) if name.endswith('.log')]
+        return sorted(int(name[:-4]) for name in names)
+
+    def _segment_file(self, start):
+        return os.path.join(self.path, f"{start:020d}.log")
+
+    def _recover(self):
+        segments = self._segments()
+        if not segments:
+            return 0
+        start = segments[-1]
+        filename = self._segment_file(start)
+        count = 0
+        valid_size = 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Torn write from a crash; it is cut off below
+                count += 1
+                valid_size += len(line)
+        if valid_size != os.path.getsize(filename) and not self.read_only:
+            with open(filename, 'r+b') as f:
+                f.truncate(valid_size)
+        return start + count
+
+    def append(self, record):
+        return self.append_located(record)[0]
+
+    def append_located(self, record):
+        """
+        Like append, but returns (seq, location), where location is the
+        (segment start, byte offset) pair read_at takes.
+        """
+        if self.read_only:
+            raise IOError("Log is opened read-only")
+        data = encode_record(record)
+        with self._lock:
+            if self._file is None or self.next_seq - self._segment_start >= self.segment_size:
+                self._roll()
+            offset = self._file.tell()
+            self._file.write(data)
+            self._file.flush()
+            seq = self.next_seq
+            self.next_seq += 1
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_batch or time() - self._last_sync >= self.fsync_interval:
+                self._sync()
+            return seq, (self._segment_start, offset)
+
+    def _roll(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+        segments = self._segments()
+        if segments and self.next_seq - segments[-1] < self.segment_size:
+            self._segment_start = segments[-1]
+        else:
+            self._segment_start = self.next_seq
+        self._file = open(self._segment_file(self._segment_start), 'ab')
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def read(self, start=0):
+        """
+        Yields (seq, record) for every record from sequence number start on.
+        Whole segments before start are skipped without being opened.
+        """
+        for seq, _, record in self.read_located(start):
+            yield seq, record
+
+    def read_located(self, start=0):
+        """
+        Like read, yielding (seq, location, record).
+        """
+        segments = self._segments()
+        for i, segment_start in enumerate(segments):
+            segment_end = segments[i + 1] if i + 1 < len(segments) else None
+            if segment_end is not None and segment_end <= start:
+                continue
+            seq = segment_start
+            offset = 0
+            with open(self._segment_file(segment_start), 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    if seq >= start:
+                        yield seq, (segment_start, offset), decode_record(line)
+                    seq += 1
+                    offset += len(line)
+
+    def read_at(self, location):
+        """
+        Reads back the single record at a location returned by
+        append_located or read_located.
+        """
+        segment_start, offset = location
+        mm = self._maps.get(segment_start)
+        end = mm.find(b'\n', offset) if mm is not None else -1
+        if end == -1:
+            # Not mapped yet, or mapped before the record was written
+            with self._maps_lock:
+                with open(self._segment_file(segment_start), 'rb') as f:
+                    mm = self._maps[segment_start] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            end = mm.find(b'\n', offset)
+        return decode_record(mm[offset:end + 1])
+
+    def truncate_before(self, seq):
+        # Only whole segments are dropped, so the log never needs rewriting
+        segments = self._segments()
+        for i, segment_start in enumerate(segments[:-1]):
+            if segments[i + 1] <= seq:
+                os.remove(self._segment_file(segment_start))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+
+class StoredBlocks(Sequence):
+    """
+    A chain whose blocks stay in the block log: only their locations are
+    held, and a block is read back and decoded when it is accessed, with the
+    most recently read ones cached. Blocks appended afterwards are kept in
+    memory.
+    """
+
+    def __init__(self, log, locations, blocks=(), cache_size=4096):
+        self._log = log
+        self._locations = locations  # array('Q') of (segment start, offset) pairs; never changed in place
+        self._blocks = list(blocks)
+        self._cache = OrderedDict()  # position -> decoded block
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    @property
+    def _stored(self):
+        return len(self._locations) // 2
+
+    def __len__(self):
+        return self._stored + len(self._blocks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if start == 0 and step == 1:
+                # Prefixes, e.g. the blocks a reorganization keeps, are not read
+                stored = self._stored
+                return StoredBlocks(self._log, self._locations[:2 * min(stop, stored)],
+                                    self._blocks[:max(stop - stored, 0)], self._cache_size)
+            return [self[i] for i in range(start, stop, step)]
+        if index < 0:
+            index += len(self)
+        stored = self._stored
+        if index >= stored:
+            return self._blocks[index - stored]
+        if index < 0:
+            raise IndexError("block index out of range")
+        with self._lock:
+            block = self._cache.get(index)
+            if block is not None:
+                self._cache.move_to_end(index)
+                return block
+        block = self._log.read_at((self._locations[2 * index], self._locations[2 * index + 1]))
+        del block['hash']  # Logged with the block, held in block_hashes
+        with self._lock:
+            self._cache[index] = block
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return block
+
+    def append(self, block):
+        self._blocks.append(block)
+
+    def copy(self):
+        return StoredBlocks(self._log, self._locations, self._blocks, self._cache_size)
+
+    def __add__(self, blocks):
+        return StoredBlocks(self._log, self._locations, self._blocks + list(blocks), self._cache_size)
+
+
+class Storage:
+    """
+    Durable storage for a node.
+
+    Sealed blocks go to an append-only block log. DID registrations,
+    credential issuance, revocations and presentations go to a state journal,
+    which is compacted into a snapshot every snapshot_interval blocks. Each
+    snapshot also records the block hashes, the log location of every block
+    and the transaction index, so startup reads those back, decodes only the
+    blocks logged after the snapshot and leaves the older block bodies in the
+    log until they are accessed. Only the journal records written after the
+    snapshot are applied again.
+    """
+
+    def __init__(self, path, snapshot_interval=1000, segment_size=100000, fsync_batch=256, fsync_interval=0.05,
+                 read_only=False):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.read_only = read_only  # For tools that inspect the data of a running node
+        self.blocks = SegmentedLog(os.path.join(path, 'blocks'), segment_size, fsync_batch, fsync_interval, read_only)
+        self.journal = SegmentedLog(os.path.join(path, 'journal'), segment_size, fsync_batch, fsync_interval, read_only)
+        self.snapshot_path = os.path.join(path, 'snapshots')
+        os.makedirs(self.snapshot_path, exist_ok=True)
+        self.blockchain = None
+        self.vc_manager = None
+        self._lock = threading.Lock()
+        self._blocks_since_snapshot = 0
+        self._block_locations = array('Q')  # (segment start, offset) of every block of the chain
+        self._snapshot_lock = threading.Lock()  # One snapshot file written at a time
+        self._snapshot_thread = None
+
+    def attach(self, blockchain, vc_manager):
+        """
+        Restores persisted state into blockchain and vc_manager, then keeps
+        storage up to date with their changes.
+        """
+        self.blockchain = blockchain
+        self.vc_manager = vc_manager
+        with blockchain.lock:
+            if self.read_only:
+                self._load()
+                return
+            if self.blocks.next_seq:
+                self._load()
+            else:
+                for block, block_hash in zip(blockchain.chain, blockchain.block_hashes):
+                    self._on_chain_event('block', block, block_hash)
+            blockchain.listeners.append(self._on_chain_event)
+        vc_manager.listeners.append(self._on_credential_event)
+
+    def _load(self):
+        block_seq, block_hashes, locations, transaction_index = self._load_chain_snapshot()
+        for _, location, record in self.blocks.read_located(block_seq):
+            if record['index'] <= len(block_hashes):
+                # Blocks replaced when the node switched to a longer chain
+                del block_hashes[record['index'] - 1:], locations[2 * (record['index'] - 1):]
+                transaction_index = transaction_index.truncated(record['index'] - 1)
+            block_hashes.append(record.pop('hash'))
+            locations.extend(location)
+            transaction_index.add_block(record)
+        if block_hashes:
+            self._block_locations = locations
+            self.blockchain.load_chain(StoredBlocks(self.blocks, array('Q', locations)), block_hashes, transaction_index)
+
+        journal_start = self._load_snapshot()
+        for _, record in self.journal.read(journal_start):
+            self._apply(record)
+
+    def _newest(self, suffix):
+        names = sorted(name for name in os.listdir(self.snapshot_path) if name.endswith(suffix))
+        return os.path.join(self.snapshot_path, names[-1]) if names else None
+
+    def _load_chain_snapshot(self):
+        """
+        Returns (block log seq the chain snapshot covers, block hashes, block
+        locations, transaction index), empty if there is no chain snapshot.
+        """
+        filename = self._newest('.chain')
+        if filename is None:
+            return 0, [], array('Q'), TransactionIndex()
+        maps = {'did': {}, 'credential': {}, 'type': {}}
+        with open(filename, 'rb') as f:
+            header = decode_record(f.readline())
+            chain = decode_record(f.readline())
+            for line in f:
+                record = decode_record(line)
+                maps[record['map']][record['key']] = array('Q', record['postings'])
+        hashes = chain['hashes']
+        block_hashes = [hashes[offset:offset + 32].hex() for offset in range(0, len(hashes), 32)]
+        return header['block_seq'], block_hashes, array('Q', chain['locations']), TransactionIndex.from_maps(maps)
+
+    def _load_snapshot(self):
+        filename = self._newest('.snapshot')
+        if filename is None:
+            return 0
+        with open(filename, 'rb') as f:
+            header = decode_record(f.readline())
+            for line in f:
+                self._apply(decode_record(line))
+        return header['journal_seq']
+
+    def _apply(self, record):
+        # Journal replay must be idempotent: a snapshot can already contain
+        # changes that were journaled while it was being written.
+        kind = record['kind']
+        if kind == 'did':
+            self.blockchain.did_registry.register(record['did'], record['name'], record.get('type'))
+        elif kind == 'credential':
+            self.vc_manager.restore_credential(record['credential_id'], record['record'])
+        elif kind == 'revocation':
+            self.vc_manager.restore_revocation(record['credential_id'])
+        elif kind == 'presentation':
+            self.vc_manager.restore_presentation(record['credential_id'], record['verifier_did'], record['presented'])
+
+    def _on_chain_event(self, event, *args):
+        if event == 'block':
+            block, block_hash = args
+            _, location = self.blocks.append_located({**block, 'hash': block_hash})
+            self._block_locations.extend(location)
+            self._blocks_since_snapshot += 1
+            if self._blocks_since_snapshot >= self.snapshot_interval:
+                self._snapshot_in_background()
+        elif event == 'reorganized':
+            start, blocks, block_hashes = args
+            # Replaced in whole, as the copy a snapshot worker holds must not change
+            locations = self._block_locations[:2 * (start - 1)]
+            for block, block_hash in zip(blocks, block_hashes):
+                _, location = self.blocks.append_located({**block, 'hash': block_hash})
+                locations.extend(location)
+            self._block_locations = locations
+            self._blocks_since_snapshot += len(blocks)
+        elif event == 'did':
+            did, name, did_type = args
+            self._journal({'kind': 'did', 'did': did, 'name': name, 'type': did_type})
+
+    def _on_credential_event(self, event, credential_id, record):
+        if event == 'issued':
+            self._journal({'kind': 'credential', 'credential_id': credential_id, 'record': record})
+        elif event == 'revoked':
+            self._journal({'kind': 'revocation', 'credential_id': credential_id})
+        elif event in ('presented', 'access_revoked'):
+            self._journal({'kind': 'presentation', 'credential_id': credential_id, 'verifier_did': record,
+                           'presented': event == 'presented'})
+
+    def _journal(self, record):
+        with self._lock:
+            self.journal.append(record)
+
+    def snapshot(self):
+        """
+        Writes the current DIDs, credentials, revocations and presentations to
+        a new snapshot and drops the journal segments it makes redundant.
+        """
+        self._blocks_since_snapshot = 0
+        return self._write_snapshot(*self._copy_state())
+
+    def _snapshot_in_background(self):
+        # Called under the chain lock: only the state is copied here, it is
+        # encoded and fsynced on another thread
+        if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return  # Tried again on the next block
+        self._blocks_since_snapshot = 0
+        self._snapshot_thread = threading.Thread(
+            target=self._snapshot_worker, args=self._copy_state(), name='storage-snapshot', daemon=True)
+        self._snapshot_thread.start()
+
+    def _copy_state(self):
+        """
+        Point-in-time copy of the state to snapshot, as shallow copies of the
+        containers; records are never modified in place.
+        """
+        with self._lock:
+            # Taken before the state is copied; anything journaled concurrently is replayed again on load
+            journal_seq = self.journal.next_seq
+        did_count = len(self.blockchain.did_registry)  # DIDs are only ever appended
+        credentials = dict(self.vc_manager.credentials.items())
+        revoked = set(self.vc_manager.revoked_credentials)
+        presentations = list(self.vc_manager.presentations.items())
+        with self.blockchain.lock:
+            # Blocks are logged under the chain lock, so the log position matches the chain
+            chain = (self.blocks.next_seq, list(self.blockchain.block_hashes), array('Q', self._block_locations),
+                     self.blockchain.transaction_index.maps())
+        return journal_seq, did_count, credentials, revoked, presentations, chain
+
+    def _snapshot_worker(self, journal_seq, *state):
+        try:
+            self._write_snapshot(journal_seq, *state)
+        except Exception:
+            # The journal is only truncated after a snapshot is written, so nothing is lost
+            logger.exception("Writing the snapshot at journal record %d failed", journal_seq)
+
+    def _write_snapshot(self, journal_seq, did_count, credentials, revoked, presentations, chain):
+        with self._snapshot_lock:
+            self.blocks.sync()
+            self.journal.sync()
+            self._write_chain_snapshot(journal_seq, *chain)
+            filename = os.path.join(self.snapshot_path, f"{journal_seq:020d}.snapshot")
+            tmp_filename = filename + '.tmp'
+            with open(tmp_filename, 'wb') as f:
+                f.write(encode_record({'journal_seq': journal_seq, 'created': time()}))
+                for did in self.blockchain.did_registry.records(stop=did_count):
+                    f.write(encode_record({'kind': 'did', **did}))
+                for credential_id, record in credentials.items():
+                    f.write(encode_record({'kind': 'credential', 'credential_id': credential_id, 'record': record}))
+                for credential_id in revoked:
+                    f.write(encode_record({'kind': 'revocation', 'credential_id': credential_id}))
+                for credential_id, verifier_did in presentations:
+                    f.write(encode_record({'kind': 'presentation', 'credential_id': credential_id,
+                                           'verifier_did': verifier_did, 'presented': True}))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, filename)
+
+            for suffix in ('.snapshot', '.chain'):
+                snapshots = sorted(name for name in os.listdir(self.snapshot_path) if name.endswith(suffix))
+                for name in snapshots[:-1]:
+                    os.remove(os.path.join(self.snapshot_path, name))
+            self.journal.truncate_before(journal_seq)
+            return filename
+
+    def _write_chain_snapshot(self, journal_seq, block_seq, block_hashes, locations, maps):
+        filename = os.path.join(self.snapshot_path, f"{journal_seq:020d}.chain")
+        tmp_filename = filename + '.tmp'
+        # The posting lists keep growing after the copy, so they are cut at the copied height
+        end = pack_location(len(block_hashes) + 1, 0)
+        with open(tmp_filename, 'wb') as f:
+            f.write(encode_record({'block_seq': block_seq, 'height': len(block_hashes), 'created': time()}))
+            f.write(encode_record({
+                'hashes': b''.join(bytes.fromhex(block_hash) for block_hash in block_hashes),
+                'locations': locations.tobytes(),
+            }))
+            for name, postings_by_key in maps.items():
+                for key, postings in postings_by_key.items():
+                    postings = postings[:bisect.bisect_left(postings, end)]
+                    if postings:
+                        f.write(encode_record({'map': name, 'key': key, 'postings': postings.tobytes()}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+
+    def refresh(self):
+        # State is owned by this process alone, so there is nothing to pull in
+        pass
+
+    def close(self):
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        if self.blockchain is not None and not self.read_only:
+            self.snapshot()
+        self.blocks.close()
+        self.journal.close()
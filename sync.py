@@ -0,0 +1,313 @@
+import gzip
+import hashlib
+import json
+import logging
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from blockchain import HEADER_FORMAT, Blockchain
+from consensus import Authority
+from merkle import merkle_root
+from txindex import DID_FIELDS
+
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAX_HEADERS = 50000  # Per /headers response, about 4.4 MB
+MAX_BLOCKS = 2000  # Per /blocks response
+
+logger = logging.getLogger(__name__)
+
+
+def encode_blocks(blocks):
+    """
+    gzip-compressed newline-delimited JSON, as served by /blocks.
+    """
+    lines = b''.join(json.dumps(block, separators=(',', ':')).encode('utf-8') + b'\n' for block in blocks)
+    return gzip.compress(lines, compresslevel=1)
+
+
+def decode_blocks(data):
+    try:
+        lines = gzip.decompress(data).splitlines()
+    except (OSError, EOFError, zlib.error) as e:
+        raise SyncError(f"Malformed blocks response: {e!r}") from e
+    return [json.loads(line) for line in lines if line]
+
+
+def unpack_headers(data):
+    """
+    Splits a /headers response into (header fields, header hash) pairs.
+    """
+    headers = []
+    for offset in range(0, len(data) - len(data) % HEADER_SIZE, HEADER_SIZE):
+        raw = data[offset:offset + HEADER_SIZE]
+        index, timestamp, previous_hash, root, proof = struct.unpack(HEADER_FORMAT, raw)
+        headers.append(({
+            'index': index,
+            'timestamp': timestamp,
+            'previous_hash': previous_hash.hex(),
+            'merkle_root': root.hex(),
+            'proof': proof,
+        }, hashlib.sha256(raw).hexdigest()))
+    return headers
+
+
+class SyncError(Exception):
+    pass
+
+
+def check_block(block, index, block_hash):
+    """
+    Raises SyncError unless a block received from a peer has the shape the
+    chain, its index and the DID registry rely on, and matches its header.
+    """
+    if not isinstance(block, dict) or not isinstance(block.get('transactions'), list):
+        raise SyncError(f"Block {index} is malformed")
+    for transaction in block['transactions']:
+        data = transaction.get('data') if isinstance(transaction, dict) else None
+        if not isinstance(data, dict) or not isinstance(transaction.get('type'), str):
+            raise SyncError(f"Block {index} has a malformed transaction")
+        if any(data.get(field) is not None and not isinstance(data[field], str)
+               for field in ('credential_id',) + DID_FIELDS):
+            raise SyncError(f"Block {index} has a transaction with a malformed id")
+        if transaction['type'] == 'DID_REGISTRATION' and (not data.get('did') or 'name' not in data):
+            raise SyncError(f"Block {index} has a malformed DID registration")
+    try:
+        if merkle_root(block['transactions']) != block['merkle_root']:
+            raise SyncError(f"Block {index} does not match its Merkle root")
+        if Blockchain.hash(block) != block_hash:
+            raise SyncError(f"Block {index} does not match its header")
+    except (KeyError, TypeError, ValueError, AttributeError, struct.error) as e:
+        raise SyncError(f"Block {index} is malformed: {e!r}") from e
+
+
+class Peer:
+    """
+    HTTP client for another node's sync endpoints.
+    """
+
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _get(self, path, **params):
+        url = f"{self.url}{path}?{urlencode(params)}" if params else self.url + path
+        with urlopen(Request(url), timeout=self.timeout) as response:
+            return response.read()
+
+    def head(self):
+        return json.loads(self._get('/chain_head'))
+
+    def headers(self, start, limit):
+        return unpack_headers(self._get('/headers', start=start, limit=limit))
+
+    def blocks(self, start, limit):
+        return decode_blocks(self._get('/blocks', start=start, limit=limit))
+
+
+class NodeSync:
+    """
+    Keeps the local chain in line with a set of peers.
+
+    Headers are fetched first, in bulk, and checked for linkage and proof of
+    work before any transactions are downloaded; then only the missing block
+    range is fetched as compressed batches, several in parallel. A peer's
+    chain is adopted when it is longer than the local one, starts at the
+    pinned genesis block and is fully valid, even if that means replacing
+    local blocks after a fork. Peers are trusted to be who the operator
+    configured; under authority consensus headers carry no proof of their own.
+
+    :param genesis_hash: <str> Hash of the genesis block every adopted chain must start with;
+        defaults to the local genesis block
+    """
+
+    def __init__(self, blockchain, peers=(), consensus=None, header_batch=MAX_HEADERS, block_batch=MAX_BLOCKS,
+                 fetch_workers=4, genesis_hash=None):
+        self.blockchain = blockchain
+        self.consensus = consensus or getattr(blockchain, 'consensus', None) or Authority()
+        self._genesis_hash = genesis_hash
+        self.header_batch = header_batch
+        self.block_batch = block_batch
+        self.fetch_workers = fetch_workers
+        self._peers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        for url in peers:
+            self.add_peer(url)
+
+    def add_peer(self, url):
+        peer = Peer(url)
+        with self._lock:
+            self._peers.setdefault(peer.url, peer)
+        return peer.url
+
+    def remove_peer(self, url):
+        with self._lock:
+            return self._peers.pop(url.rstrip('/'), None) is not None
+
+    @property
+    def peers(self):
+        with self._lock:
+            return list(self._peers)
+
+    @property
+    def genesis_hash(self):
+        return self._genesis_hash or self.blockchain.block_hashes[0]
+
+    def sync(self):
+        """
+        Syncs with every peer in turn. Returns one report per peer.
+        """
+        with self._lock:
+            peers = list(self._peers.values())
+        reports = []
+        for peer in peers:
+            try:
+                reports.append(self.sync_with(peer))
+            except (OSError, ValueError, SyncError) as e:
+                reports.append({"peer": peer.url, "adopted": False, "error": str(e)})
+            except Exception as e:
+                # Anything else is a bug, but one peer must not stop the others from being synced
+                logger.exception("Syncing with %s failed", peer.url)
+                reports.append({"peer": peer.url, "adopted": False, "error": repr(e)})
+        return reports
+
+    def sync_with(self, peer):
+        began = perf_counter()
+        head = peer.head()
+        if not isinstance(head, dict) or not isinstance(head.get('height'), int):
+            raise SyncError("Peer returned a malformed chain head")
+        height = len(self.blockchain.chain)
+        report = {"peer": peer.url, "peer_height": head['height'], "local_height": height, "adopted": False}
+        if head['height'] <= height:
+            return report  # Only a strictly longer chain replaces ours
+
+        fork = self._find_fork(peer, min(height, head['height']))
+        if fork and self.blockchain.block_hashes[0] != self.genesis_hash:
+            raise SyncError("Peer shares a chain that does not start at the pinned genesis block")
+        headers = self._fetch_headers(peer, fork + 1, head['height'])
+        blocks = self._fetch_blocks(peer, headers)
+        start = fork + 1
+        with self.blockchain.lock:
+            if start > 1 and self.blockchain.block_hashes[start - 2] != headers[0][0]['previous_hash'] \
+                    or len(self.blockchain.chain) >= head['height']:
+                raise SyncError("Local chain changed during sync")
+            dropped = self.blockchain.replace_blocks(start, blocks, [block_hash for _, block_hash in headers])
+            self._apply(blocks, dropped)
+        elapsed = perf_counter() - began
+        report.update({
+            "adopted": True,
+            "fork_height": fork,
+            "blocks_fetched": len(blocks),
+            "blocks_dropped": len(dropped),
+            "elapsed_seconds": elapsed,
+            "blocks_per_second": len(blocks) / elapsed if elapsed else None,
+        })
+        return report
+
+    def _find_fork(self, peer, height):
+        """
+        Highest index at which both chains have the same block, found by
+        binary search over single headers. 0 if even the genesis blocks differ.
+        """
+        if height and self._peer_hash(peer, height) == self.blockchain.block_hashes[height - 1]:
+            return height
+        low, high = 0, height  # Invariant: chains agree up to low and differ at high
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self._peer_hash(peer, middle) == self.blockchain.block_hashes[middle - 1]:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    @staticmethod
+    def _peer_hash(peer, index):
+        headers = peer.headers(index, 1)
+        if not headers:
+            raise SyncError(f"Peer has no header at {index}")
+        return headers[0][1]
+
+    def _fetch_headers(self, peer, start, end):
+        headers = []
+        previous_hash = self.blockchain.block_hashes[start - 2] if start > 1 else None
+        while start <= end:
+            batch = peer.headers(start, min(self.header_batch, end - start + 1))
+            if not batch:
+                raise SyncError(f"Peer returned no headers from {start}")
+            for header, block_hash in batch:
+                if header['index'] != start:
+                    raise SyncError(f"Expected header {start}, got {header['index']}")
+                if previous_hash is not None and header['previous_hash'] != previous_hash:
+                    raise SyncError(f"Header {start} does not link to the previous block")
+                if start == 1 and block_hash != self.genesis_hash:
+                    raise SyncError("Peer chain does not start at the pinned genesis block")
+                if start > 1 and not self.consensus.verify(block_hash):
+                    raise SyncError(f"Header {start} does not carry a valid proof")
+                previous_hash = block_hash
+                start += 1
+            headers.extend(batch)
+        return headers
+
+    def _fetch_blocks(self, peer, headers):
+        first = headers[0][0]['index']
+        ranges = [(first + i, min(self.block_batch, len(headers) - i)) for i in range(0, len(headers), self.block_batch)]
+        with ThreadPoolExecutor(self.fetch_workers) as pool:
+            batches = pool.map(lambda r: peer.blocks(*r), ranges)
+            blocks = []
+            for batch in batches:
+                for block in batch:
+                    if len(blocks) == len(headers):
+                        raise SyncError(f"Peer returned more than the {len(headers)} blocks requested")
+                    header, block_hash = headers[len(blocks)]
+                    check_block(block, header['index'], block_hash)  # Before the chain lock is taken
+                    blocks.append(block)
+        if len(blocks) != len(headers):
+            raise SyncError(f"Peer returned {len(blocks)} of {len(headers)} blocks")
+        return blocks
+
+    def _apply(self, blocks, dropped):
+        # DIDs registered on the adopted chain become resolvable here as well
+        registry = self.blockchain.did_registry
+        for block in blocks:
+            for transaction in block['transactions']:
+                if transaction['type'] == 'DID_REGISTRATION':
+                    data = transaction['data']
+                    registry.register(data['did'], data['name'], data.get('type'))
+                    for listener in self.blockchain.listeners:
+                        listener('did', data['did'], data['name'], registry.get_did_type(data['did']))
+        if not dropped:
+            return
+        # Transactions only the dropped blocks had go back into the mempool
+        adopted = {json.dumps(transaction, sort_keys=True) for block in blocks for transaction in block['transactions']}
+        for block in dropped:
+            for transaction in block['transactions']:
+                if json.dumps(transaction, sort_keys=True) not in adopted:
+                    self.blockchain.new_transaction(transaction['type'], transaction['data'])
+
+    def start(self, interval):
+        """
+        Syncs with all peers every interval seconds on a background thread.
+        """
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='node-sync', daemon=True)
+        self._thread.start()
+
+    def _run(self, interval):
+        while not self._stopping.wait(interval):
+            try:
+                self.sync()
+            except Exception:
+                logger.exception("Periodic sync failed")  # Tried again on the next round
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
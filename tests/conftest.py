@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the repository root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blockchain import Blockchain  # noqa: E402
+from keystore import ED25519, KeyStore  # noqa: E402
+from vc import VerifiableCredential  # noqa: E402
+
+
+@pytest.fixture
+def keystore():
+    # Ed25519 keys are generated in microseconds, unlike the RSA default
+    return KeyStore(default_algorithm=ED25519)
+
+
+@pytest.fixture
+def make_node(keystore):
+    """
+    Builds (blockchain, vc_manager) pairs that share the keystore, like the
+    nodes of one operator.
+    """
+    def make_node(**blockchain_options):
+        return Blockchain(**blockchain_options), VerifiableCredential(keystore)
+    return make_node
+
+
+def issue(blockchain, vc_manager, issuer_did, subject_did, claims=None):
+    """
+    Issues a credential and anchors it the way the issue_credential route does.
+    """
+    credential = vc_manager.create_credential(issuer_did, subject_did, claims or {'valid_date': '2030-01-01'})
+    blockchain.submit_transaction('VC_ISSUANCE', {
+        'issuer_did': issuer_did,
+        'subject_did': subject_did,
+        'credential_id': credential['credential_id'],
+    })
+    return credential['credential_id']
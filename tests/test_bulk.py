@@ -0,0 +1,144 @@
+import json
+
+import pytest
+
+from bulk import Importer, _read_checkpoint, _write_checkpoint, export_records
+from conftest import issue
+from storage import decode_record, encode_record
+
+
+@pytest.fixture
+def exported(make_node, keystore):
+    """
+    NDJSON lines exported from a node holding DIDs, credentials, a
+    revocation and a presentation.
+    """
+    blockchain, vc_manager = make_node()
+    keystore.create_key('did:issuer')
+    blockchain.add_did('did:issuer', 'Issuer', 'issuer')
+    for i in range(10):
+        blockchain.add_did(f'did:holder{i}', f'Holder {i}', 'holder')
+    credential_ids = [issue(blockchain, vc_manager, 'did:issuer', f'did:holder{i}', {'n': i}) for i in range(20)]
+    vc_manager.revoke_credential(credential_ids[0])
+    vc_manager.present_credential(credential_ids[1], 'did:verifier')
+    blockchain.new_block()
+    return list(export_records(blockchain, vc_manager, chunk_size=7)), credential_ids
+
+
+def anchored(blockchain, transaction_type):
+    return [transaction['data'] for block in blockchain.chain for transaction in block['transactions']
+            if transaction['type'] == transaction_type]
+
+
+def assert_imported(blockchain, vc_manager, credential_ids):
+    assert len(blockchain.dids) == 11
+    assert set(vc_manager.credentials) == set(credential_ids)
+    assert vc_manager.revoked_credentials == {credential_ids[0]}
+    assert vc_manager.presentations.is_presented(credential_ids[1], 'did:verifier')
+    assert all(vc_manager.verify_credential(credential_id) for credential_id in credential_ids[1:])
+    # Every record is anchored exactly once
+    issuances = [data['credential_id'] for data in anchored(blockchain, 'VC_ISSUANCE')]
+    assert sorted(issuances) == sorted(credential_ids)
+    assert sorted(data['did'] for data in anchored(blockchain, 'DID_REGISTRATION')) == \
+        sorted(record['did'] for record in blockchain.did_registry.records())
+    assert [data['credential_id'] for data in anchored(blockchain, 'VC_REVOCATION')] == [credential_ids[0]]
+
+
+def test_export_lines_are_ndjson_records(exported):
+    lines, credential_ids = exported
+    records = [decode_record(line) for line in lines]
+    assert all(line.endswith(b'\n') and line.count(b'\n') == 1 for line in lines)
+    kinds = [record['kind'] for record in records]
+    assert kinds == sorted(kinds, key=['did', 'credential', 'revocation', 'presentation'].index)
+    assert kinds.count('did') == 11 and kinds.count('credential') == 20
+
+
+def test_import_into_a_new_node(exported, make_node):
+    lines, credential_ids = exported
+    blockchain, vc_manager = make_node()
+    reports = list(Importer(blockchain, vc_manager, batch_size=8).run(lines))
+    assert [report['line'] for report in reports] == list(range(8, len(lines), 8)) + [len(lines)]
+    assert all(report['errors'] == 0 for report in reports)
+    # One block per batch; the last batch only holds the presentation, which is not anchored
+    assert [report['block_index'] for report in reports] == [2, 3, 4, 5, None]
+    assert_imported(blockchain, vc_manager, credential_ids)
+
+
+def test_resume_with_skip_after_an_interruption(exported, make_node):
+    lines, credential_ids = exported
+    blockchain, vc_manager = make_node()
+    reports = Importer(blockchain, vc_manager, batch_size=8).run(lines)
+    committed = next(reports)['line']
+    next(reports)
+    reports.close()  # Interrupted after the second batch, whose report was lost
+
+    resumed = list(Importer(blockchain, vc_manager, batch_size=8).run(lines, skip=committed))
+    assert resumed[0]['skipped'] == 8 and resumed[0]['anchored'] == 0
+    assert resumed[-1]['line'] == len(lines)
+    assert_imported(blockchain, vc_manager, credential_ids)
+
+
+def test_applied_records_are_anchored_when_their_block_was_lost(exported, make_node, monkeypatch):
+    lines, credential_ids = exported
+    blockchain, vc_manager = make_node()
+
+    def crash(transactions):
+        raise RuntimeError("node stopped before sealing")
+
+    monkeypatch.setattr(blockchain, 'submit_batch', crash)
+    with pytest.raises(RuntimeError):
+        list(Importer(blockchain, vc_manager, batch_size=8).run(lines))
+    monkeypatch.undo()
+
+    reports = list(Importer(blockchain, vc_manager, batch_size=8).run(lines))
+    assert reports[0]['skipped'] == 8 and reports[0]['anchored'] == 8
+    assert_imported(blockchain, vc_manager, credential_ids)
+
+
+def test_replaying_a_finished_import_changes_nothing(exported, make_node):
+    lines, credential_ids = exported
+    blockchain, vc_manager = make_node()
+    list(Importer(blockchain, vc_manager).run(lines))
+    height = len(blockchain.chain)
+    [report] = Importer(blockchain, vc_manager).run(lines)
+    assert report['anchored'] == 0 and report['block_index'] is None and report['errors'] == 0
+    assert report['skipped'] == len(lines)
+    assert len(blockchain.chain) == height
+
+
+def test_claims_are_issued_once_across_a_resume(make_node, keystore):
+    blockchain, vc_manager = make_node()
+    keystore.create_key('did:issuer')
+    lines = [encode_record({'kind': 'credential', 'credential_id': f'c{i}', 'issuer_did': 'did:issuer',
+                            'subject_did': 'did:holder', 'claims': {'n': i}}) for i in range(10)]
+    reports = Importer(blockchain, vc_manager, batch_size=4).run(lines)
+    next(reports)
+    reports.close()
+    signatures = {credential_id: vc_manager.credentials[credential_id].signature for credential_id in ('c0', 'c3')}
+
+    list(Importer(blockchain, vc_manager, batch_size=4).run(lines))
+    assert set(vc_manager.credentials) == {f'c{i}' for i in range(10)}
+    assert {credential_id: vc_manager.credentials[credential_id].signature for credential_id in signatures} == signatures
+    assert sorted(data['credential_id'] for data in anchored(blockchain, 'VC_ISSUANCE')) == sorted(f'c{i}' for i in range(10))
+
+
+def test_invalid_lines_are_reported_and_the_rest_imported(exported, make_node):
+    lines, credential_ids = exported
+    position = next(i for i, line in enumerate(lines) if credential_ids[5].encode() in line)
+    record = decode_record(lines[position])
+    record['record']['signature'] = bytes(64)
+    tampered = encode_record(record)
+    blockchain, vc_manager = make_node()
+    [report] = Importer(blockchain, vc_manager).run([b'not json\n'] + lines[:position] + [tampered] + lines[position + 1:])
+    assert [error['line'] for error in report['error_lines']] == [1, position + 2]
+    assert report['credential'] == 19
+    assert record['credential_id'] not in vc_manager.credentials
+
+
+def test_checkpoint_round_trip(tmp_path):
+    path = str(tmp_path / 'checkpoint')
+    assert _read_checkpoint(path) == 0
+    _write_checkpoint(path, 4000)
+    assert _read_checkpoint(path) == 4000
+    with open(path) as f:
+        assert json.load(f) == {'line': 4000}
@@ -0,0 +1,67 @@
+import hashlib
+import struct
+
+import pytest
+
+from blockchain import Blockchain, block_header, header_bytes, header_prefix
+from consensus import Authority, ProofOfWork, meets_difficulty, search_nonces, target_for
+
+
+def template():
+    return {
+        'index': 2,
+        'timestamp': 1700000000.0,
+        'transactions': [],
+        'merkle_root': hashlib.sha256(b'').hexdigest(),
+        'proof': 0,
+        'previous_hash': 'ab' * 32,
+    }
+
+
+def test_midstate_search_matches_hashing_the_whole_header():
+    header = template()
+    target = target_for(8)
+    proof, hashes = search_nonces(header_prefix(header), target, 0, 1 << 16)
+    assert proof is not None and hashes == proof + 1
+    block_hash = hashlib.sha256(header_bytes({**header, 'proof': proof})).digest()
+    assert block_hash < target
+    # No smaller proof satisfies the target
+    for smaller in range(proof):
+        assert hashlib.sha256(header_bytes({**header, 'proof': smaller})).digest() >= target
+
+
+def test_prefix_is_the_header_without_its_proof():
+    header = template()
+    packed = header_bytes({**header, 'proof': 12345})
+    assert packed == header_prefix(header) + struct.pack('>Q', 12345)
+
+
+def test_search_reports_ranges_without_a_proof():
+    assert search_nonces(header_prefix(template()), bytes(32), 10, 50) == (None, 50)
+
+
+def test_proof_of_work_blocks_meet_the_difficulty():
+    blockchain = Blockchain(consensus=ProofOfWork(difficulty=10, workers=1))
+    blockchain.new_transaction('DID_REGISTRATION', {'did': 'd1', 'name': 'n', 'type': 'holder'})
+    block = blockchain.new_block()
+    block_hash = blockchain.block_hashes[-1]
+    assert block_hash == Blockchain.hash(block) == hashlib.sha256(header_bytes(block_header(block))).hexdigest()
+    assert meets_difficulty(block_hash, 10)
+    assert blockchain.consensus.verify(block_hash)
+    assert blockchain.consensus.stats()['blocks_mined'] == 1
+
+
+def test_parallel_search_finds_a_valid_proof():
+    consensus = ProofOfWork(difficulty=12, workers=2, chunk_size=1 << 10)
+    try:
+        proof = consensus.seal(header_prefix(template()))
+    finally:
+        consensus.shutdown()
+    block_hash = hashlib.sha256(header_bytes({**template(), 'proof': proof})).hexdigest()
+    assert meets_difficulty(block_hash, 12)
+
+
+def test_difficulty_bounds():
+    with pytest.raises(ValueError):
+        ProofOfWork(difficulty=0)
+    assert Authority().verify('f' * 64)
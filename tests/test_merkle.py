@@ -0,0 +1,46 @@
+import pytest
+
+from merkle import EMPTY_ROOT, merkle_proof, merkle_root, verify_proof
+
+
+def transactions(count):
+    return [{'type': 'VC_ISSUANCE', 'data': {'credential_id': f'c{i}'}} for i in range(count)]
+
+
+def test_empty_block_has_the_empty_root():
+    assert merkle_root([]) == EMPTY_ROOT
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 4, 5, 7, 8, 33])
+def test_every_position_proves_inclusion(count):
+    items = transactions(count)
+    root = merkle_root(items)
+    for position, transaction in enumerate(items):
+        assert verify_proof(transaction, merkle_proof(items, position), root)
+
+
+def test_proof_does_not_verify_another_transaction():
+    items = transactions(6)
+    root = merkle_root(items)
+    proof = merkle_proof(items, 2)
+    assert not verify_proof(items[3], proof, root)
+    assert not verify_proof({'type': 'VC_ISSUANCE', 'data': {'credential_id': 'forged'}}, proof, root)
+
+
+def test_tampered_proof_is_rejected():
+    items = transactions(5)
+    root = merkle_root(items)
+    proof = merkle_proof(items, 1)
+    proof[0] = {**proof[0], 'side': 'right' if proof[0]['side'] == 'left' else 'left'}
+    assert not verify_proof(items[1], proof, root)
+
+
+def test_inner_node_cannot_pass_as_a_leaf():
+    # Leaves and inner nodes are hashed with different prefixes
+    items = transactions(2)
+    assert merkle_root(items) != merkle_root([items[0]]) != merkle_root([items[0], items[0]])
+
+
+def test_position_out_of_range():
+    with pytest.raises(IndexError):
+        merkle_proof(transactions(3), 3)
@@ -0,0 +1,101 @@
+import threading
+from concurrent.futures import wait
+
+import pytest
+
+from blockchain import Blockchain
+from consensus import Authority
+
+
+def did_registration(i):
+    return {'did': f'did:{i}', 'name': 'n', 'type': 'holder'}
+
+
+@pytest.fixture
+def blockchain():
+    blockchain = Blockchain(max_block_transactions=10, max_block_latency=0.05)
+    blockchain.start_sealer()
+    yield blockchain
+    blockchain.stop_sealer()
+
+
+def sealed_transactions(blockchain):
+    return [transaction for block in blockchain.chain[1:] for transaction in block['transactions']]
+
+
+def test_receipts_resolve_to_the_block_holding_the_transaction(blockchain):
+    receipts = [blockchain.submit_transaction('DID_REGISTRATION', did_registration(i)) for i in range(25)]
+    for i, receipt in enumerate(receipts):
+        block = receipt.result(timeout=10)
+        assert {'type': 'DID_REGISTRATION', 'data': did_registration(i)} in block['transactions']
+        assert blockchain.chain[block['index'] - 1] is block
+
+
+def test_full_mempool_is_sealed_without_waiting_for_the_latency():
+    blockchain = Blockchain(max_block_transactions=10, max_block_latency=60)
+    blockchain.start_sealer()
+    try:
+        receipts = [blockchain.submit_transaction('DID_REGISTRATION', did_registration(i)) for i in range(10)]
+        blocks = [receipt.result(timeout=10) for receipt in receipts]
+        assert sum(len(block['transactions']) for block in {block['index']: block for block in blocks}.values()) == 10
+    finally:
+        blockchain.stop_sealer(flush=False)
+
+
+def test_batch_is_sealed_into_one_block(blockchain):
+    block = blockchain.submit_transactions('DID_REGISTRATION', [did_registration(i) for i in range(40)]).result(timeout=10)
+    assert len(block['transactions']) == 40
+    assert [transaction['data'] for transaction in block['transactions']] == [did_registration(i) for i in range(40)]
+
+
+def test_concurrent_submitters_are_sealed_exactly_once(blockchain):
+    receipts = []
+    receipts_lock = threading.Lock()
+
+    def submit(worker):
+        for i in range(50):
+            receipt = blockchain.submit_transaction('DID_REGISTRATION', did_registration(f'{worker}-{i}'))
+            with receipts_lock:
+                receipts.append(receipt)
+
+    threads = [threading.Thread(target=submit, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wait(receipts, timeout=10)
+    dids = [transaction['data']['did'] for transaction in sealed_transactions(blockchain)]
+    assert sorted(dids) == sorted(f'did:{worker}-{i}' for worker in range(4) for i in range(50))
+    for index, block in enumerate(blockchain.chain[1:], start=1):
+        assert block['previous_hash'] == blockchain.block_hashes[index - 1]
+
+
+def test_stop_flushes_the_mempool():
+    blockchain = Blockchain(max_block_transactions=100, max_block_latency=60)
+    blockchain.start_sealer()
+    receipt = blockchain.submit_transaction('DID_REGISTRATION', did_registration(1))
+    blockchain.stop_sealer()
+    assert receipt.result(timeout=1)['index'] == 2
+
+
+class FailingOnce(Authority):
+    def __init__(self):
+        self.failed = False
+
+    def seal(self, prefix):
+        if not self.failed:
+            self.failed = True
+            raise RuntimeError("sealing failed")
+        return 0
+
+
+def test_failed_seal_fails_its_receipts_and_the_sealer_keeps_running():
+    blockchain = Blockchain(max_block_latency=0.01, consensus=FailingOnce())
+    blockchain.start_sealer()
+    try:
+        with pytest.raises(RuntimeError):
+            blockchain.submit_transaction('DID_REGISTRATION', did_registration(1)).result(timeout=10)
+        block = blockchain.submit_transaction('DID_REGISTRATION', did_registration(2)).result(timeout=10)
+        assert block['transactions'] == [{'type': 'DID_REGISTRATION', 'data': did_registration(2)}]
+    finally:
+        blockchain.stop_sealer()
@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+
+from sqlstore import SQLiteStorage
+from statuslist import StatusListRegistry
+
+
+@pytest.fixture
+def workers(tmp_path, make_node, keystore):
+    """
+    Attaches worker nodes to one database, like the processes of a node
+    started with several gunicorn workers.
+    """
+    keystore.create_key('did:issuer')
+    started = []
+
+    def start():
+        blockchain, vc_manager = make_node()
+        storage = SQLiteStorage(str(tmp_path / 'state.db'))
+        storage.attach(blockchain, vc_manager)
+        started.append(storage)
+        return blockchain, vc_manager, storage
+    yield start
+    for storage in started:
+        storage.close()
+
+
+def status_index(credential):
+    return int(credential['credential']['credentialStatus']['statusListIndex'])
+
+
+def test_workers_lease_disjoint_status_indexes(workers):
+    nodes = [workers() for _ in range(3)]
+    issued = [[] for _ in nodes]
+
+    def issue(worker):
+        _, vc_manager, _ = nodes[worker]
+        for i in range(150):
+            issued[worker].append(vc_manager.create_credential('did:issuer', 'did:holder', {'n': i}))
+
+    threads = [threading.Thread(target=issue, args=(worker,)) for worker in range(len(nodes))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    indexes = [status_index(credential) for credentials in issued for credential in credentials]
+    assert len(set(indexes)) == len(indexes) == 450
+
+
+def test_reservations_are_atomic_across_connections(workers):
+    storages = [workers()[2] for _ in range(2)]
+    starts = []
+    starts_lock = threading.Lock()
+
+    def reserve(storage):
+        for _ in range(100):
+            start = storage.reserve_status_indexes('did:other', 7)
+            with starts_lock:
+                starts.append(start)
+
+    threads = [threading.Thread(target=reserve, args=(storage,)) for storage in storages for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(starts) == list(range(0, 400 * 7, 7))
+
+
+def test_claiming_an_index_the_counter_passed_fails(workers):
+    _, _, storage = workers()
+    assert storage.reserve_status_indexes('did:other', 10) == 0
+    assert storage.reserve_status_indexes('did:other', 1, 5) is None
+    assert storage.reserve_status_indexes('did:other', 1, 20) == 20
+    assert storage.reserve_status_indexes('did:other', 1) == 21
+
+
+def test_restarted_worker_continues_after_leased_indexes(workers):
+    _, vc_manager, storage = workers()
+    first = vc_manager.create_credential('did:issuer', 'did:holder', {'n': 1})
+    storage.close()
+
+    # A lease is not given back on restart, so the new worker starts after it
+    _, restarted_vc, _ = workers()
+    second = restarted_vc.create_credential('did:issuer', 'did:holder', {'n': 2})
+    assert status_index(second) >= status_index(first) + StatusListRegistry().lease_size
+    assert first['credential_id'] in restarted_vc.credentials
+
+
+def test_workers_see_each_others_credentials(workers):
+    _, vc_manager, storage = workers()
+    _, other_vc, other = workers()
+    credential = vc_manager.create_credential('did:issuer', 'did:holder', {'n': 1})
+    storage.flush()
+    other.refresh(force=True)
+    assert other_vc.verify_credential(credential['credential_id'])
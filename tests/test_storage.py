@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+from conftest import issue
+from merkle import verify_proof
+from storage import Storage, StoredBlocks
+
+
+@pytest.fixture
+def node(tmp_path, make_node, keystore):
+    """
+    Starts a node on the data directory; calling it again after the previous
+    node is dropped or closed simulates a restart.
+    """
+    def start(**options):
+        blockchain, vc_manager = make_node()
+        storage = Storage(str(tmp_path / 'data'), **options)
+        storage.attach(blockchain, vc_manager)
+        return blockchain, vc_manager, storage
+    return start
+
+
+def populate(blockchain, vc_manager, keystore, credentials=6):
+    keystore.create_key('did:issuer')
+    blockchain.add_did('did:issuer', 'Issuer', 'issuer')
+    blockchain.add_did('did:holder', 'Holder', 'holder')
+    blockchain.new_block()
+    credential_ids = []
+    for i in range(credentials):
+        credential_ids.append(issue(blockchain, vc_manager, 'did:issuer', 'did:holder', {'n': i}))
+        blockchain.new_block()
+    vc_manager.revoke_credential(credential_ids[0])
+    blockchain.submit_transaction('VC_REVOCATION', {'credential_id': credential_ids[0]})
+    vc_manager.present_credential(credential_ids[1], 'did:verifier')
+    blockchain.new_block()
+    return credential_ids
+
+
+def assert_same_state(before, after, credential_ids):
+    blockchain, vc_manager = before
+    restored_chain, restored_vc = after
+    assert restored_chain.block_hashes == blockchain.block_hashes
+    assert list(restored_chain.chain) == list(blockchain.chain)
+    assert restored_chain.dids == blockchain.dids
+    assert restored_vc.revoked_credentials == {credential_ids[0]}
+    assert restored_vc.presentations.is_presented(credential_ids[1], 'did:verifier')
+    for credential_id in credential_ids:
+        assert restored_vc.verify_credential(credential_id) == (credential_id != credential_ids[0])
+    for credential_id in credential_ids:
+        proofs = restored_chain.inclusion_proofs(credential_id)
+        assert proofs and all(verify_proof(p['transaction'], p['proof'], p['header']['merkle_root']) for p in proofs)
+
+
+def test_restart_replays_the_logs_without_a_snapshot(node, keystore):
+    blockchain, vc_manager, storage = node(snapshot_interval=1000)
+    credential_ids = populate(blockchain, vc_manager, keystore)
+    # Dropped without close(), as after a crash: nothing but the logs is on disk
+    assert not os.listdir(storage.snapshot_path)
+
+    restored_chain, restored_vc, _ = node(snapshot_interval=1000)
+    assert_same_state((blockchain, vc_manager), (restored_chain, restored_vc), credential_ids)
+
+
+def test_restart_from_a_snapshot_and_the_blocks_after_it(node, keystore):
+    blockchain, vc_manager, storage = node(snapshot_interval=1000)
+    credential_ids = populate(blockchain, vc_manager, keystore)
+    storage.snapshot()
+    credential_ids.append(issue(blockchain, vc_manager, 'did:issuer', 'did:holder', {'after': 'snapshot'}))
+    blockchain.new_block()
+    storage.blocks.sync()
+
+    restored_chain, restored_vc, restored = node(snapshot_interval=1000)
+    assert_same_state((blockchain, vc_manager), (restored_chain, restored_vc), credential_ids)
+    # Blocks covered by the snapshot stay in the log until they are read
+    assert isinstance(restored_chain.chain, StoredBlocks)
+    assert restored_chain.find_transactions(did='did:holder', limit=1000)[0] == \
+        blockchain.find_transactions(did='did:holder', limit=1000)[0]
+
+    # The restored node keeps appending where the old one stopped
+    restored_chain.new_block()
+    restored.close()
+    again_chain, _, _ = node()
+    assert again_chain.block_hashes == restored_chain.block_hashes
+
+
+def test_background_snapshots_during_sealing(node, keystore):
+    blockchain, vc_manager, storage = node(snapshot_interval=2)
+    credential_ids = populate(blockchain, vc_manager, keystore, credentials=9)
+    storage.close()
+    assert any(name.endswith('.chain') for name in os.listdir(storage.snapshot_path))
+
+    restored_chain, restored_vc, _ = node(snapshot_interval=2)
+    assert_same_state((blockchain, vc_manager), (restored_chain, restored_vc), credential_ids)
+
+
+def test_torn_block_record_is_cut_off(node, keystore):
+    blockchain, vc_manager, storage = node()
+    populate(blockchain, vc_manager, keystore, credentials=2)
+    storage.blocks.close()
+    segment = os.path.join(storage.blocks.path, sorted(os.listdir(storage.blocks.path))[-1])
+    with open(segment, 'ab') as f:
+        f.write(b'{"index": 99, "transac')  # A write interrupted by a crash
+
+    restored_chain, _, _ = node()
+    assert restored_chain.block_hashes == blockchain.block_hashes
+    restored_chain.new_block()
+    assert restored_chain.chain[-1]['index'] == len(blockchain.chain) + 1
+
+
+def test_replaced_blocks_are_not_restored(node, keystore, make_node):
+    blockchain, vc_manager, storage = node(snapshot_interval=1000)
+    populate(blockchain, vc_manager, keystore, credentials=3)
+    storage.snapshot()
+
+    # A longer chain that forks after block 2, as adopted from a peer
+    other, _ = make_node()
+    other.load_chain(blockchain.chain[:2], blockchain.block_hashes[:2])
+    for i in range(6):
+        other.new_transaction('DID_REGISTRATION', {'did': f'did:fork{i}', 'name': 'n', 'type': 'holder'})
+        other.new_block()
+    with blockchain.lock:
+        blockchain.replace_blocks(3, other.chain[2:], other.block_hashes[2:])
+    storage.blocks.sync()
+
+    restored_chain, _, _ = node(snapshot_interval=1000)
+    assert restored_chain.block_hashes == other.block_hashes
+    assert list(restored_chain.chain) == list(other.chain)
+    assert restored_chain.find_transactions(did='did:fork5')[0][0]['data']['did'] == 'did:fork5'
+    assert restored_chain.find_transactions(did='did:holder', transaction_type='VC_ISSUANCE')[0] == []
@@ -0,0 +1,179 @@
+import gzip
+
+import pytest
+
+from blockchain import Blockchain
+from consensus import ProofOfWork
+from sync import NodeSync, SyncError, decode_blocks, encode_blocks, unpack_headers
+
+
+class LocalPeer:
+    """
+    Serves a chain through the same encodings as the /chain_head, /headers
+    and /blocks routes, and counts the requests.
+    """
+
+    def __init__(self, blockchain, url='http://peer'):
+        self.blockchain = blockchain
+        self.url = url
+        self.requests = {'headers': 0, 'blocks': 0}
+
+    def head(self):
+        return {'height': len(self.blockchain.chain), 'hash': self.blockchain.block_hashes[-1]}
+
+    def headers(self, start, limit):
+        self.requests['headers'] += 1
+        return unpack_headers(self.blockchain.headers(start, limit))
+
+    def blocks(self, start, limit):
+        self.requests['blocks'] += 1
+        return decode_blocks(encode_blocks(self.blockchain.chain[start - 1:start - 1 + limit]))
+
+
+class MalformedPeer(LocalPeer):
+    def __init__(self, blockchain, head=None, headers=None, blocks=None):
+        super().__init__(blockchain)
+        self._head, self._headers, self._blocks = head, headers, blocks
+
+    def head(self):
+        return self._head(self.blockchain) if self._head else super().head()
+
+    def headers(self, start, limit):
+        return self._headers(self.blockchain, start, limit) if self._headers else super().headers(start, limit)
+
+    def blocks(self, start, limit):
+        return self._blocks(self.blockchain.chain[start - 1:start - 1 + limit]) if self._blocks \
+            else super().blocks(start, limit)
+
+
+def grow(blockchain, blocks, prefix='did'):
+    for i in range(blocks):
+        blockchain.new_transaction('DID_REGISTRATION', {'did': f'{prefix}:{i}', 'name': 'n', 'type': 'holder'})
+        blockchain.new_transaction('VC_ISSUANCE', {'issuer_did': 'did:issuer', 'subject_did': f'{prefix}:{i}',
+                                                   'credential_id': f'{prefix}-c{i}'})
+        blockchain.new_block()
+    return blockchain
+
+
+@pytest.fixture
+def source():
+    return grow(Blockchain(), 12)
+
+
+def follower(source, peers, **options):
+    blockchain = Blockchain()
+    node_sync = NodeSync(blockchain, genesis_hash=source.block_hashes[0], **options)
+    node_sync._peers = {peer.url: peer for peer in peers}
+    return blockchain, node_sync
+
+
+def test_new_node_fetches_headers_then_blocks_in_batches(source):
+    peer = LocalPeer(source)
+    blockchain, node_sync = follower(source, [peer], header_batch=5, block_batch=4)
+    [report] = node_sync.sync()
+    assert report['adopted'] and report['fork_height'] == 0 and report['blocks_fetched'] == 13
+    assert blockchain.block_hashes == source.block_hashes
+    assert list(blockchain.chain) == list(source.chain)
+    assert blockchain.did_registry.get_did_name('did:11') == 'n'
+    assert blockchain.find_transactions(credential_id='did-c3')[0][0]['data']['subject_did'] == 'did:3'
+    # Genesis check plus three header batches; four block batches
+    assert peer.requests == {'headers': 4, 'blocks': 4}
+
+
+def test_only_missing_blocks_are_fetched(source):
+    blockchain, node_sync = follower(source, [])
+    blockchain.load_chain(source.chain[:8], source.block_hashes[:8])
+    peer = LocalPeer(source)
+    node_sync._peers = {peer.url: peer}
+    [report] = node_sync.sync()
+    assert report['fork_height'] == 8 and report['blocks_fetched'] == 5 and report['blocks_dropped'] == 0
+    assert blockchain.block_hashes == source.block_hashes
+
+
+def test_fork_is_replaced_and_its_transactions_go_back_to_the_mempool(source):
+    blockchain, node_sync = follower(source, [LocalPeer(source)])
+    blockchain.load_chain(source.chain[:5], source.block_hashes[:5])
+    grow(blockchain, 2, prefix='local')
+    [report] = node_sync.sync()
+    assert report['adopted'] and report['fork_height'] == 5 and report['blocks_dropped'] == 2
+    assert blockchain.block_hashes == source.block_hashes
+    mempool = {transaction['data'].get('credential_id') for transaction in blockchain.current_transactions}
+    assert mempool == {'local-c0', 'local-c1', None}
+    assert blockchain.find_transactions(credential_id='local-c0')[0] == []
+
+
+def test_shorter_or_equal_chain_is_not_adopted(source):
+    blockchain, node_sync = follower(source, [LocalPeer(grow(Blockchain(), 3))])
+    blockchain.load_chain(source.chain, source.block_hashes)
+    [report] = node_sync.sync()
+    assert not report['adopted'] and 'error' not in report
+    assert blockchain.block_hashes == source.block_hashes
+
+
+def test_chain_from_another_genesis_is_rejected(source):
+    blockchain, node_sync = follower(grow(Blockchain(), 1), [LocalPeer(source)])
+    [report] = node_sync.sync()
+    assert not report['adopted'] and 'genesis' in report['error']
+    assert len(blockchain.chain) == 1
+
+
+def test_headers_without_proof_of_work_are_rejected(source):
+    blockchain, node_sync = follower(source, [LocalPeer(source)], consensus=ProofOfWork(difficulty=32, workers=1))
+    [report] = node_sync.sync()
+    assert not report['adopted'] and 'proof' in report['error']
+    assert len(blockchain.chain) == 1
+
+
+def test_unreachable_peer_does_not_stop_the_others(source):
+    class Unreachable(LocalPeer):
+        def head(self):
+            raise OSError("connection refused")
+
+    blockchain, node_sync = follower(source, [Unreachable(source, url='http://down'), LocalPeer(source)])
+    down, up = node_sync.sync()
+    assert not down['adopted'] and 'refused' in down['error']
+    assert up['adopted'] and blockchain.block_hashes == source.block_hashes
+
+
+def retamper(blocks, **changes):
+    return [{**block, **changes} for block in blocks]
+
+
+MALFORMED = {
+    'head without height': dict(head=lambda chain: {'hash': 'x'}),
+    'head with a string height': dict(head=lambda chain: {'height': '99'}),
+    'no headers': dict(headers=lambda chain, start, limit: []),
+    'headers out of order': dict(headers=lambda chain, start, limit: unpack_headers(chain.headers(start + 1, limit))),
+    'unlinked headers': dict(headers=lambda chain, start, limit: [
+        ({**header, 'previous_hash': '00' * 32} if header['index'] > 1 else header, block_hash)
+        for header, block_hash in unpack_headers(chain.headers(start, limit))]),
+    'block list of lists': dict(blocks=lambda blocks: [[1]] * len(blocks)),
+    'block without transactions': dict(blocks=lambda blocks: [{'index': block['index']} for block in blocks]),
+    'extra block': dict(blocks=lambda blocks: blocks + blocks[:1]),
+    'missing block': dict(blocks=lambda blocks: blocks[:-1]),
+    'tampered proof': dict(blocks=lambda blocks: retamper(blocks, proof=1)),
+    'tampered transactions': dict(blocks=lambda blocks: retamper(blocks, transactions=[])),
+    'transaction without data': dict(blocks=lambda blocks: retamper(blocks, transactions=[{'type': 'VC_ISSUANCE'}])),
+    'numeric credential id': dict(blocks=lambda blocks: retamper(
+        blocks, transactions=[{'type': 'VC_ISSUANCE', 'data': {'credential_id': 7}}])),
+    'registration without did': dict(blocks=lambda blocks: retamper(
+        blocks, transactions=[{'type': 'DID_REGISTRATION', 'data': {'name': 'n'}}])),
+    'timestamp of the wrong type': dict(blocks=lambda blocks: retamper(blocks, timestamp='now')),
+    'corrupt gzip': dict(blocks=lambda blocks: decode_blocks(b'not gzip')),
+    'truncated gzip': dict(blocks=lambda blocks: decode_blocks(encode_blocks(blocks)[:-8])),
+    'invalid json': dict(blocks=lambda blocks: decode_blocks(gzip.compress(b'{"index": \n'))),
+}
+
+
+@pytest.mark.parametrize('name', MALFORMED)
+def test_malformed_peer_responses_leave_the_chain_untouched(source, name):
+    blockchain, node_sync = follower(source, [MalformedPeer(source, **MALFORMED[name])])
+    [report] = node_sync.sync()
+    assert not report['adopted'] and report['error']
+    assert not report['error'].startswith(('KeyError', 'TypeError', 'IndexError', 'AttributeError'))
+    assert blockchain.block_hashes[1:] == [] and len(blockchain.did_registry) == 0
+
+
+def test_malformed_blocks_raise_sync_error(source):
+    with pytest.raises(SyncError):
+        decode_blocks(b'\x1f\x8b garbage')
@@ -0,0 +1,68 @@
+import struct
+
+import pytest
+
+from wire import cbor_dumps, cbor_loads
+
+
+@pytest.mark.parametrize('value', [
+    0, 23, 24, 255, 256, 65535, 65536, 2 ** 32, 2 ** 64 - 1, -1, -24, -25, -(2 ** 64),
+    1.5, -0.0, 1e300,
+    '', 'did:example:123', 'ü' * 40, 'x' * 70000,
+    b'', b'\x00\xff' * 100,
+    True, False, None,
+    [], [1, [2, [3]]], {}, {'a': 1, 'nested': {'list': [b'sig', None]}, 7: 'int key'},
+])
+def test_round_trip(value):
+    assert cbor_loads(cbor_dumps(value)) == value
+
+
+def test_round_trip_of_a_credential_record():
+    record = {
+        'credential_id': 'c1',
+        'credential': {'issuer': 'did:i', 'credentialSubject': {'id': 'did:h', 'valid_date': '2030-01-01'}},
+        'signed_bytes': b'{"issuer":"did:i"}',
+        'signature': bytes(range(64)),
+        'key_id': 'k1',
+    }
+    assert cbor_loads(cbor_dumps(record)) == record
+
+
+def test_tuples_and_sets_encode_as_arrays():
+    assert cbor_loads(cbor_dumps((1, 2))) == [1, 2]
+    assert cbor_loads(cbor_dumps({3, 1, 2})) == [1, 2, 3]
+
+
+def test_known_encodings():
+    # RFC 8949 appendix A
+    assert cbor_dumps(100) == bytes.fromhex('1864')
+    assert cbor_dumps(-1000) == bytes.fromhex('3903e7')
+    assert cbor_dumps([1, [2, 3]]) == bytes.fromhex('8201820203')
+    assert cbor_dumps({'a': 1}) == bytes.fromhex('a1616101')
+    assert cbor_loads(bytes.fromhex('f93c00')) == 1.0  # Half-precision float
+    assert cbor_loads(bytes.fromhex('5f42010243030405ff')) == b'\x01\x02\x03\x04\x05'  # Indefinite-length bytes
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    bytes.fromhex('1a0000'),  # Truncated integer
+    bytes.fromhex('63616263') + b'x',  # Trailing data
+    bytes.fromhex('65616263'),  # Truncated text
+    bytes.fromhex('a2616101'),  # Map with a missing entry
+    bytes.fromhex('a1800102'),  # Array as a map key
+    bytes.fromhex('62c328'),  # Invalid UTF-8
+    bytes.fromhex('1c'),  # Reserved additional information
+])
+def test_malformed_data_raises_value_error(data):
+    with pytest.raises(ValueError):
+        cbor_loads(data)
+
+
+def test_unsupported_type():
+    with pytest.raises(TypeError):
+        cbor_dumps(object())
+
+
+def test_float_encoding_is_lossless():
+    value = struct.unpack('>d', struct.pack('>d', 0.1))[0]
+    assert cbor_loads(cbor_dumps(value)) == value
@@ -0,0 +1,122 @@
+import bisect
+import threading
+from array import array
+
+# Transaction data fields that hold a DID, for the by-DID index
+DID_FIELDS = ('did', 'issuer_did', 'subject_did', 'holder_did', 'verifier_did')
+
+
+def pack_location(block_index, position):
+    return (block_index << 32) | position
+
+
+def split_location(location):
+    return location >> 32, location & 0xFFFFFFFF
+
+
+class TransactionIndex:
+    """
+    Inverted indexes from DID, credential_id and transaction type to the
+    transactions that mention them. Each posting list is an array of packed
+    (block index, position) integers in chain order, extended as blocks are
+    sealed.
+    """
+
+    def __init__(self):
+        self.by_did = {}
+        self.by_credential = {}
+        self.by_type = {}
+        self._lock = threading.Lock()
+
+    def add_block(self, block):
+        with self._lock:
+            for position, transaction in enumerate(block['transactions']):
+                location = pack_location(block['index'], position)
+                data = transaction['data']
+                self._post(self.by_type, transaction['type'], location)
+                credential_id = data.get('credential_id')
+                if credential_id is not None:
+                    self._post(self.by_credential, credential_id, location)
+                dids = {data[field] for field in DID_FIELDS if data.get(field)}
+                for did in dids:
+                    self._post(self.by_did, did, location)
+
+    @staticmethod
+    def _post(index, key, location):
+        postings = index.get(key)
+        if postings is None:
+            index[key] = array('Q', [location])
+        else:
+            postings.append(location)
+
+    def lookup(self, did=None, credential_id=None, transaction_type=None):
+        """
+        Returns the posting lists for the given filters, smallest first, or
+        None if no filter was given.
+        """
+        with self._lock:
+            postings = []
+            if did is not None:
+                postings.append(self.by_did.get(did, array('Q')))
+            if credential_id is not None:
+                postings.append(self.by_credential.get(credential_id, array('Q')))
+            if transaction_type is not None:
+                postings.append(self.by_type.get(transaction_type, array('Q')))
+            if not postings:
+                return None
+            # Copy the smallest list only; the others are probed through the transaction itself
+            postings.sort(key=len)
+            return array('Q', postings[0])
+
+    def locations(self, credential_id):
+        with self._lock:
+            return [split_location(location) for location in self.by_credential.get(credential_id, ())]
+
+    def maps(self):
+        """
+        Returns {'did': ..., 'credential': ..., 'type': ...} shallow copies of
+        the posting dicts. The lists themselves are shared and keep growing,
+        so cut them with truncated() for a fixed height.
+        """
+        with self._lock:
+            return {'did': dict(self.by_did), 'credential': dict(self.by_credential), 'type': dict(self.by_type)}
+
+    @classmethod
+    def from_maps(cls, maps):
+        index = cls()
+        index.by_did, index.by_credential, index.by_type = maps['did'], maps['credential'], maps['type']
+        return index
+
+    def truncated(self, block_count):
+        """
+        Returns a copy that only indexes the first block_count blocks, e.g.
+        the blocks a reorganization keeps.
+        """
+        end = pack_location(block_count + 1, 0)
+        maps = {}
+        for name, postings_by_key in self.maps().items():
+            maps[name] = {}
+            for key, postings in postings_by_key.items():
+                kept = postings[:bisect.bisect_left(postings, end)]
+                if kept:
+                    maps[name][key] = kept
+        return self.from_maps(maps)
+
+    def clear(self):
+        with self._lock:
+            self.by_did = {}
+            self.by_credential = {}
+            self.by_type = {}
+
+
+def matches(transaction, did=None, credential_id=None, transaction_type=None, role=None):
+    data = transaction['data']
+    if transaction_type is not None and transaction['type'] != transaction_type:
+        return False
+    if credential_id is not None and data.get('credential_id') != credential_id:
+        return False
+    if did is not None:
+        fields = (role,) if role else DID_FIELDS
+        if not any(data.get(field) == did for field in fields):
+            return False
+    return True
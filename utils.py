@@ -1,7 +1,85 @@
+import atexit
+import multiprocessing
+import os
 from blockchain import Blockchain
+from consensus import create_consensus
 from did import DID
+from keystore import KeyStore
+from metrics import registry as metrics
+from storage import Storage
+from sync import NodeSync
+from sqlstore import SQLiteStorage
 from vc import VerifiableCredential
 
-blockchain = Blockchain()
-did_manager = DID()
-vc_manager = VerifiableCredential()
\ No newline at end of file
+metrics.enabled = os.environ.get('SSI_METRICS', '1') != '0'
+
+consensus = create_consensus(
+    os.environ.get('SSI_CONSENSUS', 'authority'),
+    difficulty=int(os.environ.get('SSI_POW_DIFFICULTY', 16)),
+    workers=int(os.environ.get('SSI_POW_WORKERS', 0)) or None,
+)
+
+did_manager = DID(
+    cache_size=int(os.environ.get('SSI_DID_CACHE_SIZE', 100000)),
+    cache_ttl=int(os.environ.get('SSI_DID_CACHE_TTL', 300)),
+)
+blockchain = Blockchain(
+    max_block_transactions=int(os.environ.get('SSI_BLOCK_MAX_TRANSACTIONS', 500)),
+    max_block_latency=int(os.environ.get('SSI_BLOCK_MAX_LATENCY_MS', 200)) / 1000,
+    did_registry=did_manager,
+    consensus=consensus,
+)
+keystore = KeyStore(
+    os.environ.get('SSI_KEYSTORE_DIR', 'keystore'),
+    default_algorithm=os.environ.get('SSI_KEY_ALGORITHM', 'RSA'),
+    passphrase=os.environ.get('SSI_KEYSTORE_PASSPHRASE'),
+)
+vc_manager = VerifiableCredential(
+    keystore,
+    status_base_url=os.environ.get('SSI_STATUS_BASE_URL', ''),
+    verification_cache_size=int(os.environ.get('SSI_VERIFICATION_CACHE_SIZE', 100000)),
+    verification_cache_ttl=int(os.environ.get('SSI_VERIFICATION_CACHE_TTL', 60)),
+)
+
+node_sync = NodeSync(
+    blockchain,
+    peers=[url for url in os.environ.get('SSI_PEERS', '').split(',') if url],
+    genesis_hash=os.environ.get('SSI_GENESIS_HASH') or None,
+)
+admin_token = os.environ.get('SSI_ADMIN_TOKEN')  # Guards operator-only routes
+storage = None
+
+# Signing pool workers started by forkserver or spawn re-import the main module
+# while they bootstrap; they only need the code, not a running node of their own
+if not getattr(multiprocessing.current_process(), '_inheriting', False):
+    consensus.start()  # Forks the mining workers before any other thread exists
+    atexit.register(consensus.shutdown)
+    vc_manager.start_signing_pool()  # One long-lived pool for executor='process' batches
+    atexit.register(vc_manager.shutdown)
+
+    if os.environ.get('SSI_STATE_BACKEND', 'log') == 'sqlite':
+        # Shared by every worker process, e.g. under `gunicorn -w N app:app`
+        sqlite_path = os.environ.get('SSI_SQLITE_PATH') or os.path.join(os.environ.get('SSI_DATA_DIR', 'data'), 'state.db')
+        os.makedirs(os.path.dirname(sqlite_path) or '.', exist_ok=True)
+        storage = SQLiteStorage(
+            sqlite_path,
+            pool_size=int(os.environ.get('SSI_SQLITE_POOL_SIZE', 4)),
+            batch_size=int(os.environ.get('SSI_SQLITE_BATCH_SIZE', 256)),
+            flush_interval=int(os.environ.get('SSI_SQLITE_FLUSH_MS', 10)) / 1000,
+            refresh_interval=int(os.environ.get('SSI_SQLITE_REFRESH_MS', 20)) / 1000,
+        )
+    elif os.environ.get('SSI_DATA_DIR'):
+        storage = Storage(
+            os.environ['SSI_DATA_DIR'],
+            snapshot_interval=int(os.environ.get('SSI_SNAPSHOT_INTERVAL', 1000)),
+        )
+    if storage is not None:
+        storage.attach(blockchain, vc_manager)
+        atexit.register(storage.close)
+
+    if int(os.environ.get('SSI_SYNC_INTERVAL_MS', 0)):
+        node_sync.start(int(os.environ['SSI_SYNC_INTERVAL_MS']) / 1000)
+        atexit.register(node_sync.stop)
+
+    blockchain.start_sealer()
+    atexit.register(blockchain.stop_sealer)  # Runs before storage.close, so the last block is persisted
@@ -0,0 +1,233 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter, time
+from cryptography.hazmat.primitives import serialization
+from canonical import canonicalize
+from blockchain import Blockchain
+from consensus import PROOF_OF_WORK, meets_difficulty
+from keystore import KeyStore, key_fingerprint, sign, verify
+from merkle import merkle_root
+from vc import VerifiableCredential
+
+CHECKPOINT_DID = 'chain-validator'
+
+# Set in each worker by _init_worker. With the fork start method the chain is
+# inherited from the parent instead of being pickled.
+_blocks = None
+_block_hashes = None
+_vc_manager = None
+_issuer_keys = {}
+_difficulty = 0
+
+
+def _init_worker(blocks, block_hashes, credentials, difficulty=0, issuer_keys=None):
+    global _blocks, _block_hashes, _vc_manager, _issuer_keys, _difficulty
+    _blocks = blocks
+    _difficulty = difficulty
+    _block_hashes = block_hashes
+    _issuer_keys = issuer_keys or {}
+    _vc_manager = None
+    if credentials is not None:
+        _vc_manager = VerifiableCredential()
+        _vc_manager.credentials = credentials
+
+
+def _validate_range(start, end, verify_signatures):
+    """
+    Validates blocks with 1-based indexes start..end (inclusive). Returns
+    (start, first invalid block index or None, error, signatures checked).
+    """
+    previous_hash = Blockchain.hash(_blocks[start - 2]) if start > 1 else None
+    signatures_checked = 0
+    for index in range(start, end + 1):
+        block = _blocks[index - 1]
+        if block['index'] != index:
+            return start, index, f"Block at height {index} has index {block['index']}", signatures_checked
+        if merkle_root(block['transactions']) != block['merkle_root']:
+            return start, index, "Merkle root does not match the transactions", signatures_checked
+        if previous_hash is not None and block['previous_hash'] != previous_hash:
+            return start, index, "previous_hash does not match the hash of the previous block", signatures_checked
+        previous_hash = Blockchain.hash(block)
+        if _block_hashes and previous_hash != _block_hashes[index - 1]:
+            return start, index, "Header hash does not match the hash recorded when the block was sealed", signatures_checked
+        if index > 1 and not meets_difficulty(previous_hash, _difficulty):
+            return start, index, f"Header hash does not meet the proof-of-work difficulty of {_difficulty} bits", signatures_checked
+        if not verify_signatures:
+            continue
+        for transaction in block['transactions']:
+            if transaction['type'] != 'VC_ISSUANCE':
+                continue
+            credential_id = transaction['data']['credential_id']
+            if credential_id not in _vc_manager.credentials:
+                continue  # Credential bodies are off-chain; a node may not hold every one
+            # The record carries its own public key, so it must also be one the issuer holds
+            record = _vc_manager.credentials[credential_id]
+            public_key_pem = record.key_table.get(record.key_ref)[0]
+            if record.issuer != transaction['data'].get('issuer_did') \
+                    or key_fingerprint(public_key_pem) not in _issuer_keys.get(record.issuer, ()):
+                return start, index, f"Credential {credential_id} is not signed with a key of its issuer", signatures_checked
+            signatures_checked += 1
+            if not _vc_manager.verify_signature(credential_id):
+                return start, index, f"Signature of credential {credential_id} is invalid", signatures_checked
+    return start, None, None, signatures_checked
+
+
+def _issuer_fingerprints(keystore, credentials):
+    issuers = {record.issuer for _, record in credentials.items()}
+    return {issuer: {keystore.get_key_fingerprint(issuer, key['key_id']) for key in keystore.list_keys(issuer)}
+            for issuer in issuers}
+
+
+def validate_chain(blockchain, vc_manager=None, start=1, workers=None, chunk_size=10000, difficulty=0):
+    """
+    Hashes and links blocks start..height in parallel chunks across processes
+    and, when vc_manager is given, re-verifies every anchored credential
+    signature it holds against the issuer's keys in vc_manager's keystore.
+    With a difficulty, every block after the genesis block must carry a
+    valid proof of work.
+
+    :return: <dict> Report with the first invalid block (if any) and throughput
+    """
+    began = perf_counter()
+    blocks, block_hashes, _ = blockchain.view()
+    end = len(blocks)
+    workers = workers or os.cpu_count() or 1
+    ranges = [(i, min(i + chunk_size - 1, end)) for i in range(start, end + 1, chunk_size)]
+    credentials = vc_manager.credentials if vc_manager is not None else None
+    issuer_keys = _issuer_fingerprints(vc_manager.keystore, credentials) if vc_manager is not None else None
+    results = []
+    if ranges:
+        if workers == 1 or len(ranges) == 1:
+            _init_worker(blocks, block_hashes, credentials, difficulty, issuer_keys)
+            results = [_validate_range(s, e, vc_manager is not None) for s, e in ranges]
+        else:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+            with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                     initargs=(blocks, block_hashes, credentials, difficulty, issuer_keys)) as pool:
+                futures = [pool.submit(_validate_range, s, e, vc_manager is not None) for s, e in ranges]
+                results = [future.result() for future in futures]
+
+    failures = sorted((invalid, error) for _, invalid, error, _ in results if invalid is not None)
+    elapsed = perf_counter() - began
+    checked = max(end - start + 1, 0)
+    return {
+        'valid': not failures,
+        'start': start,
+        'end': end,
+        'checked_blocks': checked,
+        'signatures_checked': sum(result[3] for result in results),
+        'first_invalid_block': failures[0][0] if failures else None,
+        'error': failures[0][1] if failures else None,
+        'elapsed_seconds': elapsed,
+        'blocks_per_second': checked / elapsed if elapsed else None,
+    }
+
+
+class CheckpointStore:
+    """
+    Signed records of the last height up to which the chain was validated,
+    so later runs only need to check the blocks added since.
+    """
+
+    def __init__(self, path, keystore):
+        self.path = path
+        self.keystore = keystore
+
+    def load(self, blockchain):
+        """
+        Returns the last checkpoint if its signature is valid and it still
+        matches the chain, otherwise None, also when the file is malformed,
+        so the caller validates the whole chain.
+        """
+        try:
+            with open(self.path) as f:
+                checkpoint = json.load(f)
+            signature = bytes.fromhex(checkpoint.pop('signature'))
+            public_key_pem = self.keystore.get_public_key_pem(CHECKPOINT_DID, checkpoint['key_id'])
+            if public_key_pem is None:
+                return None
+            public_key = serialization.load_pem_public_key(public_key_pem.encode('utf-8'))
+            verify(public_key, checkpoint['algorithm'], signature, canonicalize(checkpoint))
+            height = checkpoint['height']
+            chain = blockchain.chain
+            if not isinstance(height, int) or not 1 <= height <= len(chain) \
+                    or Blockchain.hash(chain[height - 1]) != checkpoint['block_hash']:
+                return None
+        except Exception:
+            return None  # Missing, unreadable, hand-edited or not signed by us
+        return checkpoint
+
+    def record(self, blockchain, height):
+        self.keystore.create_key(CHECKPOINT_DID)
+        key_id, algorithm, private_key = self.keystore.get_signing_key(CHECKPOINT_DID)
+        checkpoint = {
+            'height': height,
+            'block_hash': Blockchain.hash(blockchain.chain[height - 1]),
+            'created': time(),
+            'key_id': key_id,
+            'algorithm': algorithm,
+        }
+        checkpoint['signature'] = sign(private_key, algorithm, canonicalize(checkpoint)).hex()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.path)
+        return checkpoint
+
+
+def validate_incremental(blockchain, checkpoints, vc_manager=None, full=False, workers=None, chunk_size=10000,
+                         difficulty=0):
+    checkpoint = None if full else checkpoints.load(blockchain)
+    start = checkpoint['height'] + 1 if checkpoint else 1
+    report = validate_chain(blockchain, vc_manager, start, workers, chunk_size, difficulty)
+    report['checkpoint_height'] = checkpoint['height'] if checkpoint else None
+    if report['valid'] and report['end'] >= start:
+        report['new_checkpoint_height'] = checkpoints.record(blockchain, report['end'])['height']
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Validate the persisted chain of a node.")
+    parser.add_argument('--data-dir', default=os.environ.get('SSI_DATA_DIR', 'data'))
+    parser.add_argument('--keystore-dir', default=os.environ.get('SSI_KEYSTORE_DIR', 'keystore'))
+    parser.add_argument('--checkpoint', help="Checkpoint file (default: <data-dir>/checkpoint.json)")
+    parser.add_argument('--full', action='store_true', help="Ignore the last checkpoint and validate every block")
+    parser.add_argument('--no-signatures', action='store_true', help="Skip re-verifying credential signatures")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--difficulty', type=int,
+                        default=int(os.environ.get('SSI_POW_DIFFICULTY', 16))
+                        if os.environ.get('SSI_CONSENSUS') == PROOF_OF_WORK else 0,
+                        help="Proof-of-work difficulty in bits every block must meet (0 to skip)")
+    args = parser.parse_args(argv)
+
+    from storage import Storage
+
+    # The node's keystore: it holds the issuer keys signatures are checked against
+    keystore = KeyStore(args.keystore_dir, default_algorithm='Ed25519',
+                        passphrase=os.environ.get('SSI_KEYSTORE_PASSPHRASE'))
+    blockchain = Blockchain()
+    vc_manager = VerifiableCredential(keystore)
+    storage = Storage(args.data_dir, read_only=True)
+    storage.attach(blockchain, vc_manager)
+    checkpoints = CheckpointStore(args.checkpoint or os.path.join(args.data_dir, 'checkpoint.json'), keystore)
+    report = validate_incremental(
+        blockchain,
+        checkpoints,
+        None if args.no_signatures else vc_manager,
+        full=args.full,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        difficulty=args.difficulty,
+    )
+    print(json.dumps(report, indent=2))
+    return 0 if report['valid'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,94 +1,396 @@
-import json
+import functools
+import logging
+import multiprocessing
+import os
+import threading
 import uuid
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
 from datetime import datetime
+from time import perf_counter
+from canonical import canonicalize
+from credstore import CredentialStore
+from statuslist import StatusListRegistry
+from keystore import KeyStore, PublicKeyCache, RSA, key_fingerprint, sign, verify, serialize_public_key
+from metrics import registry as metrics
+from presentations import PresentationRegistry, VerificationCache
+
+logger = logging.getLogger(__name__)
+
+MAX_VERIFY_BATCH = 10000  # Credential ids accepted by one verify_credentials call
+
+_signing_keys = {}  # In signing pool workers: private key PEM -> loaded key
+
+
+def _sign_batch(private_pem, algorithm, payloads):
+    private_key = _signing_keys.get(private_pem)
+    if private_key is None:
+        if len(_signing_keys) >= 256:
+            _signing_keys.clear()
+        private_key = _signing_keys[private_pem] = serialization.load_pem_private_key(private_pem, password=None)
+    return _sign_payloads(private_key, algorithm, payloads)
+
+
+def _sign_payloads(private_key, algorithm, payloads):
+    return [sign(private_key, algorithm, payload) for payload in payloads]
+
 
 class VerifiableCredential:
-    def __init__(self):
-        self.credentials = {}
-        self.presented_credentials = {}
+    def __init__(self, keystore=None, status_base_url='', verification_cache_size=100000, verification_cache_ttl=60):
+        self.credentials = CredentialStore()
+        self.presentations = PresentationRegistry()
+        self.verification_cache = VerificationCache(verification_cache_size, verification_cache_ttl)
+        self.revoked_credentials = set()
+        # Called as listener(event, credential_id, record) on issuance and revocation, and as
+        # listener(event, credential_id, verifier_did) when a presentation is made or withdrawn
+        self.listeners = []
+        self.keystore = keystore or KeyStore()
+        self.public_keys = PublicKeyCache()
+        self.status_lists = StatusListRegistry()
+        self.status_base_url = status_base_url
+        self._verify_pool = None
+        self._signing_pool = None
+        self._pool_lock = threading.Lock()
 
     def create_credential(self, issuer_did, subject_did, credential_data):
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-        )
-        public_key = private_key.public_key()
+        key_id, algorithm, private_key = self.keystore.get_signing_key(issuer_did)
+
+        # The status list index is part of what is signed, so it is given back if signing fails
+        credential = self._build_credential(issuer_did, subject_did, credential_data)
+        try:
+            with metrics.timer('ssi_credential_canonicalize_seconds', "Time spent canonicalizing credentials"):
+                signed_bytes = canonicalize(credential)
+            with metrics.timer('ssi_credential_sign_seconds', "Time spent signing credentials"):
+                signature = sign(private_key, algorithm, signed_bytes)
+        except BaseException:
+            self._release_status_indexes(issuer_did, [credential])
+            raise
+
+        credential_id = self._store_credential(issuer_did, credential, signed_bytes, signature, algorithm, key_id)
+        metrics.inc('ssi_credentials_issued_total', help_text="Credentials issued")
+        return self.credentials[credential_id].as_dict(credential_id, credential)
+
+    def create_credentials(self, issuer_did, entries, executor='thread', max_workers=None, chunk_size=64):
+        """
+        Issues one credential per (subject_did, credential_data) entry, signing
+        chunks of them in parallel. Yields the same records as create_credential
+        in completion order, so callers can stream results while later chunks
+        are still being signed. An entry can carry the credential_id to use as
+        a third element.
+
+        :param executor: <str> 'thread' or 'process'
+        """
+        if executor not in ('thread', 'process'):
+            raise ValueError(f"Unsupported executor: {executor}")
+        key_id, algorithm, private_key = self.keystore.get_signing_key(issuer_did)
+        max_workers = max_workers or os.cpu_count() or 1
+
+        if executor == 'process':
+            private_pem = private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            )
+            pool = self.start_signing_pool()
+            sign_chunk = functools.partial(_sign_batch, private_pem, algorithm)
+        else:
+            pool = ThreadPoolExecutor(max_workers)
+            sign_chunk = functools.partial(_sign_payloads, private_key, algorithm)
+
+        chunks = self._credential_chunks(issuer_did, entries, chunk_size)
+        pending = {}
+        try:
+            while True:
+                # Keep a bounded number of chunks in flight so memory does not grow with the batch
+                while len(pending) < max_workers * 2:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    try:
+                        payloads = [canonicalize(credential) for credential in chunk[0]]
+                    except BaseException:
+                        self._release_status_indexes(issuer_did, chunk[0])
+                        raise
+                    pending[pool.submit(sign_chunk, payloads)] = (chunk, payloads)
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    signatures = future.result()  # A chunk that failed stays pending, so its indexes are released
+                    (credentials, credential_ids), payloads = pending.pop(future)
+                    # Store the whole chunk before yielding, so a caller that stops early loses no indexes
+                    stored = [
+                        (self._store_credential(
+                            issuer_did, credential, signed_bytes, signature, algorithm, key_id, credential_id
+                        ), credential)
+                        for credential, credential_id, signed_bytes, signature in zip(
+                            credentials, credential_ids, payloads, signatures)
+                    ]
+                    for credential_id, credential in stored:
+                        yield self.credentials[credential_id].as_dict(credential_id, credential)
+        except BaseException:
+            # Also when the caller stops consuming: none of the pending chunks were stored
+            for (credentials, _), _ in pending.values():
+                self._release_status_indexes(issuer_did, credentials)
+            raise
+        finally:
+            if executor == 'process':
+                for future in pending:
+                    future.cancel()  # The pool is shared and outlives the batch
+            else:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    def start_signing_pool(self, max_workers=None):
+        """
+        Returns the process pool that signs batches for executor='process',
+        creating it on first use. Workers are started by a forkserver (or
+        spawned) rather than forked from a threaded server, and cache each
+        issuer key they load.
+        """
+        with self._pool_lock:
+            if self._signing_pool is None:
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self._signing_pool = ProcessPoolExecutor(max_workers or os.cpu_count() or 1, mp_context=context)
+            return self._signing_pool
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._signing_pool is not None:
+                self._signing_pool.shutdown(wait=True, cancel_futures=True)
+                self._signing_pool = None
+            if self._verify_pool is not None:
+                self._verify_pool.shutdown(wait=True, cancel_futures=True)
+                self._verify_pool = None
+
+    def _credential_chunks(self, issuer_did, entries, chunk_size):
+        credentials, credential_ids = [], []
+        for subject_did, credential_data, *credential_id in entries:
+            credentials.append(self._build_credential(issuer_did, subject_did, credential_data))
+            credential_ids.append(credential_id[0] if credential_id else None)
+            if len(credentials) == chunk_size:
+                yield credentials, credential_ids
+                credentials, credential_ids = [], []
+        if credentials:
+            yield credentials, credential_ids
 
-        credential = {
+    def _release_status_indexes(self, issuer_did, credentials):
+        for credential in credentials:
+            self.status_lists.release(issuer_did, int(credential['credentialStatus']['statusListIndex']))
+
+    def _build_credential(self, issuer_did, subject_did, credential_data):
+        status_index = self.status_lists.allocate(issuer_did)
+        status_list_url = f"{self.status_base_url}/status/{issuer_did}"
+        return {
             "@context": ["https://www.w3.org/2018/credentials/v1"],
             "type": ["VerifiableCredential"],
             "issuer": issuer_did,
             "issuanceDate": datetime.utcnow().isoformat() + 'Z',
             "credentialSubject": {
-                "id": subject_did,
                 **credential_data,
+                "id": subject_did,  # Last, so claims cannot replace the subject
+            },
+            "credentialStatus": {
+                "id": f"{status_list_url}#{status_index}",
+                "type": "StatusList2021Entry",
+                "statusPurpose": "revocation",
+                "statusListIndex": str(status_index),
+                "statusListCredential": status_list_url,
             }
         }
 
-        credential_json = json.dumps(credential).encode('utf-8')
-        signature = private_key.sign(
-            credential_json,
-            padding.PKCS1v15(),
-            hashes.SHA256()
-        )
+    def _status_entry(self, record):
+        if record.status_index < 0:
+            return None
+        return record.issuer, record.status_index
 
-        credential_id = str(uuid.uuid4())
-        serialized_public_key = self.serialize_key(public_key)  # Serialize public key
-        self.credentials[credential_id] = {
-            "credential": credential,
-            "signature": signature,
-            "public_key": serialized_public_key,  # Store serialized public key
-        }
-        return {"credential_id": credential_id, **self.credentials[credential_id]}
+    def _store_credential(self, issuer_did, credential, signed_bytes, signature, algorithm, key_id, credential_id=None):
+        credential_id = credential_id or str(uuid.uuid4())
+        serialized_public_key = self.keystore.get_public_key_pem(issuer_did, key_id)  # Cached per issuer key
+        record = self.credentials.add(
+            credential_id,
+            credential,
+            signed_bytes,  # Exact bytes covered by the signature
+            signature,
+            serialized_public_key,  # Shared through the store's key table
+            algorithm,
+            key_id,
+            self.keystore.get_key_fingerprint(issuer_did, key_id),
+        )
+        for listener in self.listeners:
+            listener('issued', credential_id, record)
+        return credential_id
 
     def serialize_key(self, key):
-        if isinstance(key, rsa.RSAPublicKey):
-            return key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            ).decode('utf-8')
-        raise TypeError("Unsupported key type for serialization")
+        return serialize_public_key(key)
+
+    def verify_credential(self, credential_id, verifier_did=None):
+        """
+        Checks revocation and the signature. When verifier_did is given the
+        result is cached for that verifier until it expires, the credential
+        is revoked or the holder withdraws the verifier's access.
+        """
+        # Only verifiers the credential was presented to get cached results, so
+        # callers cannot fill the cache with made-up verifier_dids
+        cached = verifier_did is not None and self.presentations.is_presented(credential_id, verifier_did)
+        if cached:
+            valid = self.verification_cache.get(verifier_did, credential_id)
+            if valid is not None:
+                return valid
+        if self.is_revoked(credential_id):
+            valid = False
+        else:
+            valid = self.verify_signature(credential_id)
+        if cached and credential_id in self.credentials:
+            self.verification_cache.put(verifier_did, credential_id, valid)
+            if valid and self.is_revoked(credential_id):
+                # Revoked while the signature was being checked
+                self.verification_cache.invalidate(credential_id)
+                valid = False
+        return valid
 
-    def verify_credential(self, credential_id):
-        credential_data = self.credentials.get(credential_id)
-        if not credential_data:
+    def verify_signature(self, credential_id):
+        """
+        Checks only the stored signature, regardless of revocation status.
+        """
+        record = self.credentials.get(credential_id)
+        if record is None:
             return False
-        
-        credential = credential_data['credential']
-        signature = credential_data['signature']
-        public_key_pem = credential_data['public_key']
 
-        try:
-            public_key = serialization.load_pem_public_key(
-                public_key_pem.encode('utf-8'),
-                backend=default_backend()
-            )
+        public_key_pem, algorithm, _, fingerprint = record.key_table.get(record.key_ref)
 
-            credential_json = json.dumps(credential).encode('utf-8')
-            public_key.verify(
-                signature,
-                credential_json,
-                padding.PKCS1v15(),
-                hashes.SHA256()
-            )
+        try:
+            public_key = self.public_keys.load(public_key_pem, fingerprint or key_fingerprint(public_key_pem))
+            # encoded holds the exact signed bytes: the canonical form, or plain
+            # json.dumps output for records created before canonical serialization
+            with metrics.timer('ssi_credential_verify_seconds', "Time spent verifying credential signatures"):
+                verify(public_key, algorithm or RSA, record.signature, record.encoded)
             return True
         except Exception as e:
-            print(f"Verification failed: {str(e)}")
+            metrics.inc('ssi_credential_verify_failures_total', help_text="Credential signatures that failed to verify")
+            logger.info("Verification of %s failed: %s", credential_id, e)
             return False
 
+    def verify_credentials(self, credential_ids, verifier_did=None, max_workers=None, chunk_size=256):
+        """
+        Verifies many credentials on a shared worker pool. Returns one
+        {"credential_id", "valid", "elapsed_ms"} entry per id, in input order.
+        Results are cached for verifier_did like verify_credential's.
+        """
+        credential_ids = list(credential_ids)
+        if len(credential_ids) > MAX_VERIFY_BATCH:
+            raise ValueError(f"At most {MAX_VERIFY_BATCH} credentials can be verified at once")
+        with self._pool_lock:
+            if self._verify_pool is None:
+                self._verify_pool = ThreadPoolExecutor(max_workers or os.cpu_count() or 1)
+        chunks = [credential_ids[i:i + chunk_size] for i in range(0, len(credential_ids), chunk_size)]
+        results = []
+        for chunk_results in self._verify_pool.map(functools.partial(self._verify_chunk, verifier_did=verifier_did), chunks):
+            results.extend(chunk_results)
+        return results
+
+    def _verify_chunk(self, credential_ids, verifier_did=None):
+        results = []
+        for credential_id in credential_ids:
+            start = perf_counter()
+            valid = self.verify_credential(credential_id, verifier_did)
+            results.append({
+                "credential_id": credential_id,
+                "valid": valid,
+                "elapsed_ms": (perf_counter() - start) * 1000,
+            })
+        return results
+
     def present_credential(self, credential_id, verifier_did):
-        if credential_id not in self.presented_credentials:
-            self.presented_credentials[credential_id] = []
-        self.presented_credentials[credential_id].append(verifier_did)
+        """
+        Returns False if the credential was already presented to the verifier.
+        """
+        if not self.presentations.present(credential_id, verifier_did):
+            return False
+        for listener in self.listeners:
+            listener('presented', credential_id, verifier_did)
+        return True
 
     def revoke_credential(self, credential_id):
-        if credential_id in self.credentials:
-            del self.credentials[credential_id]
+        """
+        Flips the credential's bit in its issuer status list. The record is
+        kept so verifiers can tell a revoked credential from an unknown one.
+        Returns False if the credential is unknown or already revoked.
+        """
+        record = self.credentials.get(credential_id)
+        if record is None or credential_id in self.revoked_credentials:
+            return False
+        self._mark_revoked(credential_id, record)
+        for listener in self.listeners:
+            listener('revoked', credential_id, None)
+        return True
+
+    def _mark_revoked(self, credential_id, record):
+        self.revoked_credentials.add(credential_id)
+        status_entry = self._status_entry(record)
+        if status_entry is not None:
+            self.status_lists.revoke(*status_entry)
+        self.verification_cache.invalidate(credential_id)
+
+    def is_revoked(self, credential_id):
+        record = self.credentials.get(credential_id)
+        if record is None:
+            return credential_id in self.revoked_credentials
+        status_entry = self._status_entry(record)
+        if status_entry is None:
+            return credential_id in self.revoked_credentials
+        return self.status_lists.is_revoked(*status_entry)
+
+    def credential_status(self, credential_id):
+        if credential_id not in self.credentials and credential_id not in self.revoked_credentials:
+            return 'unknown'
+        return 'revoked' if self.is_revoked(credential_id) else 'valid'
+
+    def restore_credential(self, credential_id, record):
+        """
+        Puts back a persisted credential record without signing or notifying
+        listeners, keeping its status list index reserved.
+        """
+        self.credentials[credential_id] = record
+        status_entry = self._status_entry(self.credentials[credential_id])
+        if status_entry is not None:
+            self.status_lists.reserve(*status_entry)
+            if credential_id in self.revoked_credentials:
+                self.status_lists.revoke(*status_entry)
+
+    def import_credential(self, credential_id, record):
+        """
+        Adds a credential signed elsewhere, e.g. on the system it is migrated
+        from, and notifies listeners as on issuance. The caller checks the
+        signature first.
+        """
+        self.restore_credential(credential_id, record)
+        record = self.credentials[credential_id]
+        for listener in self.listeners:
+            listener('issued', credential_id, record)
+        return record
+
+    def restore_revocation(self, credential_id):
+        record = self.credentials.get(credential_id)
+        if record is None:
+            self.revoked_credentials.add(credential_id)
+        else:
+            self._mark_revoked(credential_id, record)
+
+    def restore_presentation(self, credential_id, verifier_did, presented=True):
+        if presented:
+            self.presentations.present(credential_id, verifier_did)
+        else:
+            self.verification_cache.invalidate(credential_id, verifier_did)
+            self.presentations.withdraw(credential_id, verifier_did)
 
     def revoke_access_credential(self, credential_id, verifier_did):
-        if credential_id in self.presented_credentials:
-            self.presented_credentials[credential_id].remove(verifier_did)
+        """
+        Returns False if the credential was not presented to the verifier.
+        """
+        self.verification_cache.invalidate(credential_id, verifier_did)
+        if not self.presentations.withdraw(credential_id, verifier_did):
+            return False
+        for listener in self.listeners:
+            listener('access_revoked', credential_id, verifier_did)
+        return True
@@ -0,0 +1,293 @@
+import base64
+import json
+import struct
+from collections.abc import Mapping
+from flask import Response, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from metrics import registry as metrics
+
+JSON_MIMETYPE = 'application/json'
+CBOR_MIMETYPE = 'application/cbor'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def _default(value):
+    # Signatures, keys and signed credential bytes are sent as base64 strings
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+_encoder = json.JSONEncoder(default=_default, separators=(',', ':'))
+
+
+def dumps(obj):
+    with metrics.timer('ssi_json_encode_seconds', "Time spent encoding JSON responses"):
+        return _encoder.encode(obj)
+
+
+def ndjson_lines(items):
+    """
+    Encodes each item exactly once, as one line of newline-delimited JSON.
+    """
+    for item in items:
+        yield _encoder.encode(item) + '\n'
+
+
+# CBOR (RFC 8949), limited to what the API sends: integers up to 64 bits,
+# floats, byte and text strings, arrays, maps, booleans and null. Signatures,
+# keys and signed credential bytes travel as native byte strings.
+
+_pack_float = struct.Struct('>Bd').pack
+_unpack_half, _unpack_single, _unpack_double = struct.Struct('>e').unpack, struct.Struct('>f').unpack, struct.Struct('>d').unpack
+_SIMPLE = {0xf4: False, 0xf5: True, 0xf6: None, 0xf7: None}
+_MAX_CACHED_TEXT = 64
+_text_cache = {}  # Encoded short strings; field names and DIDs repeat across a payload
+
+
+def _head(major, length):
+    major <<= 5
+    if length < 24:
+        return bytes((major | length,))
+    if length < 0x100:
+        return bytes((major | 24, length))
+    if length < 0x10000:
+        return bytes((major | 25,)) + length.to_bytes(2, 'big')
+    if length < 0x100000000:
+        return bytes((major | 26,)) + length.to_bytes(4, 'big')
+    if length < 0x10000000000000000:
+        return bytes((major | 27,)) + length.to_bytes(8, 'big')
+    raise ValueError("Integer does not fit in 64 bits")
+
+
+def _encode_text(value, out):
+    encoded = _text_cache.get(value)
+    if encoded is None:
+        data = value.encode('utf-8')
+        encoded = _head(3, len(data)) + data
+        if len(value) <= _MAX_CACHED_TEXT:
+            if len(_text_cache) >= 10000:
+                _text_cache.clear()
+            _text_cache[value] = encoded
+    out += encoded
+
+
+def _encode_int(value, out):
+    out += _head(0, value) if value >= 0 else _head(1, -1 - value)
+
+
+def _encode_float(value, out):
+    out += _pack_float(0xfb, value)
+
+
+def _encode_bytes(value, out):
+    out += _head(2, len(value))
+    out += value
+
+
+def _encode_map(value, out):
+    out += _head(5, len(value))
+    for key, item in value.items():
+        _ENCODERS.get(type(key), _encode_other)(key, out)
+        _ENCODERS.get(type(item), _encode_other)(item, out)
+
+
+def _encode_array(value, out):
+    out += _head(4, len(value))
+    for item in value:
+        _ENCODERS.get(type(item), _encode_other)(item, out)
+
+
+def _encode_constant(value, out):
+    out += b'\xf6' if value is None else b'\xf5' if value else b'\xf4'
+
+
+def _encode_other(value, out):
+    if isinstance(value, str):
+        _encode_text(str(value), out)
+    elif isinstance(value, bool):
+        _encode_constant(value, out)
+    elif isinstance(value, int):
+        _encode_int(int(value), out)
+    elif isinstance(value, float):
+        _encode_float(value, out)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        _encode_bytes(bytes(value), out)
+    elif isinstance(value, Mapping):
+        _encode_map(value, out)
+    elif isinstance(value, (list, tuple)):
+        _encode_array(value, out)
+    elif isinstance(value, (set, frozenset)):
+        _encode_array(sorted(value), out)
+    else:
+        raise TypeError(f"Object of type {type(value).__name__} is not CBOR serializable")
+
+
+_ENCODERS = {
+    str: _encode_text,
+    int: _encode_int,
+    float: _encode_float,
+    bool: _encode_constant,
+    type(None): _encode_constant,
+    bytes: _encode_bytes,
+    bytearray: _encode_bytes,
+    dict: _encode_map,
+    list: _encode_array,
+    tuple: _encode_array,
+}
+
+
+def cbor_dumps(obj):
+    with metrics.timer('ssi_cbor_encode_seconds', "Time spent encoding CBOR responses"):
+        out = bytearray()
+        _ENCODERS.get(type(obj), _encode_other)(obj, out)
+        return bytes(out)
+
+
+def _decode(data, offset):
+    """
+    Decodes the item starting at offset. Returns (value, next offset).
+    """
+    initial = data[offset]
+    offset += 1
+    major, info = initial >> 5, initial & 0x1f
+    if info < 24:
+        length = info
+    elif info < 28:
+        end = offset + (1 << (info - 24))
+        if end > len(data):
+            raise ValueError("Truncated CBOR data")
+        length = int.from_bytes(data[offset:end], 'big')
+        offset = end
+    elif info == 31 and major in (2, 3, 4, 5):
+        return _decode_indefinite(data, offset, major)
+    else:
+        raise ValueError(f"Unsupported CBOR additional information {info} for major type {major}")
+
+    if major == 3:
+        end = offset + length
+        if end > len(data):
+            raise ValueError("Truncated CBOR data")
+        return data[offset:end].decode('utf-8'), end
+    if major == 0:
+        return length, offset
+    if major == 5:
+        value = {}
+        for _ in range(length):
+            head = data[offset]
+            if 0x60 <= head < 0x78:  # Short text key, decoded inline
+                end = offset + head - 0x5f
+                key, offset = data[offset + 1:end].decode('utf-8'), end
+            else:
+                key, offset = _decode(data, offset)
+                if isinstance(key, (list, dict)):
+                    raise ValueError("CBOR map keys must be scalars")
+            value[key], offset = _decode(data, offset)
+        return value, offset
+    if major == 4:
+        value = []
+        for _ in range(length):
+            item, offset = _decode(data, offset)
+            value.append(item)
+        return value, offset
+    if major == 2:
+        end = offset + length
+        if end > len(data):
+            raise ValueError("Truncated CBOR data")
+        return data[offset:end], end
+    if major == 1:
+        return -1 - length, offset
+    if major == 6:
+        return _decode(data, offset)  # Tags are ignored
+    if initial in _SIMPLE:
+        return _SIMPLE[initial], offset
+    if info == 25:
+        return _unpack_half(data[offset - 2:offset])[0], offset
+    if info == 26:
+        return _unpack_single(data[offset - 4:offset])[0], offset
+    if info == 27:
+        return _unpack_double(data[offset - 8:offset])[0], offset
+    raise ValueError(f"Unsupported CBOR simple value {info}")
+
+
+def _decode_indefinite(data, offset, major):
+    items = []
+    while data[offset] != 0xff:
+        item, offset = _decode(data, offset)
+        items.append(item)
+    offset += 1
+    if major == 2:
+        return b''.join(items), offset
+    if major == 3:
+        return ''.join(items), offset
+    if major == 4:
+        return items, offset
+    if len(items) % 2 or any(isinstance(key, (list, dict)) for key in items[::2]):
+        raise ValueError("Malformed indefinite-length CBOR map")
+    return dict(zip(items[::2], items[1::2])), offset
+
+
+def cbor_loads(data):
+    """
+    Decodes a single CBOR data item. Raises ValueError on malformed or
+    trailing data.
+    """
+    data = bytes(data)
+    try:
+        value, offset = _decode(data, 0)
+    except (IndexError, RecursionError, TypeError, UnicodeDecodeError, struct.error) as e:
+        raise ValueError(f"Malformed CBOR data: {e}") from e
+    if offset != len(data):
+        raise ValueError("Trailing data after CBOR item")
+    return value
+
+
+def negotiate(accept):
+    """
+    Response mimetype for an Accept header: CBOR only when the client
+    prefers it to JSON, so clients sending */* or nothing keep getting JSON.
+    """
+    if not accept:
+        return JSON_MIMETYPE
+    return parse_accept_header(accept, MIMEAccept).best_match((JSON_MIMETYPE, CBOR_MIMETYPE), JSON_MIMETYPE)
+
+
+def request_body():
+    """
+    The request body decoded according to its Content-Type, CBOR or JSON.
+    None if it is missing or malformed.
+    """
+    if request.mimetype == CBOR_MIMETYPE:
+        try:
+            return cbor_loads(request.get_data())
+        except ValueError:
+            return None
+    return request.get_json(silent=True)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    jsonify() answers in CBOR instead when the request's Accept header
+    prefers it.
+    """
+
+    def response(self, *args, **kwargs):
+        if has_request_context() and negotiate(request.headers.get('Accept')) == CBOR_MIMETYPE:
+            return Response(cbor_dumps(self._prepare_response_obj(args, kwargs)), mimetype=CBOR_MIMETYPE)
+        return super().response(*args, **kwargs)
+
+    def dumps(self, obj, **kwargs):
+        with metrics.timer('ssi_json_encode_seconds', "Time spent encoding JSON responses"):
+            return super().dumps(obj, **kwargs)
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, (bytes, bytearray, set, frozenset)):
+            return _default(o)
+        if isinstance(o, Mapping):
+            return dict(o)
+        return DefaultJSONProvider.default(o)